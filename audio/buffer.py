@@ -0,0 +1,168 @@
+import threading
+
+
+class PCMRingBuffer:
+    # Fixed-size ring buffer between one producer (a decoder thread) and one consumer (the bot loop).
+    # The memory is allocated once; the producer writes whatever it gets, the consumer takes whole frames.
+    # The size is a multiple of the frame size, so a frame never wraps around the end of the buffer.
+
+    def __init__(self, frame_size, frames):
+        self.frame_size = frame_size
+        self.size = frame_size * frames
+        self._buffer = bytearray(self.size)
+        self._view = memoryview(self._buffer)
+        self._read_pos = 0
+        self._write_pos = 0
+        self._fill = 0
+        self._eof = False  # the producer has nothing more to write
+        self._aborted = False  # the consumer is not interested anymore
+        self._cond = threading.Condition()
+
+        # called by the producer when a frame becomes readable after the buffer starved, and at the end
+        # of the stream, so that the consumer doesn't have to poll
+        self.listener = None
+
+        # underruns: frames asked by the consumer while the buffer was starving, once playback started
+        # overruns: writes that found the buffer full and had to wait for the consumer, or drop data
+        self.underruns = 0
+        self.overruns = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def fill_level(self):
+        return self._fill / self.size
+
+    def available(self):
+        return self._fill
+
+    def is_eof(self):
+        return self._eof
+
+    def is_aborted(self):
+        return self._aborted
+
+    def is_drained(self):
+        return self._eof and self._fill == 0
+
+    def write(self, data):
+        # Block until all of data is in the buffer. Return False if the consumer aborted.
+        data = memoryview(data)
+        while len(data):
+            ready = False
+            with self._cond:
+                if self._fill == self.size and not self._aborted:
+                    self.overruns += 1
+                    while self._fill == self.size and not self._aborted:
+                        self._cond.wait()
+                if self._aborted:
+                    return False
+
+                size = min(len(data), self.size - self._fill, self.size - self._write_pos)
+                self._view[self._write_pos:self._write_pos + size] = data[:size]
+                self._write_pos = (self._write_pos + size) % self.size
+                self._fill += size
+                self.bytes_written += size
+                self._cond.notify_all()
+                ready = self._fill >= self.frame_size > self._fill - size
+
+            if ready and self.listener:
+                self.listener()
+            data = data[size:]
+
+        return True
+
+    def wait_for_space(self, size, timeout):
+        # Wait until size bytes can be written without blocking, or timeout. Return whether they can.
+        with self._cond:
+            return self._cond.wait_for(lambda: self.size - self._fill >= size or self._aborted, timeout) \
+                and not self._aborted
+
+    def write_nowait(self, data):
+        # Write the whole frames of data that fit in the buffer right now, and drop the rest instead of
+        # waiting for the consumer. Return the number of bytes written.
+        with self._cond:
+            if self._aborted:
+                return 0
+            size = min(len(data), self.size - self._fill)
+            size -= size % self.frame_size
+            if size < len(data):
+                self.overruns += 1
+        # only the producer adds to the buffer: this doesn't block
+        return size if size and self.write(memoryview(data)[:size]) else 0
+
+    def write_from(self, readinto, max_size):
+        # Let the producer read straight into the free space of the buffer, without an intermediate copy.
+        # readinto(view) fills view and returns the number of bytes written, like io.RawIOBase.readinto.
+        # Return that number, 0 at the end of the stream or if the consumer aborted.
+        with self._cond:
+            if self._fill == self.size and not self._aborted:
+                self.overruns += 1
+                while self._fill == self.size and not self._aborted:
+                    self._cond.wait()
+            if self._aborted:
+                return 0
+            # only the producer moves _write_pos, and the consumer never looks past _fill
+            start = self._write_pos
+            size = min(max_size, self.size - self._fill, self.size - start)
+
+        written = readinto(self._view[start:start + size])
+        if not written:
+            return 0
+
+        with self._cond:
+            self._write_pos = (start + written) % self.size
+            self._fill += written
+            self.bytes_written += written
+            self._cond.notify_all()
+            ready = self._fill >= self.frame_size > self._fill - written
+
+        if ready and self.listener:
+            self.listener()
+        return written
+
+    def close(self):
+        # called by the producer once everything has been written
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+        if self.listener:
+            self.listener()
+
+    def abort(self):
+        # called by the consumer, wakes up a blocked producer
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+    def read_into(self, out):
+        # Copy as many whole frames as fit into out, a writable buffer whose size is a multiple of the
+        # frame size. At the end of the stream the last frame may be shorter. Return the number of bytes
+        # copied, 0 once the stream is drained, None if the producer is late: nothing can be played for now.
+        with self._cond:
+            if self._fill < self.frame_size and not self._eof:
+                if self.bytes_read:
+                    self.underruns += 1
+                return None
+
+            size = min(len(out), self._fill)
+            if size < self._fill or not self._eof:
+                size -= size % self.frame_size
+            first = min(size, self.size - self._read_pos)
+            out[:first] = self._view[self._read_pos:self._read_pos + first]
+            out[first:size] = self._view[:size - first]
+            self._read_pos = (self._read_pos + size) % self.size
+            self._fill -= size
+            self.bytes_read += size
+            self._cond.notify_all()
+
+        return size
+
+    def stats(self):
+        return {'size': self.size,
+                'fill': self._fill,
+                'fill_level': self.fill_level(),
+                'underruns': self.underruns,
+                'overruns': self.overruns,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read}
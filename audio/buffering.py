@@ -0,0 +1,86 @@
+import collections
+import time
+
+from audio.pcm import FRAME_DURATION
+
+# Oversleeps of the loop remembered to estimate how late it wakes up, about 10 s of waits
+JITTER_WINDOW = 500
+
+# The target covers this many times the worst oversleep seen, plus two frames
+JITTER_HEADROOM = 3
+
+# The target is lowered at most once every STEADY_PERIOD seconds without underrun, by LOWER_STEP of it,
+# and raised by RAISE_STEP of it at every underrun.
+STEADY_PERIOD = 2.0
+LOWER_STEP = 0.2
+RAISE_STEP = 0.5
+
+# decisions kept for !telemetry
+DECISIONS = 10
+
+
+class BufferTarget:
+    # Seconds of audio the loop keeps in pymumble's buffer. The loop must hand over the next frame before
+    # what is queued has been played, so the target has to cover how late the loop wakes up; but every
+    # second of it is a second a skip or a pause takes to be heard. The target follows the worst
+    # oversleep of the loop, is raised at once when the output runs dry, and lowered slowly when all
+    # goes well, between 'minimum' and 'maximum'.
+
+    def __init__(self, minimum=0.1, maximum=1.0, initial=0.5):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target = min(max(initial, minimum), self.maximum)
+        self.oversleeps = collections.deque(maxlen=JITTER_WINDOW)
+        self.last_change = time.monotonic()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.decisions = collections.deque(maxlen=DECISIONS)  # (time, old target, new target, reason)
+        self.raised = 0
+        self.lowered = 0
+        self.flushes = 0
+        self.flushed = 0.0
+
+    def needed(self):
+        # what the oversleeps seen lately call for
+        return JITTER_HEADROOM * max(self.oversleeps, default=0) + 2 * FRAME_DURATION
+
+    def woke(self, oversleep):
+        # The loop woke up oversleep seconds after the end of a wait for the buffer to drain
+        self.oversleeps.append(max(oversleep, 0))
+        now = time.monotonic()
+        needed = self.needed()
+        if needed > self.target:
+            self._set(needed, f"wakes up {oversleep * 1000:.0f} ms late", now)
+        elif now - self.last_change > STEADY_PERIOD:
+            self._set(max(needed, self.target * (1 - LOWER_STEP)), "steady", now)
+
+    def underrun(self):
+        # The output ran dry before the loop sent the next frame
+        self._set(self.target * (1 + RAISE_STEP) + FRAME_DURATION, "underrun", time.monotonic())
+
+    def flush(self, seconds):
+        self.flushes += 1
+        self.flushed += seconds
+
+    def _set(self, target, reason, now):
+        target = min(max(target, self.minimum), self.maximum)
+        self.last_change = now
+        if abs(target - self.target) < 0.001:
+            return
+        if target > self.target:
+            self.raised += 1
+        else:
+            self.lowered += 1
+        self.decisions.append((time.time(), self.target, target, reason))
+        self.target = target
+
+    def report(self):
+        lines = [f"output buffer target: {self.target * 1000:.0f} ms (from {self.minimum * 1000:.0f} to "
+                 f"{self.maximum * 1000:.0f} ms), worst oversleep {max(self.oversleeps, default=0) * 1000:.1f} ms, "
+                 f"raised {self.raised} times, lowered {self.lowered} times",
+                 f"flushed at interrupts: {self.flushes} times, {self.flushed:.1f} s"]
+        for when, old, new, reason in self.decisions:
+            lines.append(f"  {time.strftime('%H:%M:%S', time.localtime(when))} {old * 1000:.0f} → "
+                         f"{new * 1000:.0f} ms: {reason}")
+        return lines
@@ -0,0 +1,280 @@
+import collections
+import logging
+import mmap
+import re
+import subprocess as sp
+import threading
+
+from audio.buffer import PCMRingBuffer
+from audio.pcm import FRAME_DURATION, SAMPLE_RATE, frame_size, seconds_to_bytes
+
+log = logging.getLogger("bot")
+
+# Audio moved at once from ffmpeg into the ring buffer, and from the ring buffer to the bot.
+# 200 ms are 20 frames: one syscall and one lock instead of twenty.
+READ_BLOCK = 0.2
+
+# Lines of ffmpeg's stderr kept to explain a failure
+STDERR_TAIL = 20
+
+# Kinds of ffmpeg failures, from its error messages. The first match wins.
+ERROR_MISSING = "missing"
+ERROR_UNSUPPORTED = "unsupported"
+ERROR_NETWORK = "network"
+ERROR_UNKNOWN = "unknown"
+error_patterns = [
+    (ERROR_MISSING, re.compile(r"No such file or directory|does not exist|404 Not Found|410 Gone", re.I)),
+    (ERROR_NETWORK, re.compile(r"Connection (refused|reset|timed out)|timed out|Network is unreachable|"
+                               r"Name or service not known|name resolution|Server returned 5(\d\d|XX)|HTTP error 5\d\d|"
+                               r"Input/output error|End of file while", re.I)),
+    (ERROR_UNSUPPORTED, re.compile(r"Invalid data found|Unknown (de|en)coder|could not find codec|"
+                                   r"Decoder \(codec .*\) not found|not supported|moov atom not found|"
+                                   r"Failed to read frame size|Unknown input format|does not contain any stream",
+                                   re.I)),
+]
+
+
+def classify_error(message):
+    for kind, pattern in error_patterns:
+        if pattern.search(message):
+            return kind
+    return ERROR_UNKNOWN
+
+
+class Decoder:
+    # One ffmpeg process decoding an uri into s16le PCM, and a thread moving its output into a ring buffer.
+    # The bot only ever talks to the ring buffer, so a slow ffmpeg doesn't block the bot and a busy bot
+    # doesn't block ffmpeg, as long as the buffer is neither empty nor full.
+    # Both sides work on blocks of READ_BLOCK; the bot still gets one frame at a time, sliced from its block.
+
+    passthrough = False  # see OpusDecoder
+
+    def __init__(self, uri, channels, start_from=0, buffer_duration=1.0, ffmpeg_debug=False, listener=None,
+                 gain=1.0, recording=None, end=None):
+        self.uri = uri
+        self.channels = channels
+        self.start_from = start_from
+        self.end = end  # where the song stops for the bot, in seconds, None for the end of the stream
+        self.gain = gain  # not applied here: the bot applies it together with the volume
+        self.ffmpeg_debug = ffmpeg_debug
+        # A PCMRecording getting a copy of the whole song: ffmpeg decodes it from its beginning to its end,
+        # what comes before start_from and after end is only written into the recording.
+        self.recording = recording
+        self._skip = seconds_to_bytes(start_from, channels) if recording else 0
+        self._limit = None
+        if recording and end is not None:
+            self._limit = max(seconds_to_bytes(end, channels) - self._skip, 0)
+        self._handed = 0  # bytes written into the ring buffer
+        self._tail = False  # the bot has everything it plays, the rest of the song is for the recording
+        self.frame_size = frame_size(channels)
+        frames = max(1, int(buffer_duration / FRAME_DURATION))
+        self.buffer = PCMRingBuffer(self.frame_size, frames)
+        self.buffer.listener = listener
+
+        # the block the frames given to the bot are sliced from, refilled from the ring buffer once consumed
+        self.block_size = self.frame_size * max(1, min(frames, int(READ_BLOCK / FRAME_DURATION)))
+        self._block = bytearray(self.block_size)
+        self._block_view = memoryview(self._block)
+        self._block_pos = 0
+        self._block_end = 0
+
+        self.process = None
+        self.thread = None
+        self.stderr_thread = None
+        self.stderr_tail = collections.deque(maxlen=STDERR_TAIL)
+        self.error = None  # ffmpeg's last words if it failed
+        self.error_kind = None  # one of the ERROR_ kinds
+
+    def command(self):
+        # -ss before -i seeks in the input instead of decoding and dropping everything up to start_from,
+        # -accurate_seek then trims what lies between the key frame found and start_from.
+        # A recording needs the whole song, whose silence is then dropped by _readinto
+        seek = length = ()
+        if not self.recording:
+            if self.start_from:
+                seek = ('-ss', f"{self.start_from:f}", '-accurate_seek')
+            if self.end is not None:
+                length = ('-t', f"{max(self.end - self.start_from, 0):f}")
+        return ("ffmpeg", '-v', "debug" if self.ffmpeg_debug else "warning", '-nostdin') + seek + \
+               ('-i', self.uri, '-ac', str(self.channels)) + length + \
+               ('-f', 's16le', '-ar', str(SAMPLE_RATE), '-')
+
+    def start(self):
+        command = self.command()
+        log.debug("decoder: execute ffmpeg command: " + " ".join(command))
+
+        self._spawn(command)
+        self.thread = threading.Thread(target=self._read, name="Decoder", daemon=True)
+        self.thread.start()
+
+        return self
+
+    def _spawn(self, command):
+        # unbuffered: the reader thread reads straight into the ring buffer
+        self.process = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=0)
+        self.stderr_tail.clear()
+        self.stderr_thread = threading.Thread(target=self._drain_stderr, args=(self.process,), name="DecoderStderr",
+                                              daemon=True)
+        self.stderr_thread.start()
+
+    def _wait(self, aborted):
+        # Wait for ffmpeg once its output has been read, and find out why it failed if it did
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr_thread.join()
+        if self.process.returncode != 0 and not aborted:
+            self.error = "\n".join(self.stderr_tail) or f"ffmpeg exited with code {self.process.returncode}"
+            self.error_kind = classify_error(self.error)
+            log.debug(f"decoder: ffmpeg failed ({self.error_kind}): {self.error}")
+
+    def _drain_stderr(self, process):
+        # ffmpeg would block once the pipe is full if nobody read it
+        for line in process.stderr:
+            line = line.decode("utf-8", "ignore").rstrip()
+            if line:
+                self.stderr_tail.append(line)
+                if self.ffmpeg_debug:
+                    log.debug("ffmpeg: " + line)
+        process.stderr.close()
+
+    def _readinto(self, view):
+        # everything goes into the recording, what lies between start_from and end into view
+        while not self._tail:
+            size = self.process.stdout.readinto(view)
+            if not size:
+                return 0
+            self.recording.write(view[:size])
+
+            skipped = min(self._skip, size)
+            self._skip -= skipped
+            size -= skipped
+            if self._limit is not None and self._handed + size >= self._limit:
+                # before the bot can read the end: kill() must not stop the recording from now on
+                size = self._limit - self._handed
+                self._tail = True
+            if size:
+                if skipped:
+                    view[:size] = view[skipped:skipped + size]
+                self._handed += size
+                return size
+        return 0
+
+    def _read(self):
+        stdout = self.process.stdout
+        readinto = self._readinto if self.recording else stdout.readinto
+        while self.buffer.write_from(readinto, self.block_size):
+            pass
+
+        if self._tail:
+            # the bot may go on, ffmpeg decodes the rest of the song into the recording
+            self.buffer.close()
+            block = bytearray(self.block_size)
+            view = memoryview(block)
+            size = stdout.readinto(block)
+            while size:
+                self.recording.write(view[:size])
+                size = stdout.readinto(block)
+
+        aborted = self.buffer.is_aborted() and not self._tail
+        self._wait(aborted)
+        if self.recording:
+            self.recording.finish(self.process.returncode == 0 and not aborted)
+        # last, this wakes up the bot, which will find the error if any
+        self.buffer.close()
+
+        stats = self.buffer.stats()
+        log.debug(f"decoder: ffmpeg exited with code {self.process.returncode}, "
+                  f"{stats['bytes_written']} bytes decoded, "
+                  f"{stats['underruns']} underruns, {stats['overruns']} overruns")
+
+    def read(self):
+        # Return the next frame, as a memoryview only valid until the next call. At the end of the stream
+        # the last frame may be shorter, then b'' is returned. None means ffmpeg is late.
+        if self._block_pos == self._block_end:
+            size = self.buffer.read_into(self._block)
+            if not size:
+                return None if size is None else b''
+            self._block_pos = 0
+            self._block_end = size
+
+        start = self._block_pos
+        self._block_pos = min(start + self.frame_size, self._block_end)
+        return self._block_view[start:self._block_pos]
+
+    def available(self):
+        # bytes decoded and not read yet
+        return self._block_end - self._block_pos + self.buffer.available()
+
+    def consumed(self):
+        # bytes handed out by read() since start_from
+        return self.buffer.bytes_read - (self._block_end - self._block_pos)
+
+    def is_eof(self):
+        # everything has been decoded
+        return self.buffer.is_eof()
+
+    def is_finished(self):
+        return self._block_pos == self._block_end and self.buffer.is_drained()
+
+    def kill(self):
+        self.buffer.abort()
+        if self.process and self.process.poll() is None and not self._tail:
+            self.process.kill()
+
+
+class MappedDecoder:
+    # Same interface as Decoder, for a song already decoded into a file by the PCM cache. Nothing to decode
+    # and nothing to wait for: the frames handed to the bot are slices of the memory mapped file.
+
+    passthrough = False
+
+    def __init__(self, path, channels, start_from=0, gain=1.0, end=None):
+        self.uri = path
+        self.channels = channels
+        self.start_from = start_from
+        self.end = end
+        self.gain = gain
+        self.frame_size = frame_size(channels)
+        self.error = None
+        self.error_kind = None
+
+        self._view = None
+        self._start = 0
+        self._pos = 0
+        self._end = 0
+
+    def start(self):
+        with open(self.uri, "rb") as file:
+            self._view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        self._end = len(self._view)
+        if self.end is not None:
+            self._end = min(seconds_to_bytes(self.end, self.channels), self._end)
+        # seeking is only an offset
+        self._start = self._pos = min(seconds_to_bytes(self.start_from, self.channels), self._end)
+        log.debug(f"decoder: play {self.uri} from the pcm cache at {self.start_from:f}s")
+
+        return self
+
+    def read(self):
+        if self._pos >= self._end:
+            return b''
+        start = self._pos
+        self._pos = min(start + self.frame_size, self._end)
+        return self._view[start:self._pos]
+
+    def available(self):
+        return self._end - self._pos
+
+    def consumed(self):
+        return self._pos - self._start
+
+    def is_eof(self):
+        return True
+
+    def is_finished(self):
+        return self._pos >= self._end
+
+    def kill(self):
+        # The mapping is closed once the last frame handed out is released
+        self._view = None
+        self._start = self._pos = self._end = 0
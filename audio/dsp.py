@@ -0,0 +1,196 @@
+import audioop
+import math
+import time
+
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH, apply_gains, bytes_to_seconds, frame_size
+
+# The compressor and the limiter decide on one gain per step of that many frames (1 ms), every step
+# of a block is then handled by one audioop call, like the fades.
+DSP_STEP = 48
+
+# largest sample value
+FULL_SCALE = 32767
+
+
+def db_to_gain(db):
+    return 10 ** (db / 20)
+
+
+def _smoothing(seconds):
+    # part of the way to the target covered in one step, for a time constant of 'seconds'
+    if seconds <= 0:
+        return 1.0
+    return 1 - math.exp(-DSP_STEP / (SAMPLE_RATE * seconds))
+
+
+class Equalizer:
+    # Bass and treble shelves, 'bass' and 'treble' dB on each side of 'crossover' Hz. The low band is a
+    # triangular moving average of the input: two moving averages over a power of two of samples, each
+    # made of log2(length) audioop.add of the block and the block shifted, on 32 bits samples so that
+    # the sums don't saturate. The high band is the input minus the low band. The output is delayed by
+    # 'delay' samples, the middle of the moving average (1.3 ms at 250 Hz).
+    # Every audioop call returns new bytes; the blocks joined to the tails of the previous one are the
+    # only buffers that can be reused, they are allocated once for blocks of a frame.
+
+    name = "eq"
+
+    def __init__(self, channels, bass=0.0, treble=0.0, crossover=250):
+        self.channels = channels
+        self.bass = db_to_gain(bass)
+        self.treble = db_to_gain(treble)
+        # the triangular average of 2 * length samples is 3 dB down at about 0.32 * rate / length
+        self.length = 2 ** max(1, round(math.log2(0.32 * SAMPLE_RATE / crossover)))
+        self.delay = self.length - 1
+        self._wide_frame = 4 * channels
+        # the sum of length ** 2 samples stays below 2 ** 30
+        self._scale = 1 / (2 * self.length ** 2)
+
+        # tails of the previous block: scaled 32 bits input for the averages, and input to delay
+        self._history = bytearray(2 * self.delay * self._wide_frame)
+        self._dry = bytearray(self.delay * SAMPLE_WIDTH * channels)
+        # the tails followed by a frame
+        self._low = bytearray(len(self._history) + 2 * frame_size(channels))
+        self._delayed = bytearray(len(self._dry) + frame_size(channels))
+
+    def reset(self):
+        self._history[:] = bytes(len(self._history))
+        self._dry[:] = bytes(len(self._dry))
+
+    @staticmethod
+    def _join(tail, block, out):
+        # tail followed by block, in out if it has the size, then the last len(tail) bytes become the tail
+        size = len(tail) + len(block)
+        if len(out) != size:
+            out = bytearray(size)
+        out[:len(tail)] = tail
+        out[len(tail):] = block
+        tail[:] = memoryview(out)[size - len(tail):]
+        return out
+
+    def process(self, pcm, gain):
+        wide = audioop.mul(audioop.lin2lin(pcm, SAMPLE_WIDTH, 4), 4, self._scale)
+        low = self._join(self._history, wide, self._low)
+        for _ in range(2):
+            shift = 1
+            while shift < self.length:
+                offset = shift * self._wide_frame
+                view = memoryview(low)
+                low = audioop.add(view[:-offset], view[offset:], 4)
+                shift *= 2
+        low = audioop.lin2lin(audioop.mul(low, 4, 2), 4, SAMPLE_WIDTH)
+
+        dry = memoryview(self._join(self._dry, pcm, self._delayed))[:len(pcm)]
+
+        return audioop.add(audioop.mul(dry, SAMPLE_WIDTH, self.treble),
+                           audioop.mul(low, SAMPLE_WIDTH, self.bass - self.treble), SAMPLE_WIDTH)
+
+
+class Compressor:
+    # Brings the level above 'threshold' dBFS closer to it by 'ratio', then adds 'makeup' dB. The level
+    # is the RMS of each step, the gain follows it with the 'attack' and 'release' time constants.
+
+    name = "compressor"
+
+    def __init__(self, channels, threshold=-20.0, ratio=3.0, attack=0.01, release=0.2, makeup=0.0):
+        self.threshold = threshold
+        self.slope = 1 - 1 / max(ratio, 1.0)
+        self.attack = _smoothing(attack)
+        self.release = _smoothing(release)
+        self.makeup = makeup
+        self.step_size = DSP_STEP * SAMPLE_WIDTH * channels
+        self.reduction = 0.0  # dB
+        self._out = bytearray(frame_size(channels))
+
+    def reset(self):
+        self.reduction = 0.0
+
+    def process(self, pcm, gain):
+        view = memoryview(pcm)
+        gains = []
+        reduction = self.reduction
+        for start in range(0, len(pcm), self.step_size):
+            rms = audioop.rms(view[start:start + self.step_size], SAMPLE_WIDTH)
+            target = 0.0
+            if rms:
+                over = 20 * math.log10(rms / FULL_SCALE) - self.threshold
+                if over > 0:
+                    target = over * self.slope
+            reduction += (target - reduction) * (self.attack if target > reduction else self.release)
+            gains.append(db_to_gain(self.makeup - reduction))
+        self.reduction = reduction
+
+        out = self._out if len(pcm) == len(self._out) else bytearray(len(pcm))
+        return apply_gains(pcm, gains, self.step_size, out)
+
+
+class Limiter:
+    # Keeps the peaks under 'ceiling' dBFS once the volume is applied: the volume stage comes after the
+    # chain, and its multiplication would clip them. The gain of each step is low enough for the loudest
+    # sample of the step, and comes back to 1 with the 'release' time constant.
+
+    name = "limiter"
+
+    def __init__(self, channels, ceiling=-1.0, release=0.1):
+        self.ceiling = FULL_SCALE * db_to_gain(ceiling)
+        self.release = _smoothing(release)
+        self.step_size = DSP_STEP * SAMPLE_WIDTH * channels
+        self.gain = 1.0
+        self._out = bytearray(frame_size(channels))
+
+    def reset(self):
+        self.gain = 1.0
+
+    def process(self, pcm, gain):
+        if self.gain == 1.0 and audioop.max(pcm, SAMPLE_WIDTH) * gain <= self.ceiling:
+            return pcm
+
+        view = memoryview(pcm)
+        gains = []
+        current = self.gain
+        for start in range(0, len(pcm), self.step_size):
+            peak = audioop.max(view[start:start + self.step_size], SAMPLE_WIDTH) * gain
+            current += (1 - current) * self.release
+            if current > 0.9999:
+                current = 1.0
+            if peak * current > self.ceiling:
+                current = self.ceiling / peak
+            gains.append(current)
+        self.gain = current
+
+        out = self._out if len(pcm) == len(self._out) else bytearray(len(pcm))
+        return apply_gains(pcm, gains, self.step_size, out)
+
+
+class DSPChain:
+    # Stages applied in order to the audio of a song before the volume stage. process() gets the gain
+    # the volume stage will apply. The CPU time of each stage is counted, to see what it costs.
+
+    def __init__(self, stages, channels):
+        self.stages = stages
+        self.channels = channels
+        self.reset_stats()
+
+    def reset(self):
+        # a new song starts, forget the end of the previous one
+        for stage in self.stages:
+            stage.reset()
+
+    def reset_stats(self):
+        self.cpu = {stage.name: 0.0 for stage in self.stages}
+        self.processed = 0  # bytes
+
+    def process(self, pcm, gain):
+        self.processed += len(pcm)
+        for stage in self.stages:
+            start = time.thread_time()
+            pcm = stage.process(pcm, gain)
+            self.cpu[stage.name] += time.thread_time() - start
+        return pcm
+
+    def report(self):
+        seconds = bytes_to_seconds(self.processed, self.channels)
+        lines = []
+        for stage in self.stages:
+            cost = self.cpu[stage.name] * 1000 / seconds if seconds else 0
+            lines.append(f"{stage.name}: {cost:.2f} ms of CPU per second of audio")
+        return lines
@@ -0,0 +1,98 @@
+import audioop
+import collections
+import logging
+import math
+import queue
+import threading
+import time
+
+from audio.pcm import SAMPLE_WIDTH
+
+log = logging.getLogger("bot")
+
+# The loudness of a user is the RMS of what they said during the last WINDOW seconds.
+WINDOW = 0.1
+
+
+class DuckingDetector:
+    # Tells the bot when someone talks, from the voice packets pymumble receives.
+    # pymumble's callback only queues the packets; a worker thread measures them, a batch at a time:
+    # all the packets of a user in a batch go through a single audioop.rms.
+    # A user triggers ducking once they stayed above their threshold for 'attack' seconds, and ducking
+    # is released 'release' seconds after the last packet above it.
+
+    def __init__(self, threshold=3000, attack=0.0, release=1.0):
+        self.threshold = threshold
+        self.thresholds = {}  # user name -> threshold overriding the default one
+        self.attack = attack
+        self.release = release
+
+        # (ducking, release time), replaced as a whole so that readers never see half of an update
+        self.state = (False, 0.0)
+
+        self._queue = queue.SimpleQueue()
+        self._windows = {}  # user name -> deque of (time, sum of squares, samples)
+        self._last_seen = {}
+        self._above_since = {}
+        self._thread = None
+
+    def start(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._worker, name="Ducking", daemon=True)
+            self._thread.start()
+
+    def feed(self, user, sound):
+        # called from pymumble's thread: do as little as possible
+        self._queue.put((user['name'], sound.pcm, time.time()))
+
+    def threshold_of(self, name):
+        return self.thresholds.get(name, self.threshold)
+
+    def is_ducking(self, now=None):
+        ducking, release = self.state
+        return ducking and release >= (now or time.time())
+
+    def _worker(self):
+        while True:
+            batch = collections.defaultdict(list)
+            name, pcm, received = self._queue.get()
+            batch[name].append(pcm)
+            now = received
+            while True:
+                try:
+                    name, pcm, received = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch[name].append(pcm)
+                now = max(now, received)
+
+            for name, packets in batch.items():
+                self._measure(name, b''.join(packets), now)
+
+    def _measure(self, name, pcm, now):
+        samples = len(pcm) // SAMPLE_WIDTH
+        if not samples:
+            return
+
+        window = self._windows.setdefault(name, collections.deque())
+        if now - self._last_seen.get(name, now) > WINDOW:
+            # the user stopped talking in between
+            window.clear()
+            self._above_since.pop(name, None)
+        self._last_seen[name] = now
+
+        rms = audioop.rms(pcm, SAMPLE_WIDTH)
+        window.append((now, rms * rms * samples, samples))
+        while window[0][0] < now - WINDOW:
+            window.popleft()
+        rms = int(math.sqrt(sum(w[1] for w in window) / sum(w[2] for w in window)))
+
+        threshold = self.threshold_of(name)
+        if rms > threshold:
+            since = self._above_since.setdefault(name, now)
+            if now - since >= self.attack:
+                if not self.is_ducking(now):
+                    log.debug(f"bot: ducking triggered by {name}")
+                self.state = (True, now + self.release)
+        else:
+            self._above_since.pop(name, None)
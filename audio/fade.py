@@ -0,0 +1,92 @@
+import math
+
+from audio.pcm import FRAME_SAMPLES, SAMPLE_WIDTH, apply_gain_steps
+
+FADE_IN = "in"
+FADE_OUT = "out"
+
+# Largest difference between the gain applied to a frame and the curve, 1/512: 64 at full scale. Frames
+# share one gain as long as the curve stays that close to it, which takes steps of one frame where the
+# curve is steep, and long steps where it is flat.
+FADE_TOLERANCE = 1 / 512
+
+# Upper bound of cached curves. Chunks have a fixed size, only the last chunk of a song differs.
+MAX_CACHED_CURVES = 64
+
+# The exponential curve ends at exp(-EXPONENTIAL_DECAY)
+EXPONENTIAL_DECAY = FRAME_SAMPLES / 60
+
+# Fade curves, from the first frame (gain 1) to the last frame of a fade-out.
+# A fade-in is the same curve played backwards.
+fade_curves = {}
+
+
+def exponential_curve(length):
+    # The curve botamusique has always used, falling to 1/e every 60 frames over a 10 ms frame, scaled to
+    # the length: every curve goes from 1 to (almost) 0 over the length it is made for.
+    return [math.exp(-EXPONENTIAL_DECAY * x / length) for x in range(length)]
+
+
+def linear_curve(length):
+    return [1 - x / length for x in range(length)]
+
+
+def cosine_curve(length):
+    return [0.5 + 0.5 * math.cos(math.pi * x / length) for x in range(length)]
+
+
+fade_curves['exponential'] = exponential_curve
+fade_curves['linear'] = linear_curve
+fade_curves['cosine'] = cosine_curve
+
+
+class Fader:
+    def __init__(self, shape="exponential", tolerance=FADE_TOLERANCE):
+        if shape not in fade_curves:
+            raise KeyError(f"Unknown fade curve '{shape}'")
+
+        self.shape = shape
+        self.tolerance = tolerance
+        self._curves = {}  # (length, channels, direction) -> steps, see apply_gain_steps()
+
+    def curve(self, length, channels, direction):
+        key = (length, channels, direction)
+        if key in self._curves:
+            return self._curves[key]
+
+        gains = fade_curves[self.shape](length)
+        if direction == FADE_IN:
+            gains.reverse()
+        # a step goes on while its gains stay within twice the tolerance, its gain is the middle of them
+        frame_bytes = SAMPLE_WIDTH * channels
+        steps = []
+        start = 0
+        while start < length:
+            low = high = gains[start]
+            end = start + 1
+            while end < length and max(high, gains[end]) - min(low, gains[end]) <= 2 * self.tolerance:
+                low = min(low, gains[end])
+                high = max(high, gains[end])
+                end += 1
+            steps.append((end * frame_bytes, (low + high) / 2))
+            start = end
+        curve = tuple(steps)
+
+        if len(self._curves) >= MAX_CACHED_CURVES:
+            self._curves.clear()
+        self._curves[key] = curve
+
+        return curve
+
+    def apply(self, pcm, channels, direction, pad=True):
+        # Fade pcm in or out. With pad, the faded audio is followed by the same amount of silence,
+        # which is what the bot sends when a song gets interrupted.
+        frame_bytes = SAMPLE_WIDTH * channels
+        length = len(pcm) // frame_bytes
+        size = length * frame_bytes  # a trailing partial frame is dropped
+
+        out = bytearray(2 * size if pad else size)
+        if length:
+            apply_gain_steps(memoryview(pcm)[:size], self.curve(length, channels, direction), out)
+
+        return bytes(out)
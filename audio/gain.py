@@ -0,0 +1,52 @@
+import audioop
+
+from audio.pcm import SAMPLE_WIDTH, apply_gains, frame_size
+
+# Number of frames sharing one gain value while the gain moves. Volume changes are slow compared to a
+# fade (ducking takes 200 ms, a volume change 500 ms), so 0.5 ms steps move the gain by less than 0.2%
+# each, and a 10 ms frame only needs 20 audioop calls.
+RAMP_STEP = 24
+
+# Below this difference between two consecutive gains, the ramp is not worth it: the samples
+# change by less than one unit.
+RAMP_THRESHOLD = 1 / 32768
+
+
+class GainRamp:
+    # The volume stage. The gain asked for a frame is reached at the end of that frame, starting from the
+    # gain the previous frame ended with, so ducking and volume changes are a smooth line instead of a
+    # staircase of 10 ms steps. A constant gain costs one audioop.mul, like before, and a gain of 1
+    # only a copy.
+
+    def __init__(self, channels, step=RAMP_STEP):
+        self.frame_size = frame_size(channels)
+        self.step_size = step * SAMPLE_WIDTH * channels
+        self.gain = None  # gain at the end of the last frame
+
+        steps = (self.frame_size + self.step_size - 1) // self.step_size
+        # where each step of a frame sits between the previous gain (0) and the new one (1)
+        self._ramp = tuple((i + 1) / steps for i in range(steps))
+        self._out = bytearray(self.frame_size)
+
+    def apply(self, pcm, gain):
+        # Return pcm multiplied by gain, as bytes: pymumble hands it to opuslib, whose ctypes cast
+        # doesn't take a bytearray. A moving gain is computed into a buffer reused for each full frame,
+        # anything else (fades are twice as long) into a new one.
+        size = len(pcm)
+        previous = gain if self.gain is None else self.gain
+        self.gain = gain
+
+        if abs(gain - previous) < RAMP_THRESHOLD:
+            if gain == 1:
+                return bytes(pcm)
+            return audioop.mul(pcm, SAMPLE_WIDTH, gain)
+
+        out = self._out if size == self.frame_size else bytearray(size)
+        delta = gain - previous
+        steps = (size + self.step_size - 1) // self.step_size
+        if steps == len(self._ramp):
+            gains = [previous + delta * x for x in self._ramp]
+        else:
+            gains = [previous + delta * (i + 1) / steps for i in range(steps)]
+        apply_gains(pcm, gains, self.step_size, out)
+        return bytes(out)
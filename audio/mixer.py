@@ -0,0 +1,54 @@
+import audioop
+
+from audio.fade import fade_curves
+from audio.pcm import FRAME_DURATION, SAMPLE_WIDTH, frame_size
+
+
+class CrossfadeMixer:
+    # Mix the tail of the outgoing song with the head of the incoming one, frame by frame.
+    # Gains change once per frame (10 ms), which is far below what can be heard over a fade of seconds.
+    # The sum is done by audioop.add, which saturates instead of wrapping around on overflow.
+
+    def __init__(self, channels, duration, shape="cosine"):
+        if shape not in fade_curves:
+            raise KeyError(f"Unknown fade curve '{shape}'")
+
+        self.frame_size = frame_size(channels)
+        self.length = max(1, round(duration / FRAME_DURATION))  # in frames
+        self.fade_out = tuple(fade_curves[shape](self.length))
+        # complementary gains: both songs always add up to the full level
+        self.fade_in = tuple(1 - gain for gain in self.fade_out)
+        self.position = 0
+
+        # every buffer is allocated once and reused for each frame
+        self._outgoing = bytearray(self.frame_size)
+        self._mixed = bytearray(self.frame_size)
+        self._silence = bytes(self.frame_size)
+
+    def reset(self):
+        self.position = 0
+
+    def is_done(self):
+        return self.position >= self.length
+
+    def mix(self, outgoing, incoming, outgoing_gain=1.0):
+        # outgoing may be shorter than incoming (end of the song) or None (its decoder is late),
+        # the missing part is mixed as silence. outgoing_gain scales outgoing relative to incoming.
+        # The result has the length of incoming and is only valid until the next call.
+        size = len(incoming)
+        index = min(self.position, self.length - 1)
+        self.position += 1
+
+        if outgoing:
+            n = min(len(outgoing), size)
+            self._outgoing[:n] = outgoing[:n]
+            self._outgoing[n:size] = self._silence[n:size]
+        else:
+            self._outgoing[:size] = self._silence[:size]
+
+        self._mixed[:size] = audioop.add(audioop.mul(memoryview(self._outgoing)[:size], SAMPLE_WIDTH,
+                                                     self.fade_out[index] * outgoing_gain),
+                                         audioop.mul(incoming, SAMPLE_WIDTH, self.fade_in[index]),
+                                         SAMPLE_WIDTH)
+
+        return memoryview(self._mixed)[:size]
@@ -0,0 +1,87 @@
+# Just enough of Ogg (RFC 3533) and Opus (RFC 6716, RFC 7845) to take the Opus packets out of the Ogg
+# stream ffmpeg writes when it copies the audio of a song without decoding it.
+
+OPUS_HEAD = b"OpusHead"
+OPUS_TAGS = b"OpusTags"
+
+# samples at 48 kHz of one frame, per configuration of the TOC byte: SILK, hybrid then CELT
+_frame_samples = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+
+class OggReader:
+    # Packets of the first logical stream of an Ogg stream, read from a file object
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.serial = None
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            more = self.stream.read(size - len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def packets(self):
+        packet = b''
+        while True:
+            header = self._read_exact(27)
+            if len(header) < 27:
+                return
+            if header[:4] != b"OggS":
+                raise ValueError("not an Ogg stream")
+            lacing = self._read_exact(header[26])
+            body = self._read_exact(sum(lacing))
+            if len(body) < sum(lacing):
+                return
+
+            serial = header[14:18]
+            if self.serial is None:
+                self.serial = serial
+            elif serial != self.serial:
+                continue
+            if not header[5] & 0x01:
+                packet = b''  # not a continued page: whatever was left is lost
+
+            position = 0
+            for size in lacing:
+                packet += body[position:position + size]
+                position += size
+                if size < 255:
+                    yield packet
+                    packet = b''
+
+
+def opus_packet_samples(packet):
+    # Duration of an Opus packet, in samples at 48 kHz, 0 if it isn't valid
+    if not packet:
+        return 0
+    toc = packet[0]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    elif len(packet) > 1:
+        frames = packet[1] & 0x3f
+    else:
+        return 0
+    return _frame_samples[toc >> 3] * frames
+
+
+def opus_audio_packets(packets):
+    # The audio packets following the identification header, with their duration: the comment header, and
+    # anything that isn't an Opus packet, are skipped
+    for packet in packets:
+        samples = opus_packet_samples(packet)
+        if samples and not packet.startswith(OPUS_TAGS):
+            yield packet, samples
+
+
+def opus_head(packet):
+    # (channels, pre-skip) from the identification header, None if packet isn't one
+    if len(packet) < 19 or not packet.startswith(OPUS_HEAD):
+        return None
+    return packet[9], int.from_bytes(packet[10:12], 'little')
@@ -0,0 +1,313 @@
+import collections
+import logging
+import os
+import threading
+import urllib.parse
+
+import opuslib
+
+from audio.decoder import Decoder
+from audio.ogg import OggReader, opus_audio_packets, opus_head, opus_packet_samples
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH
+
+log = logging.getLogger("bot")
+
+# Songs that may be Opus, worth trying without decoding. The others are decoded by ffmpeg right away.
+OPUS_EXTENSIONS = ('.opus', '.ogg', '.oga', '.webm')
+
+# Starts the placeholders of the packets in pymumble's queue, see OpusPassthrough
+PLACEHOLDER_MAGIC = b"\x00botamusique-opus\x00"
+
+# longest Opus packet, 120 ms
+MAX_PACKET_SAMPLES = 5760
+
+# Gain close enough to 1 to send packets as they are, 0.25 dB. The volume of the bot leaves the songs as they
+# are at 87.5: !volume 87 and !volume 88 are both within it.
+PASSTHROUGH_GAIN = 0.03
+
+# Packets waiting in pymumble's queue for the PassthroughEncoder, in seconds. There are never more than the
+# output buffer of the bot; more means that pymumble doesn't encode through it any more.
+MAX_PENDING = 3.0
+
+
+def may_be_opus(uri):
+    return os.path.splitext(urllib.parse.urlparse(uri).path)[1].lower() in OPUS_EXTENSIONS
+
+
+class OpusDecoder(Decoder):
+    # A Decoder for songs in Opus, where ffmpeg only copies the packets into an Ogg stream instead of
+    # decoding them, so that the bot can hand them to Mumble as they are (see OpusPassthrough).
+    # They are decoded here, with libopus, only when the bot needs PCM: to change the volume, fade, mix.
+    # A song that turns out not to be Opus is decoded by ffmpeg into PCM, like by Decoder.
+
+    passthrough = True  # until the song turns out not to be Opus
+
+    def __init__(self, uri, channels, start_from=0, buffer_duration=1.0, ffmpeg_debug=False, listener=None,
+                 gain=1.0):
+        super().__init__(uri, channels, start_from, buffer_duration, ffmpeg_debug, listener, gain)
+        self.listener = listener
+        self.max_samples = int(buffer_duration * SAMPLE_RATE)
+        self.cond = threading.Condition()
+        self.packets = collections.deque()  # (packet, samples)
+        self.queued_samples = 0
+        self.eof = False
+        self.aborted = False
+
+        self._opus = None
+        self._opus_stale = False  # packets were handed out without going through the decoder
+        self._pcm = b''  # decoded and not read yet
+        self._pcm_pos = 0
+        self._consumed = 0
+        self.pre_skip = 0  # samples of the encoder's delay, at the beginning of the stream, not decoded yet
+        self._packet_bytes = 0
+        self._packet_samples = 0
+
+    def command(self):
+        if not self.passthrough:
+            return super().command()
+        # small pages: ffmpeg would otherwise wait for a second of audio before writing one
+        seek = ('-ss', f"{self.start_from:f}") if self.start_from else ()
+        return ("ffmpeg", '-v', "debug" if self.ffmpeg_debug else "warning", '-nostdin') + seek + \
+               ('-i', self.uri, '-map', '0:a:0', '-c:a', 'copy', '-f', 'ogg', '-page_duration', '20000', '-')
+
+    def _read(self):
+        opus = False
+        try:
+            packets = OggReader(self.process.stdout).packets()
+            head = opus_head(next(packets, b''))
+            if head:
+                opus = True
+                self.pre_skip = head[1]
+                for packet, samples in opus_audio_packets(packets):
+                    if not self._put(packet, samples):
+                        break
+        except ValueError:
+            pass  # ffmpeg can't put this codec into Ogg, and wrote nothing
+
+        if opus or self.aborted:
+            self._wait(self.aborted)
+            with self.cond:
+                self.eof = True
+            if self.listener:
+                self.listener()
+            log.debug(f"decoder: ffmpeg exited with code {self.process.returncode}, opus packets copied")
+            return
+
+        log.debug(f"decoder: {self.uri} isn't opus, decode it")
+        self.process.kill()
+        self._wait(True)
+        self.passthrough = False
+        self._spawn(self.command())
+        super()._read()
+
+    def _put(self, packet, samples):
+        with self.cond:
+            while self.queued_samples >= self.max_samples and not self.aborted:
+                self.cond.wait()
+            if self.aborted:
+                return False
+            starving = not self.packets
+            self.packets.append((packet, samples))
+            self.queued_samples += samples
+            self._packet_bytes += len(packet)
+            self._packet_samples += samples
+        if starving and self.listener:
+            self.listener()
+        return True
+
+    def _get(self, samples=None):
+        # Next packet, None if there is none yet, b'' at the end. With samples, only a packet that long.
+        with self.cond:
+            if not self.packets:
+                return b'' if self.eof else None
+            packet, length = self.packets[0]
+            if samples is not None and length != samples:
+                return None
+            self.packets.popleft()
+            self.queued_samples -= length
+            self.cond.notify()
+            return packet
+
+    def _decode(self, packet):
+        if not self._opus:
+            self._opus = opuslib.Decoder(SAMPLE_RATE, self.channels)
+        elif self._opus_stale:
+            self._opus.reset_state()
+        self._opus_stale = False
+        try:
+            pcm = self._opus.decode(packet, MAX_PACKET_SAMPLES)
+        except opuslib.OpusError:
+            pcm = bytes(opus_packet_samples(packet) * SAMPLE_WIDTH * self.channels)
+        if self.pre_skip:
+            # The pre-skip of the header is silenced rather than cut: the frames decoded here stay aligned
+            # with the packets, and the few ms of the encoder's delay are never heard.
+            size = min(self.pre_skip * SAMPLE_WIDTH * self.channels, len(pcm))
+            pcm = bytes(size) + pcm[size:]
+            self.pre_skip -= size // (SAMPLE_WIDTH * self.channels)
+        return pcm
+
+    def read(self):
+        if not self.passthrough:
+            return super().read()
+
+        # whole frames only, whatever the length of the packets, except at the end
+        while len(self._pcm) - self._pcm_pos < self.frame_size:
+            packet = self._get()
+            if packet is None:
+                return None
+            if packet == b'':
+                break
+            self._pcm = self._pcm[self._pcm_pos:] + self._decode(packet)
+            self._pcm_pos = 0
+
+        if self._pcm_pos == len(self._pcm):
+            return b''
+        start = self._pcm_pos
+        self._pcm_pos = min(start + self.frame_size, len(self._pcm))
+        self._consumed += self._pcm_pos - start
+        return memoryview(self._pcm)[start:self._pcm_pos]
+
+    def read_packet(self, samples):
+        # The next packet as it is, if it is 'samples' long and none of it has been handed out as PCM yet.
+        # The packets holding the pre-skip are always decoded.
+        if not self.passthrough or self.pre_skip or self._pcm_pos != len(self._pcm):
+            return None
+        packet = self._get(samples)
+        if packet:
+            self._opus_stale = True
+            self._consumed += samples * SAMPLE_WIDTH * self.channels
+        return packet
+
+    def bitrate(self):
+        # mean bitrate of the packets copied so far, in bit/s
+        if not self._packet_samples:
+            return 0
+        return self._packet_bytes * 8 * SAMPLE_RATE // self._packet_samples
+
+    def available(self):
+        if not self.passthrough:
+            return super().available()
+        return self.queued_samples * SAMPLE_WIDTH * self.channels + len(self._pcm) - self._pcm_pos
+
+    def consumed(self):
+        if not self.passthrough:
+            return super().consumed()
+        return self._consumed
+
+    def is_eof(self):
+        if not self.passthrough:
+            return super().is_eof()
+        return self.eof
+
+    def is_finished(self):
+        if not self.passthrough:
+            return super().is_finished()
+        return self.eof and not self.packets and self._pcm_pos == len(self._pcm)
+
+    def kill(self):
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+        super().kill()
+
+
+class PassthroughEncoder:
+    # Stands for pymumble's encoder: the placeholders of packets are replaced by the packets, anything else
+    # is encoded by the real encoder.
+
+    def __init__(self, encoder, packets=None):
+        self.encoder = encoder
+        self.packets = packets if packets is not None else collections.OrderedDict()  # serial -> packet
+
+    @property
+    def bitrate(self):
+        return self.encoder.bitrate
+
+    @bitrate.setter
+    def bitrate(self, bitrate):
+        self.encoder.bitrate = bitrate
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def encode(self, pcm, frame_size):
+        if pcm[:len(PLACEHOLDER_MAGIC)] != PLACEHOLDER_MAGIC:
+            return self.encoder.encode(pcm, frame_size)
+
+        serial = int.from_bytes(pcm[len(PLACEHOLDER_MAGIC):len(PLACEHOLDER_MAGIC) + 8], 'little')
+        # placeholders dropped by clear_buffer() leave their packets behind
+        while self.packets and next(iter(self.packets)) < serial:
+            self.packets.popitem(last=False)
+        packet = self.packets.pop(serial, None)
+        if packet is None:
+            return self.encoder.encode(bytes(len(pcm)), frame_size)
+        return packet
+
+
+class OpusPassthrough:
+    # Sends Opus packets to Mumble through pymumble without encoding them again. pymumble only takes PCM,
+    # so each packet goes into its queue as a placeholder as long as one of its encoder frames, that the
+    # PassthroughEncoder wrapped around its encoder replaces with the packet. Placeholders must start
+    # exactly on an encoder frame, not be merged with PCM added before them.
+    # This relies on how pymumble encodes its queue: if packets stop being taken from the PassthroughEncoder,
+    # passthrough is turned off for good, and the songs are encoded again like the others.
+
+    def __init__(self, sound_output, channels):
+        self.sound_output = sound_output
+        self.channels = channels
+        self.encoder = None
+        self.serial = 0
+        self.broken = False
+        self.too_large = False  # last bitrate given to fits() was over pymumble's
+
+        self.packets = 0
+
+    @staticmethod
+    def supported(sound_output):
+        return all(hasattr(sound_output, name) for name in ('encoder', 'encoder_framesize', 'pcm', 'lock'))
+
+    @property
+    def samples(self):
+        # length of the packets pymumble sends
+        return round(self.sound_output.encoder_framesize * SAMPLE_RATE)
+
+    def bitrate(self):
+        # what pymumble encodes at, from the bandwidth allowed by the server
+        return getattr(self.sound_output.encoder, 'bitrate', None)
+
+    def fits(self, bitrate):
+        # Packets of a song go as they are only within the bitrate pymumble uses, the others are encoded
+        # again at that bitrate
+        limit = self.bitrate()
+        too_large = not limit or bitrate > limit
+        if too_large != self.too_large:
+            self.too_large = too_large
+            if too_large:
+                log.debug(f"bot: opus song at {bitrate // 1000} kb/s over the {(limit or 0) // 1000} kb/s of "
+                          f"the server, encoded again")
+        return not too_large
+
+    def ready(self):
+        output = self.sound_output
+        if output.encoder is None or self.broken:
+            return False
+        if output.encoder is not self.encoder:
+            # pymumble creates a new encoder when the server changes the codec
+            self.encoder = PassthroughEncoder(output.encoder, self.encoder.packets if self.encoder else None)
+            output.encoder = self.encoder
+
+        if len(self.encoder.packets) > MAX_PENDING * SAMPLE_RATE / self.samples:
+            log.warning("bot: pymumble doesn't encode through the passthrough encoder, opus passthrough is off")
+            self.broken = True
+            self.encoder.packets.clear()
+            return False
+
+        with output.lock:
+            return not output.pcm or len(output.pcm[-1]) == self.samples * SAMPLE_WIDTH * self.channels
+
+    def send(self, packet):
+        self.serial += 1
+        self.encoder.packets[self.serial] = packet
+        placeholder = PLACEHOLDER_MAGIC + self.serial.to_bytes(8, 'little')
+        self.sound_output.add_sound(placeholder + bytes(self.samples * SAMPLE_WIDTH * self.channels - len(placeholder)))
+        self.packets += 1
@@ -0,0 +1,66 @@
+import audioop
+
+# ffmpeg is always asked for signed 16 bits little-endian PCM at 48 kHz, the only format Mumble accepts.
+SAMPLE_RATE = 48000
+SAMPLE_WIDTH = 2
+
+# The bot hands audio to pymumble in 10 ms frames.
+FRAME_DURATION = 0.01
+FRAME_SAMPLES = int(SAMPLE_RATE * FRAME_DURATION)
+
+
+def frame_size(channels):
+    # size in bytes of one 10 ms frame
+    return FRAME_SAMPLES * SAMPLE_WIDTH * channels
+
+
+def bytes_to_seconds(size, channels):
+    return size / (SAMPLE_RATE * SAMPLE_WIDTH * channels)
+
+
+def seconds_to_bytes(seconds, channels):
+    # rounded down to a whole sample of every channel
+    return int(seconds * SAMPLE_RATE) * SAMPLE_WIDTH * channels
+
+
+def apply_gains(pcm, gains, step_size, out):
+    # Multiply consecutive slices of step_size bytes of pcm by the matching gain, writing into out.
+    # Every slice is handled by audioop in C, so the cost grows with len(gains) instead of with
+    # the number of samples. out must be at least as long as pcm; the rest of out is left untouched.
+    view = memoryview(pcm)
+    length = len(pcm)
+    start = 0
+    for gain in gains:
+        if start >= length:
+            break
+        end = min(start + step_size, length)
+        if gain == 1:
+            out[start:end] = view[start:end]
+        elif gain == 0:
+            out[start:end] = bytes(end - start)
+        else:
+            out[start:end] = audioop.mul(view[start:end], SAMPLE_WIDTH, gain)
+        start = end
+
+    return out
+
+
+def apply_gain_steps(pcm, steps, out):
+    # Same as apply_gains, for slices of different sizes: steps are (end, gain), end being the offset in
+    # bytes where the slice of gain ends.
+    view = memoryview(pcm)
+    length = len(pcm)
+    start = 0
+    for end, gain in steps:
+        if start >= length:
+            break
+        end = min(end, length)
+        if gain == 1:
+            out[start:end] = view[start:end]
+        elif gain == 0:
+            out[start:end] = bytes(end - start)
+        else:
+            out[start:end] = audioop.mul(view[start:end], SAMPLE_WIDTH, gain)
+        start = end
+
+    return out
@@ -0,0 +1,167 @@
+import collections
+import logging
+import os
+import threading
+
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH
+
+log = logging.getLogger("bot")
+
+# A song is written into the cache the second time it is decoded, songs played once are not worth
+# the disk writes.
+ADMIT_AFTER = 2
+
+
+class PCMRecording:
+    # The PCM of a song being decoded, written to a temporary file and moved into the cache once the
+    # decoder got to the end of the song.
+
+    def __init__(self, cache, key, path, max_size):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.file = open(path + ".part", "wb")
+
+    def write(self, data):
+        if not self.file:
+            return
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            log.debug(f"pcm cache: {self.key} doesn't fit into the cache")
+            self.finish(False)
+            return
+        self.file.write(data)
+
+    def finish(self, complete):
+        # called by the decoder at the end of the stream, complete is False if it was interrupted or failed
+        if not self.file:
+            return
+        self.file.close()
+        self.file = None
+
+        if complete and self.size:
+            os.replace(self.path + ".part", self.path)
+            self.cache.add(self.key, self.size)
+        else:
+            os.remove(self.path + ".part")
+            self.cache.discard(self.key)
+
+
+class PCMCache:
+    # Decoded songs, 48 kHz s16le like ffmpeg gives them to the bot, one file per song in
+    # tmp_folder/pcm/. The least recently played songs are deleted when the cache gets bigger than
+    # max_size. The order survives restarts: the mtime of a file is its last use.
+
+    def __init__(self, folder, max_size=None, channels=2):
+        self.folder = folder
+        self.max_size = max_size  # in bytes, None for no limit
+        self.channels = channels
+        self.lock = threading.Lock()
+
+        self.files = collections.OrderedDict()  # key -> size, least recently used first
+        self.size = 0
+        self.seen = collections.Counter()  # misses per key, see ADMIT_AFTER
+        self.recordings = set()  # keys being written
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.endswith(".part"):
+                os.remove(path)  # left by a bot that didn't exit cleanly
+            elif name.endswith(self._suffix()):
+                entries.append((os.path.getmtime(path), name[:-len(self._suffix())], os.path.getsize(path)))
+        for _, key, size in sorted(entries):
+            self.files[key] = size
+            self.size += size
+        self._evict()
+
+        log.info(f"pcm cache: {len(self.files)} songs, {self.size // 1048576} MB in {folder}")
+
+    def _suffix(self):
+        return f".{self.channels}ch.pcm"
+
+    def path(self, key):
+        return os.path.join(self.folder, key + self._suffix())
+
+    @staticmethod
+    def key(item):
+        # a modified file is a new song
+        if item.type == 'file':
+            return f"{item.id}-{int(item.mtime)}"
+        return item.id
+
+    def lookup(self, item):
+        # Return the path of the cached PCM of item, None if it isn't cached.
+        key = self.key(item)
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+                self.hits += 1
+                path = self.path(key)
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+
+            self.misses += 1
+            self.seen[key] += 1
+            return None
+
+    def recording(self, item):
+        # Return a PCMRecording for the decoder of item, None if it shouldn't be cached (yet)
+        key = self.key(item)
+        if self.max_size is not None and item.duration \
+                and item.duration * SAMPLE_RATE * SAMPLE_WIDTH * self.channels > self.max_size:
+            return None
+
+        with self.lock:
+            if key in self.files or key in self.recordings or self.seen[key] < ADMIT_AFTER:
+                return None
+            self.recordings.add(key)
+
+        try:
+            return PCMRecording(self, key, self.path(key), self.max_size)
+        except OSError as e:
+            log.warning(f"pcm cache: unable to write into {self.folder}: {e}")
+            self.discard(key)
+            return None
+
+    def discard(self, key):
+        with self.lock:
+            self.recordings.discard(key)
+
+    def add(self, key, size):
+        with self.lock:
+            self.recordings.discard(key)
+            if key in self.files:
+                self.size -= self.files[key]
+            self.files[key] = size
+            self.size += size
+            self.seen.pop(key, None)
+            self._evict()
+        log.debug(f"pcm cache: {key} cached, {self.size // 1048576} MB used")
+
+    def _evict(self):
+        while self.max_size is not None and self.size > self.max_size and self.files:
+            key, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                # a song being played keeps its mapping, the file only disappears from the folder
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            log.debug(f"pcm cache: {key} evicted")
+
+    def stats(self):
+        return {'songs': len(self.files),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses}
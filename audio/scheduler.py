@@ -0,0 +1,42 @@
+import threading
+
+# Longest sleep of the loop when nothing is playing. Everything the loop waits for wakes it up
+# earlier, this is only to notice a dead connection.
+IDLE_TIMEOUT = 1.0
+
+
+class PlaybackScheduler:
+    # Wakes up the bot loop as soon as something it is waiting for happens, instead of polling.
+    # Events raised while the loop is busy are remembered, so none of them is lost between the
+    # moment the loop checks its state and the moment it goes to sleep.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._reasons = set()
+
+        self.wakeups = 0
+        self.timeouts = 0
+
+    def notify(self, reason="event"):
+        with self._cond:
+            self._reasons.add(reason)
+            self._cond.notify_all()
+
+    def clear(self):
+        with self._cond:
+            self._reasons.clear()
+
+    def wait(self, timeout=IDLE_TIMEOUT):
+        # Return the reasons of the wakeup, an empty set if the timeout expired first.
+        with self._cond:
+            if not self._reasons:
+                self._cond.wait(timeout)
+
+            reasons = self._reasons
+            self._reasons = set()
+
+        if reasons:
+            self.wakeups += 1
+        else:
+            self.timeouts += 1
+        return reasons
@@ -0,0 +1,132 @@
+import logging
+import threading
+
+from audio.decoder import Decoder, READ_BLOCK
+from audio.pcm import FRAME_DURATION
+
+log = logging.getLogger("bot")
+
+
+class SharedStream(Decoder):
+    # One ffmpeg decoding a live stream for every SharedDecoder of the same uri in the process. Each block
+    # ffmpeg writes is copied into the ring buffer of every subscriber, which then reads it like the one of
+    # its own decoder: the volume, ducking and everything after is still done by each bot on its own copy.
+    # A live stream comes at its own pace: a subscriber without room for a block (its bot is stuck, or gone
+    # without killing its decoder) misses what doesn't fit, ffmpeg and the others never wait for it.
+
+    def __init__(self, hub, uri, channels, ffmpeg_debug=False):
+        # its own ring buffer isn't used, the blocks go straight to the ones of the subscribers
+        super().__init__(uri, channels, buffer_duration=FRAME_DURATION, ffmpeg_debug=ffmpeg_debug)
+        self.block_size = self.frame_size * int(READ_BLOCK / FRAME_DURATION)
+        self.hub = hub
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.aborted = False
+
+    def subscribe(self, decoder):
+        with self.lock:
+            if self.aborted:
+                return False
+            self.subscribers.append(decoder)
+            return True
+
+    def unsubscribe(self, decoder):
+        # the last one out stops ffmpeg
+        with self.lock:
+            if decoder in self.subscribers:
+                self.subscribers.remove(decoder)
+            if self.subscribers:
+                return
+            self.aborted = True
+        self.hub.remove(self)
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+
+    def _read(self):
+        block = bytearray(self.block_size)
+        view = memoryview(block)
+        pending = 0  # bytes of an incomplete frame, at the beginning of block
+        while not self.aborted:
+            size = self.process.stdout.readinto(view[pending:])
+            if not size:
+                break
+            pending += size
+            whole = pending - pending % self.frame_size
+            if whole:
+                self._fan_out(view[:whole])
+                view[:pending - whole] = view[whole:pending]
+                pending -= whole
+
+        # nobody can subscribe anymore, a bot asking for this stream from now on gets a new one
+        self.hub.remove(self)
+        if self.aborted and self.process.poll() is None:
+            self.process.kill()  # the last subscriber left before ffmpeg was started
+        self._wait(self.aborted)
+        with self.lock:
+            self.aborted = True
+            subscribers = list(self.subscribers)
+        for decoder in subscribers:
+            decoder.error = self.error
+            decoder.error_kind = self.error_kind
+            decoder.buffer.close()
+        log.debug(f"decoder: shared stream {self.uri} ended, code {self.process.returncode}")
+
+    def _fan_out(self, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for decoder in subscribers:
+            decoder.buffer.write_nowait(data)
+
+
+class SharedDecoder(Decoder):
+    # A Decoder reading a live stream decoded by a SharedStream, with any other SharedDecoder of the same
+    # uri in the process. It starts wherever the stream is, there is no seeking in a live stream.
+
+    def __init__(self, hub, uri, channels, buffer_duration=1.0, ffmpeg_debug=False, listener=None, gain=1.0):
+        super().__init__(uri, channels, 0, buffer_duration, ffmpeg_debug, listener, gain)
+        self.hub = hub
+        self.stream = None
+
+    def start(self):
+        self.stream = self.hub.subscribe(self)
+        return self
+
+    def kill(self):
+        self.buffer.abort()
+        if self.stream:
+            self.stream.unsubscribe(self)
+
+
+class StreamHub:
+    # The live streams decoded in this process, one SharedStream per uri and number of channels
+
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, decoder):
+        key = (decoder.uri, decoder.channels)
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream and stream.subscribe(decoder):
+                log.debug(f"decoder: {decoder.uri} is already decoded, share it")
+                return stream
+
+            stream = SharedStream(self, decoder.uri, decoder.channels, decoder.ffmpeg_debug)
+            stream.subscribe(decoder)
+            self.streams[key] = stream
+        return stream.start()
+
+    def remove(self, stream):
+        with self.lock:
+            if self.streams.get((stream.uri, stream.channels)) is stream:
+                del self.streams[(stream.uri, stream.channels)]
+
+    def stats(self):
+        with self.lock:
+            return {'streams': len(self.streams),
+                    'subscribers': sum(len(stream.subscribers) for stream in self.streams.values())}
+
+
+# shared by every bot of the process
+hub = StreamHub()
@@ -0,0 +1,160 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from audio.pcm import FRAME_DURATION
+
+log = logging.getLogger("bot")
+
+# upper bounds, in seconds, of the buckets of the sound output buffer histogram
+BUFFER_BUCKETS = (0.0, FRAME_DURATION, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+
+    def add(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+
+    def total(self):
+        return sum(self.counts)
+
+    def format(self):
+        total = self.total() or 1
+        lines = []
+        lower = None
+        for bound, count in zip(self.bounds, self.counts):
+            if count:
+                label = f"≤ {bound * 1000:.0f} ms" if bound != float('inf') else f"> {lower * 1000:.0f} ms"
+                lines.append(f"{label}: {count} ({count * 100 / total:.1f}%)")
+            lower = bound
+        return lines
+
+
+class LoopTelemetry:
+    # What the playback loop does, collected as it runs, so that stutter can be explained after the fact:
+    # how full the sound output buffer is every time the loop looks at it, how long the loop stays in
+    # each state of _loop_status, and the frames that were sent too late to avoid a gap.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.buffer = Histogram(BUFFER_BUCKETS)
+            self.phases = {}  # phase -> [seconds, times entered]
+            self.phase = None
+            self.phase_start = time.perf_counter()
+
+            self.frames = 0
+            self.late_frames = 0
+            self.max_gap = 0.0  # longest time without sending audio while playing
+            self.last_sent = None
+            self.queued = 0.0  # seconds the sound output had right after the last frame
+            self.stalls = 0
+
+    def buffer_level(self, seconds):
+        self.buffer.add(seconds)
+
+    def enter(self, status):
+        # the numbers of a status ("Wait for buffer 0.512") are not part of the phase
+        phase = status.rstrip("0123456789. ")
+        now = time.perf_counter()
+        with self.lock:
+            if self.phase is not None:
+                spent = self.phases.setdefault(self.phase, [0.0, 0])
+                spent[0] += now - self.phase_start
+                if phase != self.phase:
+                    spent[1] += 1
+            self.phase = phase
+            self.phase_start = now
+
+    def sent(self, buffered, playing):
+        # called for every frame handed to the sound output, buffered being what it had left when the
+        # loop last looked at it. A frame of a song already playing is late if the output ran out
+        # before it, that is if it comes longer after the previous one than what was queued then.
+        # Return whether it is late.
+        now = time.monotonic()
+        self.frames += 1
+        late = False
+        if playing and self.last_sent is not None:
+            gap = now - self.last_sent
+            self.max_gap = max(self.max_gap, gap)
+            if gap > self.queued:
+                self.late_frames += 1
+                late = True
+        self.last_sent = now
+        self.queued = buffered + FRAME_DURATION
+        return late
+
+    def resumed(self):
+        # the song goes on after a pause, its next frame comes after the pause and isn't late
+        self.last_sent = None
+
+    def report(self):
+        lines = [f"since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.since))}",
+                 f"frames: {self.frames}, late: {self.late_frames}, longest gap: {self.max_gap * 1000:.0f} ms, "
+                 f"stalls: {self.stalls}",
+                 "sound output buffer:"]
+        lines += ["  " + line for line in self.buffer.format()]
+
+        self.enter(self.phase or "")  # count the time spent in the current phase so far
+        lines.append("loop states:")
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda p: p[1][0], reverse=True)
+        for phase, (seconds, entered) in phases:
+            lines.append(f"  {phase or '?'}: {seconds:.1f} s, {entered} times")
+        return lines
+
+
+class LoopWatchdog:
+    # Logs the stack of every thread when the bot is playing but hasn't sent anything to the sound
+    # output for 'timeout' seconds, once per stall.
+
+    def __init__(self, telemetry, is_playing, timeout):
+        self.telemetry = telemetry
+        self.is_playing = is_playing
+        self.timeout = timeout
+        self._thread = None
+        self._stalled = None  # last_sent of the stall already reported
+        self._idle = time.monotonic()  # last time the bot wasn't playing
+
+    def start(self):
+        if self.timeout > 0 and not self._thread:
+            self._thread = threading.Thread(target=self._watch, name="Watchdog", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.timeout / 2)
+            now = time.monotonic()
+            if not self.is_playing():
+                self._idle = now
+                continue
+            last_sent = self.telemetry.last_sent
+            if last_sent is None or last_sent == self._stalled:
+                continue
+            # a song that just started or resumed had no chance to send anything yet
+            stalled = now - max(last_sent, self._idle)
+            if stalled > self.timeout:
+                self._stalled = last_sent
+                self.telemetry.stalls += 1
+                log.warning(f"bot: no audio sent for {stalled * 1000:.0f} ms while playing, threads:\n"
+                            + self.dump())
+
+    @staticmethod
+    def dump():
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            stacks.append(f"--- {names.get(ident, ident)}\n" + "".join(traceback.format_stack(frame)))
+        return "\n".join(stacks)
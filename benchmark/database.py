@@ -0,0 +1,76 @@
+# Measure the latency of the queries the bot runs most often, with a connection opened for every query
+# (as the databases did before the connection pool) and with the connection the pool keeps for the thread.
+# Run from the root of the repository: python -m benchmark.database [--songs 2000] [--number 500]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration, Condition
+
+
+def song(i):
+    return {'id': f"{i:032x}", 'type': 'file', 'title': f"Song {i}", 'artist': f"Artist {i % 50}",
+            'keywords': f"Song {i} Artist {i % 50}", 'tags': ["rock"] if i % 3 else ["jazz"],
+            'path': f"artist {i % 50}/song {i}.mp3", 'duration': 180}
+
+
+def fill(settings_db, music_db, songs):
+    for i in range(songs):
+        music_db.insert_music(song(i))
+    for i in range(20):
+        settings_db.set("user_ban", f"user{i}", None)
+    settings_db.set("bot", "volume", 0.1)
+
+
+def measure(query, number, pooled, pools):
+    # mean seconds per call
+    total = 0.0
+    for i in range(number):
+        if not pooled:
+            for pool in pools:
+                pool.close()
+        start = time.perf_counter()
+        query(i)
+        total += time.perf_counter() - start
+    return total / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Database query latency benchmark')
+    parser.add_argument("--songs", dest="songs", type=int, default=2000, help="songs in the library")
+    parser.add_argument("-n", "--number", dest="number", type=int, default=500, help="calls per query")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="botamusique-benchmark-")
+    try:
+        settings_db = SettingsDatabase(os.path.join(folder, "settings.db"))
+        music_db = MusicDatabase(os.path.join(folder, "music.db"))
+        DatabaseMigration(settings_db, music_db).migrate()
+        fill(settings_db, music_db, args.songs)
+        pools = (settings_db.pool, music_db.pool)
+
+        queries = [
+            ("settings get", lambda i: settings_db.getfloat("bot", "volume")),
+            ("user_ban items", lambda i: settings_db.items("user_ban")),
+            ("music by id", lambda i: music_db.query_music_by_id(f"{i % args.songs:032x}")),
+            ("regex search", lambda i: music_db.query_music(Condition().and_regexp("title", f"Song {i % 100}$"))),
+            ("insert music", lambda i: music_db.insert_music(song(i % args.songs))),
+        ]
+
+        print(f"{'query':<20}{'connect (us)':>14}{'pool (us)':>12}{'speedup':>10}")
+        for name, query in queries:
+            connect = measure(query, args.number, False, pools)
+            pooled = measure(query, args.number, True, pools)
+            print(f"{name:<20}{connect * 1e6:>14.1f}{pooled * 1e6:>12.1f}{connect / pooled:>9.1f}x")
+
+        settings_db.close()
+        music_db.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
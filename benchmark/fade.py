@@ -0,0 +1,93 @@
+# Compare the fade engine with the per-sample struct loop it replaced. The samples of the engine must stay
+# within FADE_TOLERANCE of the peak (plus one for the rounding) of the legacy ones, the benchmark fails if
+# they don't.
+# Run from the root of the repository: python -m benchmark.fade
+
+import argparse
+import array
+import math
+import struct
+import sys
+import timeit
+
+from audio.fade import Fader, FADE_IN, FADE_OUT, FADE_TOLERANCE, fade_curves
+from audio.pcm import frame_size
+
+
+def legacy_fadeout(_pcm_data, stereo=False, fadein=False):
+    # MumbleBot._fadeout before the fade engine
+    pcm_data = bytearray(_pcm_data)
+    if stereo:
+        if not fadein:
+            mask = [math.exp(-x / 60) for x in range(0, int(len(pcm_data) / 4))]
+        else:
+            mask = [math.exp(-x / 60) for x in reversed(range(0, int(len(pcm_data) / 4)))]
+
+        for i in range(int(len(pcm_data) / 4)):
+            pcm_data[4 * i:4 * i + 2] = struct.pack("<h",
+                                                    round(struct.unpack("<h", pcm_data[4 * i:4 * i + 2])[0] * mask[i]))
+            pcm_data[4 * i + 2:4 * i + 4] = struct.pack("<h", round(
+                struct.unpack("<h", pcm_data[4 * i + 2:4 * i + 4])[0] * mask[i]))
+    else:
+        mask = [math.exp(-x / 60) for x in range(0, int(len(pcm_data) / 2))]
+        for i in range(int(len(pcm_data) / 2)):
+            pcm_data[2 * i:2 * i + 2] = struct.pack("<h",
+                                                    round(struct.unpack("<h", pcm_data[2 * i:2 * i + 2])[0] * mask[i]))
+
+    return bytes(pcm_data) + bytes(len(pcm_data))
+
+
+PEAK = 20000
+
+
+def sine(channels, size):
+    samples = array.array('h', (int(PEAK * math.sin(i // channels / 10)) for i in range(size // 2)))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def max_difference(a, b):
+    a = array.array('h', a)
+    b = array.array('h', b)
+    return max(abs(x - y) for x, y in zip(a, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fade engine micro-benchmark')
+    parser.add_argument("-n", "--number", dest="number", type=int, default=2000, help="iterations per case")
+    args = parser.parse_args()
+
+    tolerance = math.ceil(FADE_TOLERANCE * PEAK) + 1
+    print(f"max err: largest difference with the legacy samples, tolerated up to {tolerance}")
+    print(f"{'case':<28}{'legacy (us)':>14}{'engine (us)':>14}{'speedup':>10}{'max err':>10}")
+    failed = False
+    for channels in (1, 2):
+        pcm = sine(channels, frame_size(channels))
+        for direction in (FADE_OUT, FADE_IN):
+            fadein = direction == FADE_IN
+            for shape in fade_curves:
+                fader = Fader(shape)
+                engine = timeit.timeit(lambda: fader.apply(pcm, channels, direction), number=args.number)
+                if shape == 'exponential':
+                    legacy = timeit.timeit(lambda: legacy_fadeout(pcm, channels == 2, fadein), number=args.number)
+                    # the legacy mono path ignored fadein and always faded out
+                    error = "n/a"
+                    if channels == 2 or not fadein:
+                        error = max_difference(legacy_fadeout(pcm, channels == 2, fadein),
+                                               fader.apply(pcm, channels, direction))
+                        failed = failed or error > tolerance
+                    print(f"{f'{channels}ch fade-{direction} {shape}':<28}"
+                          f"{legacy / args.number * 1e6:>14.1f}{engine / args.number * 1e6:>14.1f}"
+                          f"{legacy / engine:>9.1f}x{error:>10}")
+                else:
+                    print(f"{f'{channels}ch fade-{direction} {shape}':<28}"
+                          f"{'-':>14}{engine / args.number * 1e6:>14.1f}{'-':>10}{'-':>10}")
+
+    if failed:
+        print(f"the fade engine is more than {tolerance} away from the legacy fade")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# A stand-in for the pymumble connection, so that the bot can be run and measured without a Mumble server.
+# The sound output consumes its buffer in real time like pymumble does, but lazily from the clock instead
+# of with a thread, so it doesn't add any CPU load of its own to the measurements. Its clock can run
+# 'speed' times faster than the real one, to find how much faster than real time the bot can go.
+
+import argparse
+import configparser
+import os
+import tempfile
+import threading
+import time
+
+import pymumble_py3 as pymumble
+
+import constants
+import variables as var
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration
+
+
+class FakeSoundOutput:
+    def __init__(self, channels, speed=1.0):
+        self.channels = channels
+        self.speed = speed
+        self.encoder_framesize = 0.02
+        self.lock = threading.Lock()
+
+        self.queued = 0.0  # seconds of audio
+        self.last_drain = time.monotonic()
+        self.dry_since = None  # when the queue ran dry
+
+        self.bytes_sent = 0  # everything that went through add_sound
+        self.bytes_played = 0
+        self.sends = []  # (time, seconds queued before) of every add_sound
+        self.underruns = 0  # add_sound finding the queue dry, after the first one
+        self.starved = 0.0  # seconds spent dry before those
+
+    def _drain(self):
+        now = time.monotonic()
+        played = min(self.queued, (now - self.last_drain) * self.speed)
+        if self.queued and played == self.queued:
+            self.dry_since = self.last_drain + played / self.speed
+        self.queued -= played
+        self.bytes_played += int(played * SAMPLE_RATE) * SAMPLE_WIDTH * self.channels
+        self.last_drain = now
+        return now
+
+    def add_sound(self, pcm):
+        if type(pcm) is not bytes:
+            # pymumble queues it as it is, and opuslib's ctypes cast takes nothing else
+            raise TypeError(f"add_sound needs bytes, not {type(pcm).__name__}")
+        with self.lock:
+            now = self._drain()
+            if self.dry_since is not None:
+                self.underruns += 1
+                self.starved += now - self.dry_since
+                self.dry_since = None
+            self.sends.append((now, self.queued))
+            self.queued += len(pcm) / SAMPLE_WIDTH / self.channels / SAMPLE_RATE
+            self.bytes_sent += len(pcm)
+
+    def get_buffer_size(self):
+        # in seconds of the fake clock, like the bot expects
+        with self.lock:
+            self._drain()
+            return self.queued / self.speed
+
+    def clear_buffer(self):
+        with self.lock:
+            self._drain()
+            self.queued = 0.0
+            self.dry_since = None
+
+
+class FakeCallbacks(dict):
+    def set_callback(self, callback, dest):
+        self[callback] = dest
+
+
+class FakeUser(dict):
+    def unmute(self):
+        pass
+
+    def comment(self, comment):
+        pass
+
+
+class FakeUsers(dict):
+    def __init__(self):
+        super().__init__()
+        self.myself = FakeUser(channel_id=0, name="botamusique", session=0)
+
+
+class FakeChannel(dict):
+    def send_text_message(self, message):
+        pass
+
+    def move_in(self, session=None):
+        pass
+
+
+class FakeChannels(dict):
+    def __getitem__(self, item):
+        return FakeChannel(channel_id=item, name="Root")
+
+    def find_by_name(self, name):
+        return FakeChannel(channel_id=0, name=name)
+
+
+class FakeMumble:
+    def __init__(self, host, user, port=64738, password='', certfile=None, keyfile=None, reconnect=False,
+                 tokens=None, stereo=False, debug=False):
+        self.callbacks = FakeCallbacks()
+        self.users = FakeUsers()
+        self.channels = FakeChannels()
+        self.sound_output = FakeSoundOutput(2 if stereo else 1)
+        self.connected = pymumble.constants.PYMUMBLE_CONN_STATE_CONNECTED
+        self.alive = True
+
+    def start(self):
+        pass
+
+    def is_ready(self):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def set_codec_profile(self, profile):
+        pass
+
+    def set_bandwidth(self, bandwidth):
+        pass
+
+    def set_receive_sound(self, value):
+        pass
+
+    def get_max_message_length(self):
+        return 5000
+
+    def get_max_image_length(self):
+        return 131072
+
+
+def setup_environment(options=None, music_folder=None):
+    # Everything __main__ of mumbleBot.py sets up, in a temporary folder.
+    # options: {(section, option): value} overriding configuration.default.ini
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    var.config = configparser.ConfigParser(interpolation=None, allow_no_value=True)
+    var.config.read([os.path.join(root, 'configuration.default.ini')], encoding='utf-8')
+    for (section, option), value in (options or {}).items():
+        var.config.set(section, option, str(value))
+
+    folder = tempfile.mkdtemp(prefix="botamusique-benchmark-")
+    var.db = SettingsDatabase(os.path.join(folder, "settings.db"))
+    var.music_db = MusicDatabase(os.path.join(folder, "music.db"))
+    DatabaseMigration(var.db, var.music_db).migrate()
+
+    var.music_folder = music_folder or os.path.join(folder, "music/")
+    var.tmp_folder = os.path.join(folder, "tmp/")
+    os.makedirs(var.music_folder, exist_ok=True)
+    os.makedirs(var.tmp_folder, exist_ok=True)
+
+    var.language = var.config.get('bot', 'language', fallback='en_US')
+    constants.load_lang(var.language)
+
+    return folder
+
+
+def create_bot(speed=1.0):
+    # Create a MumbleBot connected to a FakeMumble. setup_environment() must have been called.
+    import mumbleBot
+    import media.playlist
+    from media.cache import MusicCache
+
+    var.cache = MusicCache(var.music_db)
+    var.playlist = media.playlist.get_playlist("one-shot")
+
+    args = argparse.Namespace(host="localhost", port=64738, user="botamusique", password="", channel=None,
+                              certificate=None, tokens=None, bandwidth=None, db=None, music_db=None, lang=None,
+                              quiet=True, verbose=False, config=None)
+    mumble = mumbleBot.pymumble.Mumble
+    mumbleBot.pymumble.Mumble = FakeMumble
+    try:
+        var.bot = mumbleBot.MumbleBot(args)
+    finally:
+        mumbleBot.pymumble.Mumble = mumble
+    var.bot.mumble.sound_output.speed = speed
+
+    return var.bot
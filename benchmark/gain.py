@@ -0,0 +1,54 @@
+# Compare the gain ramp with the audioop.mul call per frame it replaced.
+# Run from the root of the repository: python -m benchmark.gain
+
+import argparse
+import audioop
+import math
+import timeit
+
+from audio.gain import GainRamp
+from audio.pcm import FRAME_DURATION, frame_size
+from benchmark.fade import sine
+
+
+def ducking(frames, volume=0.8, ducking_volume=0.05):
+    # the gains volume_cycle() gives to consecutive frames when ducking starts
+    return [ducking_volume + (volume - ducking_volume) * math.exp(-i * FRAME_DURATION / 0.2)
+            for i in range(1, frames + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gain stage micro-benchmark')
+    parser.add_argument("-n", "--number", dest="number", type=int, default=20, help="iterations per case")
+    args = parser.parse_args()
+
+    cases = {'gain 1': [1.0] * 100,
+             'constant gain': [0.5] * 100,
+             'ducking ramp': ducking(100)}
+
+    print(f"{'case':<20}{'audioop (us)':>14}{'ramp (us)':>12}{'audioop step':>14}{'ramp step':>12}")
+    for channels in (1, 2):
+        pcm = sine(channels, frame_size(channels))
+        for name, gains in cases.items():
+            ramp = GainRamp(channels)
+
+            def run_audioop():
+                for gain in gains:
+                    audioop.mul(pcm, 2, gain)
+
+            def run_ramp():
+                for gain in gains:
+                    ramp.apply(pcm, gain)
+
+            legacy = timeit.timeit(run_audioop, number=args.number) / args.number / len(gains)
+            engine = timeit.timeit(run_ramp, number=args.number) / args.number / len(gains)
+
+            # largest jump of the gain between two consecutive samples
+            jump = max((abs(a - b) for a, b in zip(gains, gains[1:])), default=0)
+            steps = len(ramp._ramp)
+            print(f"{f'{channels}ch {name}':<20}{legacy * 1e6:>14.2f}{engine * 1e6:>12.2f}"
+                  f"{jump:>14.4f}{jump / steps:>12.5f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# CPU used by the bot loop while nothing is playing.
+# Run from the root of the repository: python -m benchmark.idle_cpu [--duration 10]
+
+import argparse
+import threading
+import time
+
+from benchmark.fake_mumble import setup_environment, create_bot
+
+
+def measure(duration):
+    start_cpu = time.process_time()
+    start = time.monotonic()
+    time.sleep(duration)
+    return (time.process_time() - start_cpu) / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the CPU used by an idle bot")
+    parser.add_argument('--duration', type=float, default=10, help="seconds measured for each state")
+    args = parser.parse_args()
+
+    setup_environment()
+    bot = create_bot()
+    thread = threading.Thread(target=bot.loop, name="MumbleBot", daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    print(f"{'state':<12} {'cpu':>8} {'wakeups/s':>10}")
+    for state in ("empty queue", "paused"):
+        if state == "paused":
+            bot.pause()
+
+        wakeups = bot.scheduler.wakeups + bot.scheduler.timeouts
+        cpu = measure(args.duration)
+        wakeups = (bot.scheduler.wakeups + bot.scheduler.timeouts - wakeups) / args.duration
+        print(f"{state:<12} {cpu * 100:>7.3f}% {wakeups:>10.2f}")
+
+    bot.exit = True
+    bot.wake("exit")
+    thread.join(5)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Insert generated songs into an empty library, then update all of them, one insert_music at a time (committed
+# one by one, or in a batch) and with one insert_music_many, and print the rows per second.
+# Run from the root of the repository: python -m benchmark.insert [--rows 10000 100000]
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration
+from benchmark.database import song
+
+
+def one_by_one(music_db, dicts):
+    for music_dict in dicts:
+        music_db.insert_music(music_dict)
+
+
+def batched(music_db, dicts):
+    with music_db.batch():
+        for music_dict in dicts:
+            music_db.insert_music(music_dict)
+
+
+def many(music_db, dicts):
+    music_db.insert_music_many(dicts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Library bulk insert benchmark')
+    parser.add_argument("--rows", dest="rows", type=int, nargs="+", default=[10000, 100000], help="songs inserted")
+    args = parser.parse_args()
+
+    print(f"{'rows':>8}  {'method':<22}{'insert (rows/s)':>17}{'update (rows/s)':>17}")
+    for rows in args.rows:
+        dicts = [song(i) for i in range(rows)]
+        for name, insert in (("insert_music", one_by_one), ("insert_music, batch", batched),
+                             ("insert_music_many", many)):
+            folder = tempfile.mkdtemp(prefix="botamusique-benchmark-")
+            try:
+                settings_db = SettingsDatabase(os.path.join(folder, "settings.db"))
+                music_db = MusicDatabase(os.path.join(folder, "music.db"))
+                DatabaseMigration(settings_db, music_db).migrate()
+
+                speeds = []
+                for _ in range(2):  # into the empty library, then over the songs inserted
+                    start = time.perf_counter()
+                    insert(music_db, dicts)
+                    speeds.append(rows / (time.perf_counter() - start))
+                print(f"{rows:>8}  {name:<22}{speeds[0]:>17.0f}{speeds[1]:>17.0f}")
+
+                settings_db.close()
+                music_db.close()
+            finally:
+                shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# Play a playlist of generated songs through the whole bot (ffmpeg, decoder, loop, volume, fades) into the
+# fake Mumble connection, and measure how regularly the audio reaches it.
+# Run from the root of the repository: python -m benchmark.pipeline [--songs 3] [--duration 5] [--speed 1]
+# ffmpeg must be in the PATH. Nothing is downloaded and no Mumble server is needed.
+
+import argparse
+import array
+import collections
+import math
+import os
+import resource
+import shutil
+import subprocess as sp
+import sys
+import threading
+import time
+import wave
+
+import variables as var
+from audio.pcm import FRAME_DURATION, SAMPLE_RATE, SAMPLE_WIDTH
+from benchmark.fake_mumble import setup_environment, create_bot
+
+# scenario -> (format of the songs, options of the bot)
+scenarios = collections.OrderedDict([
+    ('wav', ('wav', {})),
+    ('mp3', ('mp3', {})),
+    ('opus', ('opus', {})),
+    ('gapless', ('wav', {('bot', 'gapless'): True})),
+    ('crossfade', ('wav', {('bot', 'crossfade'): 2})),
+    ('ducking', ('wav', {('bot', 'ducking'): True})),
+    ('skip', ('wav', {})),
+])
+
+encoders = {'mp3': ("-c:a", "libmp3lame", "-b:a", "192k"),
+            'opus': ("-c:a", "libopus", "-b:a", "96k")}
+
+Sound = collections.namedtuple('Sound', ['pcm'])
+
+
+def write_wav(path, duration, frequency):
+    # a chord slowly going up and down, so that nothing in the chain can take a shortcut on silence
+    samples = array.array('h')
+    for i in range(int(duration * SAMPLE_RATE)):
+        t = i / SAMPLE_RATE
+        value = 8000 * math.sin(2 * math.pi * frequency * t) + 4000 * math.sin(3 * math.pi * frequency * t)
+        value *= 0.6 + 0.4 * math.sin(2 * math.pi * t / duration)
+        samples.append(int(value))
+        samples.append(int(-value))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(SAMPLE_WIDTH)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+
+
+def generate_songs(folder, count, duration, format):
+    # Return the names of the songs, None if ffmpeg can't encode this format
+    names = []
+    for i in range(count):
+        name = f"song{i}.{format}"
+        path = os.path.join(folder, name)
+        names.append(name)
+        if os.path.exists(path):
+            continue
+
+        wav = os.path.join(folder, f"song{i}.wav")
+        if not os.path.exists(wav):
+            write_wav(wav, duration, 220 * (i + 2))
+        if format == 'wav':
+            continue
+
+        command = ("ffmpeg", "-nostdin", "-v", "error", "-y", "-i", wav) + encoders[format] + (path,)
+        if sp.run(command, stdout=sp.DEVNULL, stderr=sp.DEVNULL).returncode != 0 \
+                or not os.path.exists(path) or not os.path.getsize(path):
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+    return names
+
+
+def talk(bot, stop):
+    # someone talking one second out of two, in 20 ms packets like pymumble receives them
+    loud = array.array('h', (int(12000 * math.sin(i / 5)) for i in range(960))).tobytes()
+    quiet = bytes(len(loud))
+    start = time.monotonic()
+    while not stop.is_set():
+        pcm = loud if int(time.monotonic() - start) % 2 == 0 else quiet
+        bot.ducking_sound_received({'name': 'talker'}, Sound(pcm))
+        time.sleep(0.02)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(scenario, songs, music_folder, speed, skip_every):
+    from media.cache import get_cached_wrapper_from_scrap
+
+    format, options = scenarios[scenario]
+    setup_environment(options, music_folder)
+    bot = create_bot(speed)
+    output = bot.mumble.sound_output
+
+    stop = threading.Event()
+    helpers = []
+    if scenario == 'ducking':
+        helpers.append(threading.Thread(target=talk, args=(bot, stop), name="Talker", daemon=True))
+
+    for name in songs:
+        var.playlist.append(get_cached_wrapper_from_scrap(type='file', path=name, user='benchmark'))
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = time.process_time()
+    start = time.monotonic()
+    thread = threading.Thread(target=bot.loop, name="MumbleBot", daemon=True)
+    thread.start()
+    for helper in helpers:
+        helper.start()
+
+    skips = []
+    while thread.is_alive():
+        time.sleep(skip_every if scenario == 'skip' else 0.1)
+        if len(var.playlist) == 0 or var.playlist.current_index == -1 and output.sends:
+            break
+        if scenario == 'skip' and len(var.playlist) > 1:
+            sent = len(output.sends)
+            skipped = time.monotonic()
+            bot.interrupt()
+            bot.interrupt_handled()
+            # the fade out is sent within interrupt(), the next song comes after it
+            sent = max(sent, len(output.sends))
+            while len(output.sends) <= sent and thread.is_alive():
+                time.sleep(0.001)
+            skips.append(output.sends[sent][0] - skipped)
+
+    # the last frames are still queued
+    while output.get_buffer_size() > 0:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    stop.set()
+    bot.exit = True
+    bot.wake("exit")
+    thread.join(5)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ffmpeg_cpu = children_after.ru_utime + children_after.ru_stime - children.ru_utime - children.ru_stime
+
+    audio = output.bytes_sent / (SAMPLE_RATE * SAMPLE_WIDTH * output.channels)
+    frames = audio / FRAME_DURATION
+    # refills send frames back to back, only the frames sent one at a time, as the buffer drains, say
+    # how regular the loop is
+    period = FRAME_DURATION / speed
+    jitter = [abs(b[0] - a[0] - period) for a, b in zip(output.sends, output.sends[1:])
+              if b[0] - a[0] > period / 10]
+
+    return {'fps': frames / elapsed,
+            'cpu': cpu / audio if audio else 0.0,
+            'ffmpeg': ffmpeg_cpu / audio if audio else 0.0,
+            'p50': percentile(jitter, 50),
+            'p95': percentile(jitter, 95),
+            'p99': percentile(jitter, 99),
+            'max': max(jitter, default=0.0),
+            'underruns': output.underruns,
+            'starved': output.starved,
+            'first': output.sends[0][0] - start if output.sends else float('nan'),
+            'skip': sum(skips) / len(skips) if skips else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the audio pipeline of the bot, end to end")
+    parser.add_argument('--songs', type=int, default=3, help="songs in the playlist")
+    parser.add_argument('--duration', type=float, default=5, help="seconds per song")
+    parser.add_argument('--speed', type=float, default=1, help="speed of the fake Mumble clock")
+    parser.add_argument('--skip-every', dest='skip_every', type=float, default=1.5,
+                        help="seconds between skips in the skip scenario")
+    parser.add_argument('--scenario', action='append', choices=list(scenarios),
+                        help="scenario to run, can be repeated (default: all)")
+    parser.add_argument('--music', help="folder for the generated songs, kept between runs")
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        sys.exit("ffmpeg is needed in the PATH")
+
+    music_folder = args.music or os.path.join(setup_environment(), "songs/")
+    os.makedirs(music_folder, exist_ok=True)
+    if not music_folder.endswith("/"):
+        music_folder += "/"
+
+    print(f"{'scenario':<10} {'fps':>7} {'cpu ms/s':>9} {'ffmpeg ms/s':>12} {'jitter p50':>11} {'p95':>7} "
+          f"{'p99':>7} {'max':>7} {'underruns':>10} {'starved ms':>11} {'first ms':>9} {'skip ms':>8}")
+    for scenario in args.scenario or scenarios:
+        songs = generate_songs(music_folder, args.songs, args.duration, scenarios[scenario][0])
+        if songs is None:
+            print(f"{scenario:<10} skipped, ffmpeg can't encode {scenarios[scenario][0]}")
+            continue
+
+        r = run(scenario, songs, music_folder, args.speed, args.skip_every)
+        skip = f"{r['skip'] * 1000:>8.1f}" if r['skip'] is not None else f"{'-':>8}"
+        print(f"{scenario:<10} {r['fps']:>7.1f} {r['cpu'] * 1000:>9.2f} {r['ffmpeg'] * 1000:>12.2f} "
+              f"{r['p50'] * 1000:>11.2f} {r['p95'] * 1000:>7.2f} {r['p99'] * 1000:>7.2f} {r['max'] * 1000:>7.2f} "
+              f"{r['underruns']:>10} {r['starved'] * 1000:>11.1f} {r['first'] * 1000:>9.1f} {skip}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Scan a library of generated files into an empty database, then scan it again unchanged, and print the
+# files per second, in the rollback journal the database used before and in WAL.
+# Run from the root of the repository: python -m benchmark.scan [--files 2000] [--ffprobe]
+# Running ffprobe on every new file takes most of a real first scan and would hide the rest: the duration
+# of the files is only read with ffprobe, which must then be in the PATH, with --ffprobe.
+
+import argparse
+import os
+import shutil
+import time
+import wave
+
+import util
+import variables as var
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH
+from benchmark.fake_mumble import setup_environment
+from media.cache import MusicCache
+
+
+def generate_library(folder, count):
+    # short silent songs, in folders of 100 like albums
+    silence = bytes(int(0.1 * SAMPLE_RATE) * SAMPLE_WIDTH)
+    for i in range(count):
+        album = os.path.join(folder, f"album {i // 100}")
+        os.makedirs(album, exist_ok=True)
+        with wave.open(os.path.join(album, f"song {i}.wav"), 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(SAMPLE_WIDTH)
+            f.setframerate(SAMPLE_RATE)
+            f.writeframes(silence)
+
+
+def scan(cache):
+    start = time.perf_counter()
+    cache.build_dir_cache()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Library scan throughput benchmark")
+    parser.add_argument('--files', type=int, default=2000, help="files in the library")
+    parser.add_argument('--ffprobe', action='store_true', help="read the duration of the files with ffprobe")
+    args = parser.parse_args()
+
+    if not args.ffprobe:
+        util.get_media_duration = lambda path: 0.1
+
+    library = os.path.join(setup_environment(), "library/")
+    generate_library(library, args.files)
+    folders = [os.path.dirname(os.path.dirname(library))]
+
+    print(f"{'journal':<24}{'first scan (files/s)':>22}{'rescan (files/s)':>18}")
+    for name, journal in (("rollback", "DELETE"), ("WAL", "WAL")):
+        folders.append(setup_environment(music_folder=library))
+        cache = MusicCache(var.music_db)
+        if journal != "WAL":
+            conn = var.music_db.pool.get()
+            conn.execute(f"PRAGMA journal_mode={journal}")
+            conn.execute("PRAGMA synchronous=FULL")
+        first = scan(cache)
+        again = scan(cache)
+        print(f"{name:<24}{args.files / first:>22.0f}{args.files / again:>18.0f}")
+        var.db.close()
+        var.music_db.close()
+
+    for folder in folders:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
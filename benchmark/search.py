@@ -0,0 +1,63 @@
+# Measure the keyword search of !search on a generated library, with the LIKE on the titles it used before,
+# and with the full-text index, for every result and for the page of results !search asks for.
+# Run from the root of the repository: python -m benchmark.search [--songs 100000] [--number 20]
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration
+
+words = ["love", "night", "blue", "dance", "heart", "river", "summer", "fire", "dream", "light", "rain", "road",
+         "home", "moon", "time", "city", "gold", "shadow", "ocean", "wild"]
+
+
+def song(i, rng):
+    title = " ".join(rng.choice(words) for _ in range(3)) + f" {i}"
+    artist = f"{rng.choice(words).capitalize()} Band {i % 500}"
+    return {'id': f"{i:032x}", 'type': 'file', 'title': title, 'artist': artist, 'keywords': f"{title} {artist}",
+            'tags': [], 'path': f"{artist}/{title}.mp3", 'duration': 180}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Library keyword search benchmark')
+    parser.add_argument("--songs", dest="songs", type=int, default=100000, help="songs in the library")
+    parser.add_argument("-n", "--number", dest="number", type=int, default=20, help="searches per case")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="botamusique-benchmark-")
+    try:
+        settings_db = SettingsDatabase(os.path.join(folder, "settings.db"))
+        music_db = MusicDatabase(os.path.join(folder, "music.db"))
+        DatabaseMigration(settings_db, music_db).migrate()
+        rng = random.Random(0)
+        with music_db.batch():
+            for i in range(args.songs):
+                music_db.insert_music(song(i, rng))
+
+        # what cmd_search_library asks: a page of 50 results, and one more to know if there are others
+        cases = (("LIKE", False, None), ("FTS", True, None), ("FTS page", True, 51))
+        searches = [["summer"], ["moon", "river"], ["band", "42"], ["sha"], ["dance", "fire", "night"]]
+        print(f"{'keywords':<24}" + "".join(f"{name + ' (ms)':>15}{'results':>9}" for name, _, _ in cases))
+        for keywords in searches:
+            line = f"{' '.join(keywords):<24}"
+            for name, full_text, limit in cases:
+                # without the index, the search falls back to LIKE
+                music_db.tables = None if full_text else {'music'}
+                start = time.perf_counter()
+                for _ in range(args.number):
+                    results = music_db.query_music_by_keywords(keywords, limit=limit)
+                line += f"{(time.perf_counter() - start) / args.number * 1000:>15.1f}{len(results):>9}"
+            print(line)
+
+        settings_db.close()
+        music_db.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ from constants import commands
 import util
 import variables as var
 from database import SettingsDatabase, MusicDatabase, Condition
+from audio.shared import hub
 from media.item import item_id_generators, dict_to_item, dicts_to_items
 from media.cache import get_cached_wrapper_from_scrap, get_cached_wrapper_by_id, get_cached_wrappers_by_tags, \
     get_cached_wrapper, get_cached_wrappers, get_cached_wrapper_from_dict, get_cached_wrappers_from_dicts
@@ -52,6 +53,7 @@ def register_all_commands(bot):
     bot.register_command(commands('search'), cmd_search_library)
     bot.register_command(commands('add_from_shortlist'), cmd_shortlist)
     bot.register_command(commands('rescan'), cmd_refresh_cache, no_partial_match=True)
+    bot.register_command(commands('telemetry'), cmd_telemetry, no_partial_match=True, admin=True)
 
 
 def send_multi_lines(bot, lines, text, linebreak="<br />"):
@@ -356,6 +358,7 @@ def cmd_ducking(bot, user, text, command, parameter):
 
     if parameter == "" or parameter == "on":
         bot.is_ducking = True
+        bot.ducking.start()
         var.db.set('bot', 'ducking', True)
         bot.mumble.callbacks.set_callback(pymumble.c.PYMUMBLE_CLBK_SOUNDRECEIVED, bot.ducking_sound_received)
         bot.mumble.set_receive_sound(True)
@@ -374,13 +377,29 @@ def cmd_ducking(bot, user, text, command, parameter):
 def cmd_ducking_threshold(bot, user, text, command, parameter):
     global log
 
-    if parameter and parameter.isdigit():
-        bot.ducking_threshold = int(parameter)
-        var.db.set('bot', 'ducking_threshold', str(bot.ducking_threshold))
-        msg = f"Ducking threshold set to {bot.ducking_threshold}."
+    # !duckthres [threshold] [user]: the threshold of one user if a name is given
+    params = parameter.split(maxsplit=1)
+    name = params[1] if len(params) > 1 else None
+    if params and params[0].isdigit():
+        threshold = int(params[0])
+        if name:
+            bot.ducking.thresholds[name] = threshold
+            var.db.set('ducking_threshold', name, str(threshold))
+            msg = f"Ducking threshold of {name} set to {threshold}."
+        else:
+            bot.ducking.threshold = threshold
+            var.db.set('bot', 'ducking_threshold', str(threshold))
+            msg = f"Ducking threshold set to {threshold}."
+        bot.send_msg(msg, text)
+    elif params and params[0] == "default" and name:
+        bot.ducking.thresholds.pop(name, None)
+        var.db.remove_option('ducking_threshold', name)
+        msg = f"Ducking threshold of {name} set to the default one, {bot.ducking.threshold}."
         bot.send_msg(msg, text)
     else:
-        msg = f"Current ducking threshold is {bot.ducking_threshold}."
+        msg = f"Current ducking threshold is {bot.ducking.threshold}."
+        if bot.ducking.thresholds:
+            msg += " " + ", ".join(f"{name}: {threshold}" for name, threshold in bot.ducking.thresholds.items())
         bot.send_msg(msg, text)
 
 
@@ -620,9 +639,12 @@ def cmd_add_tag(bot, user, text, command, parameter):
             return
 
         elif index == "*":
+            changed = []
             for item in var.playlist:
-                item.add_tags(tags)
+                if item.add_tags(tags, save=False):
+                    changed.append(item.id)
                 log.info(f"cmd: add tags {', '.join(tags)} to song {item.format_debug_string()}")
+            var.cache.save_many(changed)
             bot.send_msg(tr("added_tags_to_all", tags=", ".join(tags)), text)
             return
 
@@ -663,16 +685,21 @@ def cmd_remove_tag(bot, user, text, command, parameter):
                 return
 
         elif index == "*":
+            changed = []
             if tags[0] != "*":
                 for item in var.playlist:
-                    item.remove_tags(tags)
+                    if item.remove_tags(tags, save=False):
+                        changed.append(item.id)
                     log.info(f"cmd: remove tags {', '.join(tags)} from song {item.format_debug_string()}")
+                var.cache.save_many(changed)
                 bot.send_msg(tr("removed_tags_from_all", tags=", ".join(tags)), text)
                 return
             else:
                 for item in var.playlist:
-                    item.clear_tags()
+                    if item.clear_tags(save=False):
+                        changed.append(item.id)
                     log.info(f"cmd: clear tags from song {item.format_debug_string()}")
+                var.cache.save_many(changed)
                 bot.send_msg(tr("cleared_tags_from_all"), text)
                 return
 
@@ -727,10 +754,11 @@ def cmd_search_library(bot, user, text, command, parameter):
         if kw:
             keywords.append(kw)
 
-    music_dicts = var.music_db.query_music_by_keywords(keywords)
+    # the best matches first, one more than a page to know if some were left out
+    music_dicts = var.music_db.query_music_by_keywords(keywords, limit=ITEMS_PER_PAGE + 1)
     if music_dicts:
         items = dicts_to_items(music_dicts)
-        song_shortlist = music_dicts
+        song_shortlist = music_dicts[:ITEMS_PER_PAGE]
 
         if len(items) == 1:
             music_wrapper = get_cached_wrapper(items[0], user)
@@ -826,3 +854,33 @@ def cmd_refresh_cache(bot, user, text, command, parameter):
         bot.send_msg(tr('cache_refreshed'), text)
     else:
         bot.mumble.users[text.actor].send_text_message(tr('not_admin'))
+
+
+def cmd_telemetry(bot, user, text, command, parameter):
+    global log
+
+    if parameter == "reset":
+        bot.telemetry.reset()
+        bot.buffering.reset_stats()
+        for chain in bot.dsp_chains.values():
+            chain.reset_stats()
+        bot.send_msg("Telemetry reset.", text)
+        return
+
+    lines = ["<b>Telemetry</b>"] + bot.telemetry.report() + bot.buffering.report()
+    lines.append(f"scheduler: {bot.scheduler.wakeups} wakeups, {bot.scheduler.timeouts} timeouts")
+    if bot.decoder and hasattr(bot.decoder, 'buffer'):
+        stats = bot.decoder.buffer.stats()
+        lines.append(f"decoder buffer: {stats['fill_level'] * 100:.0f}% full, {stats['underruns']} underruns, "
+                     f"{stats['overruns']} overruns")
+    if bot.pcm_cache:
+        stats = bot.pcm_cache.stats()
+        lines.append(f"pcm cache: {stats['songs']} songs, {stats['size'] // 1048576} MB, "
+                     f"{stats['hits']} hits, {stats['misses']} misses")
+    stats = hub.stats()
+    if stats['streams']:
+        lines.append(f"shared streams: {stats['streams']}, {stats['subscribers']} subscribers")
+    for type, chain in bot.dsp_chains.items():
+        lines.append(f"dsp of {type}:")
+        lines += ["  " + line for line in chain.report()]
+    send_multi_lines(bot, lines, text)
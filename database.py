@@ -1,8 +1,10 @@
+import contextlib
 import os
 import re
 import sqlite3
 import json
 import datetime
+import threading
 import time
 import logging
 
@@ -36,18 +38,9 @@ class Condition:
             sql += f" LIMIT {self._limit}"
         if self._offset:
             sql += f" OFFSET {self._offset}"
-        if self.has_regex and conn:
-            conn.create_function("REGEXP", 2, self._regexp)
 
         return sql
 
-    @staticmethod
-    def _regexp(expr, item):
-        if not item:
-            return False
-        reg = re.compile(expr)
-        return reg.search(item) is not None
-
     def or_equal(self, column, equals_to, case_sensitive=True):
         if not case_sensitive:
             column = f"LOWER({column})"
@@ -128,6 +121,27 @@ class Condition:
 
         return self
 
+    def and_tag(self, tag):
+        # tagged with 'tag', whatever its case
+        if self._sql:
+            self._sql += " AND id IN (SELECT music_id FROM music_tags WHERE tag=?)"
+        else:
+            self._sql += "id IN (SELECT music_id FROM music_tags WHERE tag=?)"
+
+        self.filler.append(tag)
+
+        return self
+
+    def and_not_tag(self, tag):
+        if self._sql:
+            self._sql += " AND id NOT IN (SELECT music_id FROM music_tags WHERE tag=?)"
+        else:
+            self._sql += "id NOT IN (SELECT music_id FROM music_tags WHERE tag=?)"
+
+        self.filler.append(tag)
+
+        return self
+
     def or_sub_condition(self, sub_condition):
         if sub_condition.has_regex:
             self.has_regex = True
@@ -194,19 +208,143 @@ class Condition:
 
 
 SETTING_DB_VERSION = 2
-MUSIC_DB_VERSION = 4
+MUSIC_DB_VERSION = 7
+
+# keys of the dicts of insert_music that have a column of their own, the others go into metadata
+MUSIC_COLUMNS = ('id', 'type', 'title', 'tags', 'path', 'keywords')
+
+# ids in one query at most, well under the number of parameters sqlite accepts
+QUERY_CHUNK = 500
+
+
+def _regexp(expr, item):
+    if not item:
+        return False
+    return re.search(expr, item) is not None
+
+
+# The connections to a database in memory share its cache, whose tables are locked by the transaction of
+# a connection until it ends. A statement of another connection finding one locked fails at once, the
+# busy timeout doesn't apply: it is tried again every LOCKED_RETRY seconds, for LOCKED_TIMEOUT at most.
+LOCKED_RETRY = 0.002
+LOCKED_TIMEOUT = 5.0
+
+
+def _retry_locked(execute, *args):
+    deadline = time.monotonic() + LOCKED_TIMEOUT
+    while True:
+        try:
+            return execute(*args)
+        except sqlite3.OperationalError as e:
+            if not str(e).startswith(("database table is locked", "database schema is locked")) \
+                    or time.monotonic() > deadline:
+                raise
+        time.sleep(LOCKED_RETRY)
+
+
+class _SharedCacheCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        return _retry_locked(super().execute, *args)
+
+    def executemany(self, *args):
+        # a table is locked by the first row, nothing has been written when it fails
+        return _retry_locked(super().executemany, *args)
+
+
+class _SharedCacheConnection(sqlite3.Connection):
+    def cursor(self, factory=_SharedCacheCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class ConnectionPool:
+    # One long-lived connection to a database per thread. A connection can't be used by two threads at
+    # the same time, and opening one costs more than most queries of the bot (the settings are read at
+    # every chat message), so each thread keeps its own: REGEXP is registered once, when it is opened,
+    # and sqlite keeps the statements it prepared on it. The connections of threads that are gone are
+    # closed when a new one is opened, all of them by close().
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.connections = {}  # thread -> connection
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def get(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.lock:
+                for thread in [thread for thread in self.connections if not thread.is_alive()]:
+                    self.connections.pop(thread).close()
+                self.connections[threading.current_thread()] = conn
+                self.opened += 1
+        return conn
+
+    def _connect(self):
+        if self.db_path == ":memory:":
+            # every connection of the pool must see the same database, which lives as long as one of them
+            conn = sqlite3.connect(f"file:botamusique-{id(self)}?mode=memory&cache=shared", uri=True,
+                                   check_same_thread=False, factory=_SharedCacheConnection)
+        else:
+            # check_same_thread: close() closes the connections of every thread
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # readers don't wait for a writer, and a commit only syncs the log to the disk
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function("REGEXP", 2, _regexp)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # The writes of this thread inside the block are one transaction, committed when it ends and
+        # rolled back if it raises, so that a failed write doesn't keep the lock of the database. A
+        # transaction inside a transaction joins it: writes are batched by wrapping them into one. The
+        # other threads wait for the lock of the database while it is open: nothing slow belongs in it.
+        if getattr(self.local, 'transaction', False):
+            yield
+            return
+
+        conn = self.get()
+        self.local.transaction = True
+        try:
+            yield
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self.local.transaction = False
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
 
 
 class SettingsDatabase:
     def __init__(self, db_path):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+
+    def close(self):
+        self.pool.close()
 
     def get(self, section, option, **kwargs):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         result = cursor.execute("SELECT value FROM botamusique WHERE section=? AND option=?",
                                 (section, option)).fetchall()
-        conn.close()
 
         if len(result) > 0:
             return result[0][0]
@@ -226,43 +364,38 @@ class SettingsDatabase:
         return int(self.get(section, option, **kwargs))
 
     def set(self, section, option, value):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO botamusique (section, option, value) "
-                       "VALUES (?, ?, ?)", (section, option, value))
-        conn.commit()
-        conn.close()
+        with self.pool.transaction():
+            conn = self.pool.get()
+            cursor = conn.cursor()
+            cursor.execute("INSERT OR REPLACE INTO botamusique (section, option, value) "
+                           "VALUES (?, ?, ?)", (section, option, value))
 
     def has_option(self, section, option):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         result = cursor.execute("SELECT value FROM botamusique WHERE section=? AND option=?",
                                 (section, option)).fetchall()
-        conn.close()
         if len(result) > 0:
             return True
         else:
             return False
 
     def remove_option(self, section, option):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM botamusique WHERE section=? AND option=?", (section, option))
-        conn.commit()
-        conn.close()
+        with self.pool.transaction():
+            conn = self.pool.get()
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM botamusique WHERE section=? AND option=?", (section, option))
 
     def remove_section(self, section):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM botamusique WHERE section=?", (section,))
-        conn.commit()
-        conn.close()
+        with self.pool.transaction():
+            conn = self.pool.get()
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM botamusique WHERE section=?", (section,))
 
     def items(self, section):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         results = cursor.execute("SELECT option, value FROM botamusique WHERE section=?", (section,)).fetchall()
-        conn.close()
 
         if len(results) > 0:
             return list(map(lambda v: (v[0], v[1]), results))
@@ -270,78 +403,95 @@ class SettingsDatabase:
             return []
 
     def drop_table(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         cursor.execute("DROP TABLE botamusique")
-        conn.close()
 
 
 class MusicDatabase:
     def __init__(self, db_path):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+        self.tables = None  # the tables of the database, None until checked
+
+    def close(self):
+        self.pool.close()
+
+    def batch(self):
+        # the writes inside the block are committed together, see ConnectionPool.transaction()
+        return self.pool.transaction()
+
+    def has_table(self, table, conn):
+        # music_fts and music_tags don't exist during the migrations from the versions before them
+        if self.tables is None:
+            self.tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        return table in self.tables
 
     def insert_music(self, music_dict, _conn=None):
-        conn = sqlite3.connect(self.db_path) if _conn is None else _conn
+        self.insert_music_many([music_dict], _conn)
+
+    def insert_music_many(self, music_dicts, _conn=None):
+        # Insert the items of music_dicts, or update the ones already there, in one transaction. The dicts
+        # are left as they are. With _conn, the transaction is the caller's.
+        if _conn is None:
+            with self.pool.transaction():
+                self.insert_music_many(music_dicts, self.pool.get())
+            return
+
+        conn = _conn
         cursor = conn.cursor()
 
-        id = music_dict['id']
-        title = music_dict['title']
-        type = music_dict['type']
-        path = music_dict['path'] if 'path' in music_dict else ''
-        keywords = music_dict['keywords']
-
-        tags_list = list(dict.fromkeys(music_dict['tags']))
-        tags = ''
-        if tags_list:
-            tags = ",".join(tags_list) + ","
-
-        del music_dict['id']
-        del music_dict['title']
-        del music_dict['type']
-        del music_dict['tags']
-        if 'path' in music_dict:
-            del music_dict['path']
-        del music_dict['keywords']
-
-        existed = cursor.execute("SELECT 1 FROM music WHERE id=?", (id,)).fetchall()
-        if len(existed) == 0:
-            cursor.execute(
-                "INSERT INTO music (id, type, title, metadata, tags, path, keywords) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (id,
-                 type,
-                 title,
-                 json.dumps(music_dict),
-                 tags,
-                 path,
-                 keywords))
-        else:
-            cursor.execute("UPDATE music SET type=:type, title=:title, metadata=:metadata, tags=:tags, "
-                           "path=:path, keywords=:keywords WHERE id=:id",
-                           {'id': id,
-                            'type': type,
-                            'title': title,
-                            'metadata': json.dumps(music_dict),
-                            'tags': tags,
-                            'path': path,
-                            'keywords': keywords})
-
-        if not _conn:
-            conn.commit()
-            conn.close()
+        rows = {}  # id -> (row of music, tags, artist), the last one of an id wins
+        for music_dict in music_dicts:
+            tags_list = [tag for tag in dict.fromkeys(music_dict['tags']) if tag]
+            tags = ''
+            if tags_list:
+                tags = ",".join(tags_list) + ","
+            metadata = {key: value for key, value in music_dict.items() if key not in MUSIC_COLUMNS}
+
+            rows[music_dict['id']] = ((music_dict['id'], music_dict['type'], music_dict['title'], json.dumps(metadata),
+                                       tags, music_dict.get('path', ''), music_dict['keywords']),
+                                      tags_list, metadata.get('artist', ''))
+        if not rows:
+            return
+
+        # an update keeps the number of the row, which music_fts refers to
+        cursor.executemany("INSERT INTO music (id, type, title, metadata, tags, path, keywords) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                           "ON CONFLICT (id) DO UPDATE SET type=excluded.type, title=excluded.title, "
+                           "metadata=excluded.metadata, tags=excluded.tags, path=excluded.path, "
+                           "keywords=excluded.keywords",
+                           [row for row, _, _ in rows.values()])
+
+        if self.has_table('music_fts', conn):
+            # an INSERT ... SELECT into music_fts is several times slower than one with the rowid. Since
+            # version 7 the rowid of music is its number column, which VACUUM doesn't change.
+            ids = list(rows)
+            rowids = {}
+            for start in range(0, len(ids), QUERY_CHUNK):
+                chunk = ids[start:start + QUERY_CHUNK]
+                rowids.update(cursor.execute("SELECT id, rowid FROM music WHERE id IN (%s)"
+                                             % ",".join("?" * len(chunk)), chunk).fetchall())
+            cursor.executemany("INSERT OR REPLACE INTO music_fts (rowid, title, artist, path, keywords) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               [(rowids[id], row[2], artist, row[5], row[6]) for id, (row, _, artist) in rows.items()])
+
+        if self.has_table('music_tags', conn):
+            cursor.executemany("DELETE FROM music_tags WHERE music_id=?", [(id,) for id in rows])
+            cursor.executemany("INSERT OR IGNORE INTO music_tags (music_id, tag) VALUES (?, ?)",
+                               [(id, tag) for id, (_, tags_list, _) in rows.items() for tag in tags_list])
 
     def query_music_ids(self, condition: Condition):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         results = cursor.execute("SELECT id FROM music WHERE id != 'info' AND %s" %
                                  condition.sql(conn), condition.filler).fetchall()
-        conn.close()
         return list(map(lambda i: i[0], results))
 
     def query_all_paths(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         results = cursor.execute("SELECT path FROM music WHERE id != 'info' AND type = 'file'").fetchall()
-        conn.close()
         paths = []
         for result in results:
             if result and result[0]:
@@ -350,49 +500,43 @@ class MusicDatabase:
         return paths
 
     def query_all_tags(self):
-        conn = sqlite3.connect(self.db_path)
+        # the most used first
+        return list(self.query_tag_counts())
+
+    def query_tag_counts(self):
+        conn = self.pool.get()
         cursor = conn.cursor()
-        results = cursor.execute("SELECT tags FROM music WHERE id != 'info'").fetchall()
-        tags = []
-        for result in results:
-            for tag in result[0].strip(",").split(","):
-                if tag and tag not in tags:
-                    tags.append(tag)
-        conn.close()
-        return tags
+        results = cursor.execute("SELECT tag, COUNT(*) FROM music_tags GROUP BY tag "
+                                 "ORDER BY COUNT(*) DESC, tag").fetchall()
+        return dict(results)
 
     def query_music_count(self, condition: Condition):
         filler = condition.filler
 
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         condition_str = condition.sql(conn)
         cursor = conn.cursor()
         results = cursor.execute("SELECT COUNT(*) FROM music "
                                  "WHERE id != 'info' AND %s" % condition_str, filler).fetchall()
-        conn.close()
 
         return results[0][0]
 
     def query_music(self, condition: Condition, _conn=None):
         filler = condition.filler
 
-        conn = sqlite3.connect(self.db_path) if _conn is None else _conn
+        conn = self.pool.get() if _conn is None else _conn
         condition_str = condition.sql(conn)
         cursor = conn.cursor()
         results = cursor.execute("SELECT id, type, title, metadata, tags, path, keywords FROM music "
                                  "WHERE id != 'info' AND %s" % condition_str, filler).fetchall()
-        if not _conn:
-            conn.close()
 
         return self._result_to_dict(results)
 
     def _query_music_by_plain_sql_cond(self, sql_cond, _conn=None):
-        conn = sqlite3.connect(self.db_path) if _conn is None else _conn
+        conn = self.pool.get() if _conn is None else _conn
         cursor = conn.cursor()
         results = cursor.execute("SELECT id, type, title, metadata, tags, path, keywords FROM music "
                                  "WHERE id != 'info' AND %s" % sql_cond).fetchall()
-        if not _conn:
-            conn.close()
 
         return self._result_to_dict(results)
 
@@ -403,41 +547,61 @@ class MusicDatabase:
         else:
             return None
 
-    def query_music_by_keywords(self, keywords, _conn=None):
-        condition = Condition()
+    def query_music_by_keywords(self, keywords, _conn=None, limit=None):
+        conn = self.pool.get() if _conn is None else _conn
+        if not self.has_table('music_fts', conn):
+            condition = Condition()
 
-        for keyword in keywords:
-            condition.and_like("title", f"%{keyword}%", case_sensitive=False)
+            for keyword in keywords:
+                condition.and_like("title", f"%{keyword}%", case_sensitive=False)
+            if limit:
+                condition.limit(limit)
 
-        return self.query_music(condition, _conn)
+            return self.query_music(condition, _conn)
+
+        # every keyword starts a word of the title, artist, path or keywords, the best matches first
+        match = " ".join('"%s"*' % keyword.replace('"', '""') for keyword in keywords)
+        cursor = conn.cursor()
+        results = cursor.execute("SELECT music.id, music.type, music.title, music.metadata, music.tags, music.path, "
+                                 "music.keywords FROM music_fts JOIN music ON music.rowid = music_fts.rowid "
+                                 "WHERE music_fts MATCH ? ORDER BY bm25(music_fts, 4.0, 2.0, 1.0, 1.0) LIMIT ?",
+                                 (match, limit or -1)).fetchall()
+
+        return self._result_to_dict(results)
 
     def query_music_by_tags(self, tags, _conn=None):
         condition = Condition()
 
         for tag in tags:
-            condition.and_like("tags", f"%{tag},%", case_sensitive=False)
+            condition.and_tag(tag)
 
         return self.query_music(condition, _conn)
 
     def manage_special_tags(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE music SET tags=REPLACE(tags, 'recent added,', '') WHERE tags LIKE '%recent added,%' "
-                       "AND create_at <= DATETIME('now', '-1 day') AND id != 'info'")
-        cursor.execute("UPDATE music SET tags=tags||'recent added,' WHERE tags NOT LIKE '%recent added,%' "
-                       "AND create_at > DATETIME('now', '-1 day') AND id != 'info'")
-        conn.commit()
-        conn.close()
+        with self.pool.transaction():
+            conn = self.pool.get()
+            cursor = conn.cursor()
+            # music_tags finds the tag in any case, which it may have been written in by a user
+            rows = cursor.execute("SELECT id, tags FROM music "
+                                  "WHERE id IN (SELECT music_id FROM music_tags WHERE tag='recent added') "
+                                  "AND create_at <= DATETIME('now', '-1 day')").fetchall()
+            cursor.executemany("UPDATE music SET tags=? WHERE id=?",
+                               [("".join(tag + "," for tag in tags.split(",") if tag and tag.lower() != 'recent added'),
+                                 id) for id, tags in rows])
+            cursor.execute("DELETE FROM music_tags WHERE tag='recent added' "
+                           "AND music_id IN (SELECT id FROM music WHERE create_at <= DATETIME('now', '-1 day'))")
+            cursor.execute("UPDATE music SET tags=tags||'recent added,' "
+                           "WHERE id NOT IN (SELECT music_id FROM music_tags WHERE tag='recent added') "
+                           "AND create_at > DATETIME('now', '-1 day') AND id != 'info'")
+            cursor.execute("INSERT OR IGNORE INTO music_tags (music_id, tag) SELECT id, 'recent added' FROM music "
+                           "WHERE create_at > DATETIME('now', '-1 day') AND id != 'info'")
 
     def query_tags(self, condition: Condition):
-        # TODO: Can we keep a index of tags?
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         results = cursor.execute("SELECT id, tags FROM music "
                                  "WHERE id != 'info' AND %s" % condition.sql(conn), condition.filler).fetchall()
 
-        conn.close()
-
         lookup = {}
         if len(results) > 0:
             for result in results:
@@ -448,7 +612,7 @@ class MusicDatabase:
         return lookup
 
     def query_random_music(self, count, condition: Condition = None):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         results = []
 
@@ -456,10 +620,9 @@ class MusicDatabase:
             condition = Condition().and_not_sub_condition(Condition().and_equal('id', 'info'))
 
         results = cursor.execute("SELECT id, type, title, metadata, tags, path, keywords FROM music "
-                                 "WHERE id IN (SELECT id FROM music WHERE %s ORDER BY RANDOM() LIMIT ?) "
-                                 "ORDER BY RANDOM()"
+                                 "WHERE id IN (SELECT id FROM music WHERE id != 'info' AND %s "
+                                 "ORDER BY RANDOM() LIMIT ?) ORDER BY RANDOM()"
                                  % condition.sql(conn), condition.filler + [count]).fetchall()
-        conn.close()
 
         return self._result_to_dict(results)
 
@@ -482,18 +645,25 @@ class MusicDatabase:
             return []
 
     def delete_music(self, condition: Condition):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM music "
-                       "WHERE %s" % condition.sql(conn), condition.filler)
-        conn.commit()
-        conn.close()
+        with self.pool.transaction():
+            conn = self.pool.get()
+            cursor = conn.cursor()
+            if self.has_table('music_fts', conn):
+                cursor.execute("DELETE FROM music_fts WHERE rowid IN (SELECT rowid FROM music "
+                               "WHERE %s)" % condition.sql(conn), condition.filler)
+            if self.has_table('music_tags', conn):
+                cursor.execute("DELETE FROM music_tags WHERE music_id IN (SELECT id FROM music "
+                               "WHERE %s)" % condition.sql(conn), condition.filler)
+            cursor.execute("DELETE FROM music "
+                           "WHERE %s" % condition.sql(conn), condition.filler)
 
     def drop_table(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.pool.get()
         cursor = conn.cursor()
         cursor.execute("DROP TABLE music")
-        conn.close()
+        cursor.execute("DROP TABLE IF EXISTS music_fts")
+        cursor.execute("DROP TABLE IF EXISTS music_tags")
+        self.tables = None
 
 
 class DatabaseMigration:
@@ -505,7 +675,10 @@ class DatabaseMigration:
         self.music_table_migrate_func = {0: self.music_table_migrate_from_0_to_1,
                                          1: self.music_table_migrate_from_1_to_2,
                                          2: self.music_table_migrate_from_2_to_4,
-                                         3: self.music_table_migrate_from_2_to_4
+                                         3: self.music_table_migrate_from_2_to_4,
+                                         4: self.music_table_migrate_from_4_to_5,
+                                         5: self.music_table_migrate_from_5_to_6,
+                                         6: self.music_table_migrate_from_6_to_7
                                          }
 
 
@@ -514,7 +687,7 @@ class DatabaseMigration:
         self.music_database_migrate()
 
     def settings_database_migrate(self):
-        conn = sqlite3.connect(self.settings_db.db_path)
+        conn = self.settings_db.pool.get()
         cursor = conn.cursor()
         if self.has_table('botamusique', conn):
             current_version = 0
@@ -524,7 +697,6 @@ class DatabaseMigration:
                 current_version = int(ver[0])
 
             if current_version == SETTING_DB_VERSION:
-                conn.close()
                 return
             else:
                 log.info(
@@ -542,10 +714,9 @@ class DatabaseMigration:
             self.create_settings_table_version_2(conn)
 
         conn.commit()
-        conn.close()
 
     def music_database_migrate(self):
-        conn = sqlite3.connect(self.music_db.db_path)
+        conn = self.music_db.pool.get()
         cursor = conn.cursor()
         if self.has_table('music', conn):
             current_version = 0
@@ -554,7 +725,6 @@ class DatabaseMigration:
                 current_version = int(ver[0])
 
             if current_version == MUSIC_DB_VERSION:
-                conn.close()
                 return
             else:
                 log.info(f"database: migrating from music table version {current_version} to {MUSIC_DB_VERSION}...")
@@ -568,10 +738,12 @@ class DatabaseMigration:
 
         else:
             log.info(f"database: no music table found. Creating music table version {MUSIC_DB_VERSION}.")
-            self.create_music_table_version_4(conn)
+            self.create_music_table_version_7(conn)
+            self.create_music_fts_table(conn)
+            self.create_music_tags_table(conn)
 
         conn.commit()
-        conn.close()
+        self.music_db.tables = None
 
     def has_table(self, table, conn):
         cursor = conn.cursor()
@@ -611,8 +783,57 @@ class DatabaseMigration:
 
         conn.commit()
 
-    def create_music_table_version_4(self, conn):
-        self.create_music_table_version_1(conn)
+    def create_music_table_version_7(self, conn):
+        cursor = conn.cursor()
+
+        # number is the rowid, given explicitly so that VACUUM keeps it: music_fts refers to it
+        cursor.execute("CREATE TABLE music ("
+                       "number INTEGER PRIMARY KEY, "
+                       "id TEXT UNIQUE, "
+                       "type TEXT, "
+                       "title TEXT, "
+                       "keywords TEXT, "
+                       "metadata TEXT, "
+                       "tags TEXT, "
+                       "path TEXT, "
+                       "create_at DATETIME DEFAULT CURRENT_TIMESTAMP"
+                       ")")
+        cursor.execute("INSERT INTO music (id, title) "
+                       "VALUES ('info', ?)", (MUSIC_DB_VERSION,))
+
+        conn.commit()
+
+    def create_music_tags_table(self, conn):
+        # The tags of music.tags, one per row, to find the items with a tag without reading every row of music
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE music_tags ("
+                       "music_id TEXT, "
+                       "tag TEXT COLLATE NOCASE, "
+                       "UNIQUE(music_id, tag))")
+        cursor.execute("CREATE INDEX music_tags_tag ON music_tags (tag, music_id)")
+
+        rows = cursor.execute("SELECT id, tags FROM music WHERE id != 'info' AND tags != ''").fetchall()
+        cursor.executemany("INSERT OR IGNORE INTO music_tags (music_id, tag) VALUES (?, ?)",
+                           ((id, tag) for id, tags in rows for tag in tags.split(",") if tag))
+        conn.commit()
+
+    def create_music_fts_table(self, conn):
+        # The full-text index of the library for !search, its rows have the rowid of the row of music they index,
+        # its number column since version 7.
+        # Without FTS5 in this sqlite, the search looks for the keywords in the titles, which is much slower.
+        cursor = conn.cursor()
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE music_fts USING fts5("
+                           "title, artist, path, keywords, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        except sqlite3.OperationalError as e:
+            log.warning(f"database: unable to create the full-text index of the library: {e}")
+            return
+
+        rows = cursor.execute("SELECT rowid, title, metadata, path, keywords FROM music WHERE id != 'info'").fetchall()
+        cursor.executemany("INSERT INTO music_fts (rowid, title, artist, path, keywords) VALUES (?, ?, ?, ?, ?)",
+                           ((rowid, title, json.loads(metadata or '{}').get('artist', ''), path, keywords)
+                            for rowid, title, metadata, path, keywords in rows))
+        conn.commit()
 
     def settings_table_migrate_from_0_to_1(self, conn):
         cursor = conn.cursor()
@@ -669,7 +890,7 @@ class DatabaseMigration:
                     tags.append(tag)
             item['tags'] = tags
 
-            self.music_db.insert_music(item)
+        self.music_db.insert_music_many(items_to_update, conn)
         conn.commit()
 
         return 2  # return new version number
@@ -682,7 +903,36 @@ class DatabaseMigration:
             if item['type'] == 'url' or item['type'] == "url_from_playlist":
                 item['duration'] = item['duration'] * 60
 
-            self.music_db.insert_music(item)
+        self.music_db.insert_music_many(items_to_update, conn)
         conn.commit()
 
         return 4  # return new version number
+
+    def music_table_migrate_from_4_to_5(self, conn):
+        self.create_music_fts_table(conn)
+
+        return 5  # return new version number
+
+    def music_table_migrate_from_5_to_6(self, conn):
+        self.create_music_tags_table(conn)
+
+        return 6  # return new version number
+
+    def music_table_migrate_from_6_to_7(self, conn):
+        # The rowids of music were implicit, and a VACUUM may have renumbered them since music_fts was filled:
+        # music_fts is indexed again.
+        cursor = conn.cursor()
+        cursor.execute("ALTER TABLE music RENAME TO music_old")
+        cursor.execute("DROP TABLE IF EXISTS music_fts")
+        conn.commit()
+
+        self.create_music_table_version_7(conn)
+
+        cursor.execute("INSERT INTO music (id, type, title, keywords, metadata, tags, path, create_at) "
+                       "SELECT id, type, title, keywords, metadata, tags, path, create_at FROM music_old "
+                       "WHERE id != 'info' ORDER BY rowid")
+        cursor.execute("DROP TABLE music_old")
+        self.create_music_fts_table(conn)
+        conn.commit()
+
+        return 7  # return new version number
@@ -0,0 +1,153 @@
+import logging
+import os
+import queue
+import re
+import subprocess as sp
+import threading
+
+import variables as var
+
+# Bumped when the analysis measures something new, so that files analyzed by an older version
+# are analyzed again at the next scan.
+# 2: leading and trailing silence
+ANALYSIS_VERSION = 2
+
+# Silence is anything quieter than SILENCE_THRESHOLD dBFS for at least SILENCE_DURATION seconds
+SILENCE_THRESHOLD = -60
+SILENCE_DURATION = 0.5
+
+log = logging.getLogger("bot")
+
+
+def measure(path):
+    # In a single pass of ffmpeg over the file: the integrated loudness of the whole file in LUFS
+    # (EBU R128), None if ffmpeg can't tell, and where the leading silence ends and the trailing
+    # silence starts, in seconds, 0 and None if there is none.
+    command = ("ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-v", "info", "-i", path, "-vn",
+               "-af", f"silencedetect=noise={SILENCE_THRESHOLD}dB:d={SILENCE_DURATION},ebur128=framelog=verbose",
+               "-f", "null", "-")
+    process = sp.Popen(command, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        return None, 0, None
+    stderr = stderr.decode("utf-8", "ignore")
+
+    # the summary is printed at the end, after the loudness of every frame
+    loudness = None
+    for match in re.finditer(r"I:\s+(-?\d+(?:\.\d+)?) LUFS", stderr):
+        loudness = float(match[1])
+
+    return (loudness,) + find_trim(stderr)
+
+
+def find_trim(stderr):
+    # (end of the leading silence, start of the trailing silence) from the output of silencedetect
+    silences = []  # [start, end or None]
+    for match in re.finditer(r"silence_(start|end): (-?\d+(?:\.\d+)?)", stderr):
+        if match[1] == "start":
+            silences.append([float(match[2]), None])
+        elif silences:
+            silences[-1][1] = float(match[2])
+    if not silences:
+        return 0, None
+
+    # end of the file: the time of the last frame measured by ebur128, or of ffmpeg's last report
+    end = 0
+    for match in re.finditer(r"\bt: (\d+(?:\.\d+)?)", stderr):
+        end = float(match[1])
+    for match in re.finditer(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)", stderr):
+        end = max(end, int(match[1]) * 3600 + int(match[2]) * 60 + float(match[3]))
+
+    start, first_end = silences[0]
+    if start <= 0.01 and first_end is None:
+        return 0, None  # silent from the beginning to the end, leave it alone
+    trim_start = first_end if start <= 0.01 else 0
+
+    # older ffmpeg don't print the end of a silence that lasts until the end of the file
+    last_start, last_end = silences[-1]
+    trim_end = None
+    if (last_end is None or last_end >= end - 0.1) and last_start > trim_start:
+        trim_end = last_start
+
+    return trim_start, trim_end
+
+
+def loudness_to_gain(loudness, target, max_gain):
+    # Linear gain bringing loudness to target, at most max_gain dB louder
+    if loudness is None:
+        return 1.0
+    return 10 ** (min(target - loudness, max_gain) / 20)
+
+
+class LibraryAnalyzer:
+    # Measures the files of the library in background threads, and saves the results into their
+    # metadata. Every file is analyzed once: build_dir_cache only submits new or modified files,
+    # and files analyzed by an older ANALYSIS_VERSION.
+
+    def __init__(self, db, workers=2):
+        self.db = db
+        self.workers = max(1, workers)
+        self.queue = queue.Queue()
+        self.pending = set()  # ids queued or being analyzed, not to submit twice
+        self.lock = threading.Lock()
+        self.threads = []
+
+        self.analyzed = 0
+        self.failed = 0
+
+    def submit(self, id, path):
+        with self.lock:
+            if id in self.pending:
+                return
+            self.pending.add(id)
+
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name="Analysis", daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+        self.queue.put((id, path))
+
+    def qsize(self):
+        return len(self.pending)
+
+    def _worker(self):
+        while True:
+            id, path = self.queue.get()
+            try:
+                self._analyze(id, path)
+            except Exception as e:
+                self.failed += 1
+                log.error(f"library: analysis of {path} failed: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(id)
+
+    def _analyze(self, id, path):
+        mtime = os.path.getmtime(path)
+        loudness, trim_start, trim_end = measure(path)
+        if loudness is None:
+            self.failed += 1
+            log.debug(f"library: unable to measure the loudness of {path}")
+
+        # read the row again right before writing, the file may have been tagged in the meantime
+        music_dict = self.db.query_music_by_id(id)
+        if not music_dict:
+            return
+        music_dict['loudness'] = loudness
+        music_dict['trim_start'] = trim_start
+        music_dict['trim_end'] = trim_end
+        music_dict['mtime'] = mtime
+        music_dict['analysis_version'] = ANALYSIS_VERSION
+        self.db.insert_music(music_dict)
+
+        item = var.cache.get(id) if var.cache is not None else None
+        if item:
+            item.loudness = loudness
+            item.trim_start = trim_start
+            item.trim_end = trim_end
+            item.mtime = mtime
+            item.analysis_version = ANALYSIS_VERSION
+
+        self.analyzed += 1
+        log.debug(f"library: analyzed {path}: {loudness} LUFS, sound from {trim_start} to {trim_end}")
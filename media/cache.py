@@ -3,14 +3,19 @@ import os
 
 import json
 import threading
+import time
 
 from media.item import item_builders, item_id_generators, dict_to_item
+from media.analysis import LibraryAnalyzer, ANALYSIS_VERSION
 import media.file
 import media.radio
 from database import MusicDatabase, Condition
 import variables as var
 import util
 
+# build_dir_cache saves the new and modified files into the database by that many at once
+SCAN_CHUNK = 500
+
 
 class MusicCache(dict):
     def __init__(self, db: MusicDatabase):
@@ -19,6 +24,11 @@ class MusicCache(dict):
         self.log = logging.getLogger("bot")
         self.dir_lock = threading.Lock()
 
+        self.analyzer = None
+        if var.config.getboolean('bot', 'loudness_normalization', fallback=False) \
+                or var.config.getboolean('bot', 'silence_trimming', fallback=False):
+            self.analyzer = LibraryAnalyzer(db, var.config.getint('bot', 'analysis_workers', fallback=2))
+
     def get_item_by_id(self, id):
         if id in self:
             return self[id]
@@ -80,6 +90,14 @@ class MusicCache(dict):
         self.db.insert_music(self[id].to_dict())
         self.db.manage_special_tags()
 
+    def save_many(self, ids):
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return
+        self.log.debug(f"library: save {len(ids)} items into database")
+        self.db.insert_music_many(self[id].to_dict() for id in ids)
+        self.db.manage_special_tags()
+
     def free_and_delete(self, id):
         item = self.get_item_by_id(id)
         if item:
@@ -105,27 +123,70 @@ class MusicCache(dict):
     def build_dir_cache(self):
         self.dir_lock.acquire()
         self.log.info("library: rebuild directory cache")
+        start = time.time()
         files = util.get_recursive_file_list_sorted(var.music_folder)
+        new_files = set(files)
+        to_analyze = []
+        to_save = []
 
-        # remove deleted files
+        # Reading the tags and the duration of the files takes most of the scan: it is done outside of any
+        # transaction, and the items read are written SCAN_CHUNK at a time, in one short transaction.
         results = self.db.query_music(Condition().or_equal('type', 'file'))
+        missed = []
         for result in results:
-            if result['path'] not in files:
+            if result['path'] not in new_files:
                 self.log.debug("library: music file missed: %s, delete from library." % result['path'])
-                self.db.delete_music(Condition().and_equal('id', result['id']))
-            else:
-                files.remove(result['path'])
-
+                missed.append(result['id'])
+                continue
+
+            new_files.remove(result['path'])
+            uri = var.music_folder + result['path']
+            mtime = os.path.getmtime(uri)
+            if not result.get('mtime'):
+                # saved without its mtime: take the one of the file now, to notice when it changes from now on
+                result['mtime'] = mtime
+                to_save.append(result)
+            if result['mtime'] != mtime:
+                item = item_builders['file'](path=result['path'])
+                item.add_tags(result['tags'])
+                self.log.debug("library: music file modified, reload it: %s" % item.format_debug_string())
+                to_save.append(item.to_dict())
+                if item.id in self:
+                    self[item.id] = item
+                to_analyze.append((item.id, uri))
+            elif result.get('analysis_version', 0) < ANALYSIS_VERSION:
+                to_analyze.append((result['id'], uri))
+
+        with self.db.batch():
+            for id in missed:
+                self.db.delete_music(Condition().and_equal('id', id))
+
+        # what is left in new_files isn't in the library yet
         for file in files:
-            results = self.db.query_music(Condition().and_equal('path', file))
-            if not results:
-                item = item_builders['file'](path=file)
-                self.log.debug("library: music save into database: %s" % item.format_debug_string())
-                self.db.insert_music(item.to_dict())
-
-        self.db.manage_special_tags()
+            if file not in new_files:
+                continue
+            if len(to_save) >= SCAN_CHUNK:
+                self.db.insert_music_many(to_save)
+                to_save = []
+            item = item_builders['file'](path=file)
+            self.log.debug("library: music save into database: %s" % item.format_debug_string())
+            to_save.append(item.to_dict())
+            to_analyze.append((item.id, item.uri()))
+
+        with self.db.batch():
+            self.db.insert_music_many(to_save)
+            self.db.manage_special_tags()
         self.dir_lock.release()
 
+        duration = time.time() - start
+        self.log.info(f"library: {len(files)} files scanned in {duration:.1f} s "
+                      f"({len(files) / duration if duration else 0:.0f} files/s), {len(new_files)} new")
+
+        if self.analyzer and to_analyze:
+            self.log.info(f"library: {len(to_analyze)} files to analyze")
+            for id, uri in to_analyze:
+                self.analyzer.submit(id, uri)
+
 
 class CachedItemWrapper:
     def __init__(self, lib, id, type, user):
@@ -164,23 +225,26 @@ class CachedItemWrapper:
     def uri(self):
         return self.item().uri()
 
-    def add_tags(self, tags):
+    def add_tags(self, tags, save=True):
         self.item().add_tags(tags)
-        if self.item().version > self.version:
-            self.version = self.item().version
-            self.lib.save(self.id)
+        return self._changed(save)
 
-    def remove_tags(self, tags):
+    def remove_tags(self, tags, save=True):
         self.item().remove_tags(tags)
-        if self.item().version > self.version:
-            self.version = self.item().version
-            self.lib.save(self.id)
+        return self._changed(save)
 
-    def clear_tags(self):
+    def clear_tags(self, save=True):
         self.item().clear_tags()
+        return self._changed(save)
+
+    def _changed(self, save):
+        # Whether the item changed. Without 'save', the caller saves it, with lib.save_many() for many items.
         if self.item().version > self.version:
             self.version = self.item().version
-            self.lib.save(self.id)
+            if save:
+                self.lib.save(self.id)
+            return True
+        return False
 
     def is_ready(self):
         return self.item().is_ready()
@@ -16,6 +16,10 @@ type : file
     artist
     duration
     user
+    mtime
+    loudness
+    trim_start
+    trim_end
 '''
 
 
@@ -45,14 +49,20 @@ class FileItem(BaseItem):
             self.artist = ""
             self.album = ""
             self.id = hashlib.md5(path.encode()).hexdigest()
+            self.mtime = 0
+            self.analysis_version = 0  # media.analysis.ANALYSIS_VERSION of the last analysis
             if os.path.exists(self.uri()):
                 self._get_info_from_tag()
                 self.ready = "yes"
                 self.duration = util.get_media_duration(self.uri())
+                self.mtime = os.path.getmtime(self.uri())
             self.keywords = self.title + " " + self.artist
         else:
             super().__init__(from_dict)
             self.artist = from_dict['artist']
+            self.album = from_dict.get('album', "")
+            self.mtime = from_dict.get('mtime', 0)
+            self.analysis_version = from_dict.get('analysis_version', 0)
             try:
                 self.validate()
             except ValidationFailedError:
@@ -133,6 +143,8 @@ class FileItem(BaseItem):
         dict['title'] = self.title
         dict['artist'] = self.artist
         dict['album'] = self.album
+        dict['mtime'] = self.mtime
+        dict['analysis_version'] = self.analysis_version
         return dict
 
     def format_debug_string(self):
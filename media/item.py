@@ -51,6 +51,9 @@ class BaseItem:
         self.tags = []
         self.keywords = ""
         self.duration = 0
+        self.loudness = None  # integrated loudness in LUFS, measured by media.analysis
+        self.trim_start = 0  # seconds of silence at the beginning, measured by media.analysis
+        self.trim_end = None  # where the silence at the end starts, None if there is none
         self.version = 0  # if version increase, wrapper will re-save this item
 
         if from_dict is None:
@@ -64,6 +67,9 @@ class BaseItem:
             self.path = from_dict['path']
             self.keywords = from_dict['keywords']
             self.duration = from_dict['duration']
+            self.loudness = from_dict.get('loudness')
+            self.trim_start = from_dict.get('trim_start', 0)
+            self.trim_end = from_dict.get('trim_end')
 
     def is_ready(self):
         return True if self.ready == "yes" else False
@@ -120,4 +126,7 @@ class BaseItem:
                 "path": self.path,
                 "tags": self.tags,
                 "keywords": self.keywords,
-                "duration": self.duration}
+                "duration": self.duration,
+                "loudness": self.loudness,
+                "trim_start": self.trim_start,
+                "trim_end": self.trim_end}
@@ -46,6 +46,17 @@ class BasePlaylist(list):
         self.log = logging.getLogger("bot")
         self.validating_thread_lock = threading.Lock()
 
+    @property
+    def version(self):
+        return self._version
+
+    @version.setter
+    def version(self, value):
+        self._version = value
+        # every change of the playlist may be something the bot is waiting for
+        if var.bot:
+            var.bot.wake("playlist")
+
     def is_empty(self):
         return True if len(self) == 0 else False
 
@@ -224,6 +235,8 @@ class BasePlaylist(list):
         self.validating_thread_lock.acquire()
         while len(self.pending_items) > 0:
             item = self.pending_items.pop()
+            if item.id not in var.cache:
+                continue  # already dropped, e.g. ffmpeg failed to play it
             self.log.debug("playlist: validating %s" % item.format_debug_string())
             ver = item.version
 
@@ -357,8 +370,7 @@ class AutoPlaylist(OneshotPlaylist):
 
     def refresh(self):
         dicts = var.music_db.query_random_music(var.config.getint("bot", "autoplay_length", fallback=5),
-                                                Condition().and_not_sub_condition(
-                                                    Condition().and_like('tags', "%don't autoplay,%")))
+                                                Condition().and_not_tag("don't autoplay"))
 
         if dicts:
             _list = [get_cached_wrapper_from_dict(_dict, "AutoPlay") for _dict in dicts]
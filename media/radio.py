@@ -2,6 +2,8 @@ import re
 import logging
 import struct
 import requests
+import threading
+import time
 import traceback
 import hashlib
 
@@ -11,8 +13,57 @@ from constants import tr_cli as tr
 
 log = logging.getLogger("bot")
 
+# Seconds the metadata of a radio is kept, for every item and every bot of the process asking for it
+RADIO_TITLE_TTL = 10
+RADIO_DESCRIPTION_TTL = 3600
+
+
+class MetadataCache:
+    # fetch(url) called at most once every ttl seconds per url. Callers asking for an url being fetched wait
+    # for that request instead of sending another one.
+
+    def __init__(self, fetch, ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.entries = {}  # url -> (time, value)
+        self.fetching = {}  # url -> Event set once fetched
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        while True:
+            with self.lock:
+                entry = self.entries.get(url)
+                if entry and time.monotonic() - entry[0] < self.ttl:
+                    return entry[1]
+                event = self.fetching.get(url)
+                if event is None:
+                    event = self.fetching[url] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            value = self.fetch(url)
+            with self.lock:
+                now = time.monotonic()
+                for expired in [key for key, (fetched, _) in self.entries.items() if now - fetched >= self.ttl]:
+                    del self.entries[expired]
+                self.entries[url] = (now, value)
+            return value
+        finally:
+            with self.lock:
+                del self.fetching[url]
+            event.set()
+
 
 def get_radio_server_description(url):
+    return radio_descriptions.get(url)
+
+
+def get_radio_title(url):
+    return radio_titles.get(url)
+
+
+def fetch_radio_server_description(url):
     global log
 
     log.debug("radio: fetching radio server description")
@@ -59,10 +110,10 @@ def get_radio_server_description(url):
     return url
 
 
-def get_radio_title(url):
+def fetch_radio_title(url):
     global log
 
-    log.debug("radio: fetching radio server description")
+    log.debug("radio: fetching radio title")
     try:
         r = requests.get(url, headers={'Icy-MetaData': '1'}, stream=True, timeout=10)
         icy_metaint_header = int(r.headers['icy-metaint'])
@@ -86,6 +137,10 @@ def get_radio_title(url):
     return url
 
 
+radio_descriptions = MetadataCache(fetch_radio_server_description, RADIO_DESCRIPTION_TTL)
+radio_titles = MetadataCache(fetch_radio_title, RADIO_TITLE_TTL)
+
+
 def radio_item_builder(**kwargs):
     if 'name' in kwargs:
         return RadioItem(kwargs['url'], kwargs['name'])
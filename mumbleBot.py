@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
 import threading
 import time
 import sys
@@ -8,7 +9,6 @@ import math
 import signal
 import configparser
 import audioop
-import subprocess as sp
 import argparse
 import os
 import os.path
@@ -18,7 +18,6 @@ import variables as var
 import logging
 import logging.handlers
 import traceback
-import struct
 
 import util
 import command
@@ -28,6 +27,21 @@ from database import SettingsDatabase, MusicDatabase, DatabaseMigration
 from media.item import ValidationFailedError, PreparationFailedError
 import media.playlist
 from media.cache import MusicCache
+from media.analysis import loudness_to_gain
+from audio.fade import Fader, FADE_IN, FADE_OUT
+from audio.buffering import BufferTarget
+from audio.decoder import Decoder, MappedDecoder, ERROR_NETWORK
+from audio.dsp import DSPChain, Equalizer, Compressor, Limiter
+from audio.ducking import DuckingDetector
+from audio.gain import GainRamp
+from audio.mixer import CrossfadeMixer
+from audio.passthrough import OpusDecoder, OpusPassthrough, may_be_opus, PASSTHROUGH_GAIN
+from audio.pcm import FRAME_DURATION, FRAME_SAMPLES, SAMPLE_RATE, SAMPLE_WIDTH, frame_size, bytes_to_seconds, \
+    seconds_to_bytes
+from audio.pcm_cache import PCMCache
+from audio.scheduler import PlaybackScheduler
+from audio.shared import SharedDecoder, hub
+from audio.telemetry import LoopTelemetry, LoopWatchdog
 
 
 class MumbleBot:
@@ -53,21 +67,73 @@ class MumbleBot:
         self.nb_exit = 0
 
         # Related to ffmpeg thread
-        self.thread = None
-        self.thread_stderr = None
+        self.decoder = None
+        self.decoder_buffer = var.config.getfloat('bot', 'decoder_buffer', fallback=1.0)
+
+        # Decoder of the next song, started before the current one ends for gapless playback
+        self.next_decoder = None
+        self.next_decoder_item = None
+        self.gapless = var.config.getboolean('bot', 'gapless', fallback=False)
+        self.gapless_prefetch = var.config.getfloat('bot', 'gapless_prefetch', fallback=5)
+
+        # Crossfade: the decoder of the previous song keeps playing under the new one for a few seconds
+        self.outgoing_decoder = None
+        self.crossfade = var.config.getfloat('bot', 'crossfade', fallback=0)
+        self.mixer = None
+        if self.crossfade > 0:
+            self.mixer = CrossfadeMixer(2 if self.stereo else 1, self.crossfade,
+                                        var.config.get('bot', 'crossfade_curve', fallback='cosine'))
         self.read_pcm_size = 0
         self.pcm_buffer_size = 0
+        self.fade_in = False  # the next frame read starts the song or resumes it
         self.last_ffmpeg_err = ""
+        self.fader = Fader(var.config.get('bot', 'fade_curve', fallback='exponential'))
+        self.loudness_normalization = var.config.getboolean('bot', 'loudness_normalization', fallback=False)
+        self.loudness_target = var.config.getfloat('bot', 'loudness_target', fallback=-18)
+        self.loudness_max_gain = var.config.getfloat('bot', 'loudness_max_gain', fallback=6)
+        # skip the silence at the beginning and the end of the files, measured when the library was scanned
+        self.silence_trimming = var.config.getboolean('bot', 'silence_trimming', fallback=False)
+        self.trim_end = None  # where the silence at the end of the current song starts
+
+        self.pcm_cache = None
+        max_size = var.config.getint('bot', 'pcm_cache_size', fallback=500)
+        if var.config.getboolean('bot', 'pcm_cache', fallback=False) and max_size != 0:
+            self.pcm_cache = PCMCache(os.path.join(var.tmp_folder, "pcm"),
+                                      max_size * 1024 * 1024 if max_size > 0 else None,
+                                      2 if self.stereo else 1)
+        self.gain = GainRamp(2 if self.stereo else 1)
+
+        # processing of the songs before the volume, for each type of item
+        self.dsp_chains = self._create_dsp_chains()
+        self.dsp_chain = None
 
         # Play/pause status
         self.is_pause = False
         self.pause_at_id = ""
-        self.playhead = -1  # current position in a song.
-        self.song_start_at = -1
+        self.playhead = -1  # current position in a song, see position()
         self.wait_for_ready = False  # flag for the loop are waiting for download to complete in the other thread
 
         #
         self.on_interrupting = False
+        self._interrupted = threading.Event()
+        self._interrupt_handled = threading.Event()  # the state that follows an interrupt has been set
+        self._interrupt_handled.set()
+        self.hold_decoder = False  # keep the decoder of the song being interrupted, see pause()
+        self.paused_decoder = None
+        self.paused_decoder_item = None
+        self.paused_pcm = b''  # frames read from the paused decoder and never heard, played first on resume
+        self.replay_pcm = b''
+
+        # Wakes up the loop when the playlist, the decoders or the play status change
+        self.scheduler = PlaybackScheduler()
+        # seconds of audio kept in pymumble's buffer, adapted to how late the loop wakes up
+        self.buffering = BufferTarget(var.config.getfloat('bot', 'output_buffer_min', fallback=0.1),
+                                      var.config.getfloat('bot', 'output_buffer_max', fallback=1.0))
+        # the last frames of the song handed to pymumble, before the dsp and the volume, as long as it may
+        # still have them queued: a pause drops them from pymumble, the song resumes with them
+        self.sent_frames = collections.deque()
+        self.sent_size = 0
+        self.sent_max_size = seconds_to_bytes(self.buffering.maximum + 2 * FRAME_DURATION, 2 if self.stereo else 1)
 
         if args.host:
             host = args.host
@@ -123,6 +189,13 @@ class MumbleBot:
         self.join_channel()
         self.mumble.set_bandwidth(200000)
 
+        self.passthrough = None
+        if var.config.getboolean('bot', 'opus_passthrough', fallback=False):
+            if OpusPassthrough.supported(self.mumble.sound_output):
+                self.passthrough = OpusPassthrough(self.mumble.sound_output, 2 if self.stereo else 1)
+            else:
+                self.log.warning("bot: opus passthrough isn't possible with this version of pymumble")
+
         # ====== Volume ======
         self.volume_helper = util.VolumeHelper()
 
@@ -130,10 +203,11 @@ class MumbleBot:
         if var.db.has_option('bot', 'volume'):
             _volume = var.db.getfloat('bot', 'volume')
         self.volume_helper.set_volume(_volume)
+        if self.passthrough and abs(self.volume_helper.volume_set - 1) >= PASSTHROUGH_GAIN:
+            self.log.info("bot: opus passthrough only works at the volume that leaves songs as they are, "
+                          "!volume 87 or 88")
 
         self.is_ducking = False
-        self.on_ducking = False
-        self.ducking_release = time.time()
         self.last_volume_cycle_time = time.time()
 
         self._ducking_volume = 0
@@ -141,12 +215,18 @@ class MumbleBot:
         _ducking_volume = var.db.getfloat("bot", "ducking_volume", fallback=_ducking_volume)
         self.volume_helper.set_ducking_volume(_ducking_volume)
 
-        self.ducking_threshold = var.config.getfloat("bot", "ducking_threshold", fallback=5000)
-        self.ducking_threshold = var.db.getfloat("bot", "ducking_threshold", fallback=self.ducking_threshold)
+        ducking_threshold = var.config.getfloat("bot", "ducking_threshold", fallback=5000)
+        ducking_threshold = var.db.getfloat("bot", "ducking_threshold", fallback=ducking_threshold)
+        self.ducking = DuckingDetector(ducking_threshold,
+                                       attack=var.config.getfloat("bot", "ducking_attack", fallback=0),
+                                       release=var.config.getfloat("bot", "ducking_release", fallback=1))
+        for name, threshold in var.db.items("ducking_threshold"):
+            self.ducking.thresholds[name] = float(threshold)
 
         if not var.db.has_option("bot", "ducking") and var.config.getboolean("bot", "ducking", fallback=False) \
                 or var.config.getboolean("bot", "ducking"):
             self.is_ducking = True
+            self.ducking.start()
             self.mumble.callbacks.set_callback(pymumble.constants.PYMUMBLE_CLBK_SOUNDRECEIVED,
                                                self.ducking_sound_received)
             self.mumble.set_receive_sound(True)
@@ -162,9 +242,22 @@ class MumbleBot:
             self.mumble.callbacks.set_callback(pymumble.constants.PYMUMBLE_CLBK_USERUPDATED, user_change_callback(True))
 
         # Debug use
+        self.telemetry = LoopTelemetry()
+        self.watchdog = LoopWatchdog(self.telemetry, self._is_playing,
+                                     var.config.getint('debug', 'loop_watchdog', fallback=3000) / 1000)
         self._loop_status = 'Idle'
-        self._display_rms = False
-        self._max_rms = 0
+
+    @property
+    def _loop_status(self):
+        return self._status
+
+    @_loop_status.setter
+    def _loop_status(self, status):
+        self.telemetry.enter(status)
+        self._status = status
+
+    def _is_playing(self):
+        return self.decoder is not None and not self.is_pause and not self.exit and self.read_pcm_size > 0
 
     # Set the CTRL+C shortcut
     def ctrl_caught(self, signal, frame):
@@ -182,6 +275,7 @@ class MumbleBot:
         self.nb_exit += 1
 
         self.exit = True
+        self.wake("exit")
 
     def register_command(self, cmd, handle, no_partial_match=False, access_outside_channel=False, admin=False):
         cmds = cmd.split(",")
@@ -297,6 +391,8 @@ class MumbleBot:
                 error = error_traceback.rstrip().split("\n")[-1]
                 self.log.error(f"bot: command {command_exc} failed with error: {error_traceback}\n")
                 self.send_msg(tr('error_executing_command', command=command_exc, error=error), text)
+            finally:
+                self.interrupt_handled()
 
     def send_msg(self, msg, text):
         msg = msg.encode('utf-8', 'ignore').decode('utf-8')
@@ -350,28 +446,249 @@ class MumbleBot:
     def launch_music(self, music_wrapper, start_from=0):
         assert music_wrapper.is_ready()
 
-        uri = music_wrapper.uri()
-
         self.log.info("bot: play music " + music_wrapper.format_debug_string())
 
         if var.config.getboolean('bot', 'announce_current_music'):
             self.send_channel_msg(music_wrapper.format_current_playing())
 
-        if var.config.getboolean('debug', 'ffmpeg'):
-            ffmpeg_debug = "debug"
+        channels = 2 if self.stereo else 1
+        self.pcm_buffer_size = frame_size(channels)
+
+        if self.next_decoder and self.next_decoder_item is music_wrapper and start_from == 0:
+            # the song was prefetched, e.g. the current one has been skipped right before its end
+            self.decoder = self.next_decoder
+            self.next_decoder = None
+            self.next_decoder_item = None
         else:
-            ffmpeg_debug = "warning"
+            self.decoder = self._create_decoder(music_wrapper, start_from)
+        self._forget_sent()
+        self.fade_in = True
+        self._follow_song(music_wrapper)
 
+    def _create_dsp_chains(self):
         channels = 2 if self.stereo else 1
-        self.pcm_buffer_size = 960*channels
 
-        command = ("ffmpeg", '-v', ffmpeg_debug, '-nostdin', '-i',
-                   uri, '-ss', f"{start_from:f}", '-ac', str(channels), '-f', 's16le', '-ar', '48000', '-')
-        self.log.debug("bot: execute ffmpeg command: " + " ".join(command))
+        def option(name, fallback):
+            return var.config.getfloat('dsp', name, fallback=fallback)
+
+        chains = {}
+        for type in ('file', 'url', 'radio'):
+            stages = []
+            for name in var.config.get('dsp', type, fallback='').split(','):
+                name = name.strip()
+                if name == 'eq':
+                    stages.append(Equalizer(channels, bass=option('eq_bass', 0), treble=option('eq_treble', 0),
+                                            crossover=option('eq_crossover', 250)))
+                elif name == 'compressor':
+                    stages.append(Compressor(channels, threshold=option('compressor_threshold', -20),
+                                             ratio=option('compressor_ratio', 3),
+                                             attack=option('compressor_attack', 10) / 1000,
+                                             release=option('compressor_release', 200) / 1000,
+                                             makeup=option('compressor_makeup', 0)))
+                elif name == 'limiter':
+                    stages.append(Limiter(channels, ceiling=option('limiter_ceiling', -1),
+                                          release=option('limiter_release', 100) / 1000))
+                elif name:
+                    self.log.warning(f"bot: unknown dsp stage '{name}' for {type}, ignored")
+            if stages:
+                chains[type] = DSPChain(stages, channels)
+        return chains
+
+    def _follow_song(self, music_wrapper, spliced=False):
+        # The decoder now plays music_wrapper: take the chain of its type, and where it ends
+        type = 'url' if music_wrapper.type == 'url_from_playlist' else music_wrapper.type
+        self.dsp_chain = self.dsp_chains.get(type)
+        if self.dsp_chain and not spliced:
+            # the state of the chain carries on when songs follow each other
+            self.dsp_chain.reset()
+        self.trim_end = music_wrapper.item().trim_end if self.silence_trimming else None
+
+    def _song_end(self):
+        # where the current song ends, its duration if the end has no silence, 0 if unknown
+        return self.trim_end or var.playlist.current_item().item().duration
+
+    def _past_end(self):
+        return self.trim_end is not None and self._read_position() >= self.trim_end
+
+    def _create_decoder(self, music_wrapper, start_from=0):
+        channels = 2 if self.stereo else 1
+        # a song played from its beginning is recorded whole for the PCM cache, its silence is only skipped
+        from_beginning = start_from == 0
+        end = None
+        if self.silence_trimming:
+            end = music_wrapper.item().trim_end
+            if from_beginning:
+                start_from = music_wrapper.item().trim_start
+
+        if music_wrapper.type == 'radio':
+            # a radio already played by another bot of the process isn't decoded twice
+            return SharedDecoder(hub, music_wrapper.uri(), channels, buffer_duration=self.decoder_buffer,
+                                 ffmpeg_debug=var.config.getboolean('debug', 'ffmpeg'),
+                                 listener=lambda: self.wake("decoder")).start()
+
+        if self.passthrough and may_be_opus(music_wrapper.uri()):
+            return OpusDecoder(music_wrapper.uri(), channels, start_from, buffer_duration=self.decoder_buffer,
+                               ffmpeg_debug=var.config.getboolean('debug', 'ffmpeg'),
+                               listener=lambda: self.wake("decoder"), gain=self._pre_gain(music_wrapper)).start()
+
+        recording = None
+        if self.pcm_cache and music_wrapper.type in ('file', 'url'):
+            path = self.pcm_cache.lookup(music_wrapper.item())
+            if path:
+                return MappedDecoder(path, channels, start_from, gain=self._pre_gain(music_wrapper), end=end).start()
+            if from_beginning:
+                recording = self.pcm_cache.recording(music_wrapper.item())
+
+        return Decoder(music_wrapper.uri(), channels, start_from, buffer_duration=self.decoder_buffer,
+                       ffmpeg_debug=var.config.getboolean('debug', 'ffmpeg'),
+                       listener=lambda: self.wake("decoder"), gain=self._pre_gain(music_wrapper),
+                       recording=recording, end=end).start()
+
+    def _pre_gain(self, music_wrapper):
+        # gain bringing the song to the target loudness, measured when the library was scanned
+        if not self.loudness_normalization:
+            return 1.0
+        return loudness_to_gain(music_wrapper.item().loudness, self.loudness_target, self.loudness_max_gain)
+
+    def _prefetch_next(self):
+        # Start decoding the next song a few seconds before the current one ends, or as soon as
+        # ffmpeg has finished with the current one when its duration is unknown.
+        if self.next_decoder:
+            if self.next_decoder_item is var.playlist.next_item():
+                return
+            self.log.debug("bot: playlist changed, drop the prefetched song")
+            self._drop_next_decoder()
+
+        if self.is_pause or self.on_interrupting or self.wait_for_ready:
+            return
+
+        end = self._song_end()
+        if not self.decoder.is_eof() \
+                and (not end or end - self._read_position() > self.gapless_prefetch + self.crossfade):
+            return
+
+        next = var.playlist.next_item()
+        if not next or not next.is_ready():
+            return
+
+        self.log.debug(f"bot: prefetch the next song: {next.format_debug_string()}")
+        self.next_decoder = self._create_decoder(next)
+        self.next_decoder_item = next
+
+    def _read_position(self):
+        # position in the song of the last frame read from the decoder, ahead of what is heard by the
+        # amount of audio buffered in pymumble
+        return self.decoder.start_from + bytes_to_seconds(self.read_pcm_size, self.decoder.channels)
+
+    def position(self):
+        # Position in seconds of what is being heard in the current song. The loop derives it from the
+        # audio handed to pymumble minus what is still queued there, so it doesn't drift while the loop
+        # waits, and it never goes backwards while a song plays. Resume and seeks start from it.
+        return max(self.playhead, 0)
+
+    def _passthrough_possible(self):
+        # Opus packets go to Mumble as they are only while the bot has nothing to change in the song
+        return self.passthrough and self.decoder.passthrough and self.read_pcm_size > 0 and not self.replay_pcm \
+            and not self.fade_in \
+            and not self.on_interrupting and not self.outgoing_decoder and not self.dsp_chain and not self._past_end() \
+            and abs(self.volume_helper.real_volume * self.decoder.gain - 1) < PASSTHROUGH_GAIN \
+            and abs(self.gain.gain - 1) < PASSTHROUGH_GAIN \
+            and self.passthrough.ready() and self.passthrough.fits(self.decoder.bitrate())
+
+    def _account_frame(self, size, buffered):
+        # a frame of size bytes of the current song has been handed to pymumble, which had buffered seconds
+        if self.telemetry.sent(buffered, self.read_pcm_size > size):
+            self.buffering.underrun()
+        # move playhead forward: what is heard is behind what was read by what pymumble still has,
+        # this frame included
+        self.playhead = max(self.playhead, self._read_position() - buffered
+                            - bytes_to_seconds(size, self.decoder.channels))
+
+    def _read_frame(self):
+        # the frames a paused song didn't get to play come before the rest of the decoder
+        if self.replay_pcm:
+            frame = self.replay_pcm[:self.pcm_buffer_size]
+            self.replay_pcm = self.replay_pcm[len(frame):]
+            return frame
+        return self.decoder.read()
+
+    def _remember_sent(self, pcm):
+        # the frames of a decoder are views of a block it reuses, they are copied. bytes, mixed or replayed
+        # after a pause, are kept as they are.
+        if not isinstance(pcm, bytes) and not (isinstance(pcm, memoryview) and isinstance(pcm.obj, bytes)):
+            pcm = bytes(pcm)
+        self.sent_frames.append(pcm)
+        self.sent_size += len(pcm)
+        while self.sent_size - len(self.sent_frames[0]) >= self.sent_max_size:
+            self.sent_size -= len(self.sent_frames.popleft())
+
+    def _forget_sent(self):
+        self.sent_frames.clear()
+        self.sent_size = 0
+
+    def _sent_tail(self, size):
+        # the last size bytes handed to pymumble, None if they aren't all remembered
+        if size > self.sent_size:
+            return None
+        return b''.join(self.sent_frames)[self.sent_size - size:]
+
+    def _next_decoder_ready(self):
+        return self.next_decoder is not None and self.next_decoder_item is var.playlist.next_item()
+
+    def _drop_next_decoder(self):
+        if self.next_decoder:
+            self.next_decoder.kill()
+        self.next_decoder = None
+        self.next_decoder_item = None
+
+    def _splice_next(self, crossfade=False):
+        # Switch to the prefetched decoder, its first frame goes right after the last frame of the current song.
+        # With crossfade, the current decoder is kept as the outgoing one and mixed under the new song.
+        if crossfade:
+            self.outgoing_decoder = self.decoder
+            self.mixer.reset()
+        else:
+            self.decoder.kill()
+        self.decoder = self.next_decoder
+        self.next_decoder = None
+        self.next_decoder_item = None
+
+        var.playlist.next()
+        current = var.playlist.current_item()
+        self.log.info("bot: play music " + current.format_debug_string()
+                      + (" (crossfade)" if crossfade else " (gapless)"))
+        self._follow_song(current, spliced=True)
+        if var.config.getboolean('bot', 'announce_current_music'):
+            self.send_channel_msg(current.format_current_playing())
 
-        pipe_rd, pipe_wd = None, None
+        # the accounting now belongs to the new song, which is heard once pymumble played the end of the
+        # previous one
+        self.read_pcm_size = 0
+        self._forget_sent()
+        self.playhead = 0
+        self.async_download_next()
 
-        self.thread = sp.Popen(command, stdout=sp.PIPE, stderr=pipe_wd, bufsize=self.pcm_buffer_size)
+    def _crossfade_due(self):
+        # Crossfade needs the duration of the song, and the next song to be already decoding
+        if not self.mixer or self.outgoing_decoder or not self._next_decoder_ready():
+            return False
+
+        end = self._song_end()
+        return end and end - self._read_position() <= self.crossfade \
+            and self.next_decoder.available() >= self.pcm_buffer_size
+
+    def _mix_outgoing(self, raw_music):
+        outgoing = self.outgoing_decoder.read()
+        # raw_music gets the gain of its own song later, the outgoing song is corrected by the difference
+        mixed = self.mixer.mix(outgoing, raw_music, self.outgoing_decoder.gain / self.decoder.gain)
+        if outgoing == b'' or self.mixer.is_done():
+            self._stop_crossfade()
+        return mixed
+
+    def _stop_crossfade(self):
+        if self.outgoing_decoder:
+            self.outgoing_decoder.kill()
+            self.outgoing_decoder = None
 
     def async_download_next(self):
         # Function start if the next music isn't ready
@@ -416,59 +733,189 @@ class MumbleBot:
         except PreparationFailedError as e:
             self.send_channel_msg(e.msg)
             return False
+        finally:
+            self.wake("download")
 
         if item.version > ver:
             var.playlist.version += 1
 
+    def _stop_decoder(self, unheard=0):
+        # The song has been faded out, the last unheard bytes handed to pymumble have been dropped from it.
+        # A song being paused keeps its decoder: ffmpeg stays blocked on the full buffer, and the song
+        # resumes with the frames dropped, then from there.
+        # pymumble may have been in the middle of a frame: the song resumes from its beginning, a few ms
+        # played again under the fade in rather than a frame cut short, which would end the song.
+        unheard += -unheard % self.pcm_buffer_size
+        paused_pcm = self._sent_tail(unheard) if self.on_interrupting and self.hold_decoder else None
+        if paused_pcm is not None:
+            self.paused_decoder = self.decoder
+            self.paused_decoder_item = var.playlist.current_item()
+            self.paused_pcm = paused_pcm + self.replay_pcm
+            # pymumble plays what is left queued, the song will resume right after it
+            self.playhead = self._read_position() - bytes_to_seconds(unheard, self.decoder.channels)
+        else:
+            if self.hold_decoder:
+                self.log.debug("bot: the audio dropped from pymumble isn't known, the song will resume by seeking")
+            self.decoder.kill()
+        self.decoder = None
+        self.replay_pcm = b''
+        self.fade_in = False
+        self._forget_sent()
+        self._stop_crossfade()
+        self._finish_interrupt()
+
+    def _flush_output(self):
+        # Drop what pymumble still has queued, so that the skip or the pause is heard right away, and
+        # return how many seconds of audio were dropped
+        flushed = self.mumble.sound_output.get_buffer_size()
+        if flushed:
+            self.mumble.sound_output.clear_buffer()
+            self.buffering.flush(flushed)
+        return flushed
+
+    def _drop_paused_decoder(self):
+        if self.paused_decoder:
+            self.paused_decoder.kill()
+        self.paused_decoder = None
+        self.paused_decoder_item = None
+        self.paused_pcm = b''
+
+    def _finish_interrupt(self):
+        # Called by the loop once the decoder is gone
+        self.hold_decoder = False
+        if not self.on_interrupting:
+            return
+        self.on_interrupting = False
+        self._interrupted.set()
+        # interrupt() is followed by a change of state (pause, another song...), wait for it before going on,
+        # unless it is already done
+        if not self._interrupt_handled.is_set():
+            self._interrupt_handled.wait(0.1)
+
+    def wake(self, reason="event"):
+        # Tell the loop that something it may be waiting for has changed
+        self.scheduler.notify(reason)
+
     # =======================
     #          Loop
     # =======================
 
     # Main loop of the Bot
     def loop(self):
+        self.watchdog.start()
         while not self.exit and self.mumble.is_alive():
 
-            while self.thread and self.mumble.sound_output.get_buffer_size() > 0.5 and not self.exit:
-                # If the buffer isn't empty, I cannot send new music part, so I wait
-                self._loop_status = f'Wait for buffer {self.mumble.sound_output.get_buffer_size():.3f}'
-                time.sleep(0.01)
+            buffered = self.mumble.sound_output.get_buffer_size()
+            if self.decoder:
+                self.telemetry.buffer_level(buffered)
+            if self.decoder and not self.on_interrupting and buffered > self.buffering.target:
+                # If the buffer isn't empty, I cannot send new music part, so I wait until it drains
+                # down to the target, or something else happens
+                self._loop_status = f'Wait for buffer {buffered:.3f}'
+                timeout = buffered - self.buffering.target
+                start = time.monotonic()
+                if not self.scheduler.wait(timeout):
+                    self.buffering.woke(time.monotonic() - start - timeout)
+                continue
 
             raw_music = None
-            if self.thread:
-                # I get raw from ffmpeg thread
-                # move playhead forward
+            if self.decoder:
+                # I get raw from the decoder's ring buffer
                 self._loop_status = 'Reading raw'
-                if self.song_start_at == -1:
-                    self.song_start_at = time.time() - self.playhead
-                self.playhead = time.time() - self.song_start_at
-
-                raw_music = self.thread.stdout.read(self.pcm_buffer_size)
+                if self.passthrough:
+                    self.volume_cycle()
+                    if self._passthrough_possible():
+                        packet = self.decoder.read_packet(self.passthrough.samples)
+                        if packet:
+                            size = self.passthrough.samples * self.decoder.frame_size // FRAME_SAMPLES
+                            self.read_pcm_size += size
+                            self._account_frame(size, buffered)
+                            self.passthrough.send(packet)
+                            # the packet can't be replayed, what was sent before it neither
+                            self._forget_sent()
+                            if self.gapless or self.mixer:
+                                self._prefetch_next()
+                                if self._crossfade_due():
+                                    self._splice_next(crossfade=True)
+                            continue
+
+                raw_music = self._read_frame()
+                if raw_music is None:
+                    if self.on_interrupting:
+                        # interrupted while ffmpeg is late, there is nothing to fade out
+                        self._stop_decoder()
+                    else:
+                        # ffmpeg is late, nothing to play for now. The decoder wakes me up once it has a frame.
+                        self._loop_status = 'Wait for decoder'
+                        self.scheduler.wait()
+                    continue
                 self.read_pcm_size += len(raw_music)
 
+                if raw_music and self.outgoing_decoder:
+                    # the previous song is fading out under this one
+                    raw_music = self._mix_outgoing(raw_music)
+
                 if raw_music:
+                    self._remember_sent(raw_music)
                     # Adjust the volume and send it to mumble
                     self.volume_cycle()
-
-                    if not self.on_interrupting and len(raw_music) == self.pcm_buffer_size:
+                    # the loudness normalization of the song comes on top of the volume
+                    volume = self.volume_helper.real_volume * self.decoder.gain
+                    self._account_frame(len(raw_music), buffered)
+                    if self.dsp_chain:
+                        raw_music = self.dsp_chain.process(raw_music, volume)
+                    # what is left of the song is silence, this frame is its last one
+                    at_end = self._past_end()
+
+                    if not self.on_interrupting and len(raw_music) == self.pcm_buffer_size and not at_end:
+                        if self.fade_in:
+                            raw_music = self.fader.apply(raw_music, 2 if self.stereo else 1, FADE_IN, pad=False)
+                            self.fade_in = False
                         self.mumble.sound_output.add_sound(
-                            audioop.mul(raw_music, 2, self.volume_helper.real_volume))
-                    elif self.read_pcm_size == 0:
+                            self.gain.apply(raw_music, volume))
+                        if self.gapless or self.mixer:
+                            self._prefetch_next()
+                            if self._crossfade_due():
+                                self._splice_next(crossfade=True)
+                    elif not self.on_interrupting and self._next_decoder_ready():
+                        # gapless: the next song starts right after the last samples of this one
                         self.mumble.sound_output.add_sound(
-                            audioop.mul(self._fadeout(raw_music, self.stereo, fadein=True), 2, self.volume_helper.real_volume))
-                    elif self.on_interrupting or len(raw_music) < self.pcm_buffer_size:
+                            self.gain.apply(raw_music, volume))
+                        self._splice_next()
+                    elif self.on_interrupting or len(raw_music) < self.pcm_buffer_size or at_end:
+                        unheard = 0
+                        if self.on_interrupting:
+                            # what was dropped, and this frame which is only heard fading out. pymumble
+                            # counts in seconds, rounded back here to the samples they were.
+                            unheard = round(self._flush_output() * SAMPLE_RATE) * SAMPLE_WIDTH \
+                                * self.decoder.channels + len(raw_music)
                         self.mumble.sound_output.add_sound(
-                            audioop.mul(self._fadeout(raw_music, self.stereo, fadein=False), 2, self.volume_helper.real_volume))
-                        self.thread.kill()
-                        self.thread = None
-                        time.sleep(0.1)
-                        self.on_interrupting = False
-                else:
-                    time.sleep(0.1)
-            else:
-                time.sleep(0.1)
+                            self.gain.apply(self._fadeout(raw_music, self.stereo, fadein=False), volume))
+                        self._stop_decoder(unheard)
+                elif not self.on_interrupting and self._next_decoder_ready():
+                    self._splice_next()
+                    continue
+                elif self.is_pause:
+                    # the song ended while being paused
+                    self._loop_status = 'Paused'
+                    self.scheduler.wait()
+                    continue
+            elif self.is_pause:
+                self._loop_status = 'Paused'
+                self.scheduler.wait()
+                continue
 
             if not self.is_pause and not raw_music:
-                self.thread = None
+                error_kind = None
+                if self.decoder:
+                    if self.decoder.error:
+                        self.last_ffmpeg_err = self.decoder.error
+                        error_kind = self.decoder.error_kind
+                    self.decoder.kill()
+                    self.decoder = None
+                    self._forget_sent()
+                    self._finish_interrupt()
+                self._stop_crossfade()
                 # bot is not paused, but ffmpeg thread has gone.
                 # indicate that last song has finished, or the bot just resumed from pause, or something is wrong.
                 if self.read_pcm_size < self.pcm_buffer_size \
@@ -476,12 +923,21 @@ class MumbleBot:
                         and self.last_ffmpeg_err:
                     current = var.playlist.current_item()
                     self.log.error("bot: cannot play music %s", current.format_debug_string())
-                    self.log.error("bot: with ffmpeg error: %s", self.last_ffmpeg_err)
+                    self.log.error("bot: with ffmpeg error (%s): %s", error_kind, self.last_ffmpeg_err)
                     self.last_ffmpeg_err = ""
 
                     self.send_channel_msg(tr('unable_play', item=current.format_title()))
                     var.playlist.remove_by_id(current.id)
-                    var.cache.free_and_delete(current.id)
+                    var.playlist.current_index -= 1  # then the bot will move to next item
+                    if error_kind == ERROR_NETWORK:
+                        # it may work later, keep it in the library
+                        var.cache.free(current.id)
+                    else:
+                        var.cache.free_and_delete(current.id)
+                elif self.last_ffmpeg_err:
+                    # the song broke after it started, it is over anyway
+                    self.log.warning("bot: ffmpeg error (%s) while playing: %s", error_kind, self.last_ffmpeg_err)
+                    self.last_ffmpeg_err = ""
 
                 # move to the next song.
                 if not self.wait_for_ready:  # if wait_for_ready flag is not true, move to the next song.
@@ -492,7 +948,6 @@ class MumbleBot:
                             self.validate_and_start_download(current)
                             self.wait_for_ready = True
 
-                            self.song_start_at = -1
                             self.playhead = 0
 
                         except ValidationFailedError as e:
@@ -501,6 +956,7 @@ class MumbleBot:
                             var.cache.free_and_delete(current.id)
                     else:
                         self._loop_status = 'Empty queue'
+                        self.scheduler.wait()
                 else:
                     # if wait_for_ready flag is true, means the pointer is already
                     # pointing to target song. start playing
@@ -510,7 +966,7 @@ class MumbleBot:
                             self.wait_for_ready = False
                             self.read_pcm_size = 0
 
-                            self.launch_music(current, self.playhead)
+                            self.launch_music(current, self.position())
                             self.last_volume_cycle_time = time.time()
                             self.async_download_next()
                         elif current.is_failed():
@@ -518,6 +974,7 @@ class MumbleBot:
                             self.wait_for_ready = False
                         else:
                             self._loop_status = 'Wait for the next item to be ready'
+                            self.scheduler.wait()
                     else:
                         self.wait_for_ready = False
 
@@ -536,12 +993,8 @@ class MumbleBot:
     def volume_cycle(self):
         delta = time.time() - self.last_volume_cycle_time
 
-        if self.on_ducking and self.ducking_release < time.time():
-            self.on_ducking = False
-            self._max_rms = 0
-
         if delta > 0.001:
-            if self.is_ducking and self.on_ducking:
+            if self.is_ducking and self.ducking.is_ducking():
                 self.volume_helper.real_volume = \
                     (self.volume_helper.real_volume - self.volume_helper.ducking_volume_set) * math.exp(- delta / 0.2) \
                     + self.volume_helper.ducking_volume_set
@@ -552,41 +1005,10 @@ class MumbleBot:
             self.last_volume_cycle_time = time.time()
 
     def ducking_sound_received(self, user, sound):
-        rms = audioop.rms(sound.pcm, 2)
-        self._max_rms = max(rms, self._max_rms)
-        if self._display_rms:
-            if rms < self.ducking_threshold:
-                print('%6d/%6d  ' % (rms, self._max_rms) + '-' * int(rms / 200), end='\r')
-            else:
-                print('%6d/%6d  ' % (rms, self._max_rms) + '-' * int(self.ducking_threshold / 200)
-                      + '+' * int((rms - self.ducking_threshold) / 200), end='\r')
-
-        if rms > self.ducking_threshold:
-            if self.on_ducking is False:
-                self.log.debug("bot: ducking triggered")
-                self.on_ducking = True
-            self.ducking_release = time.time() + 1  # ducking release after 1s
+        self.ducking.feed(user, sound)
 
     def _fadeout(self, _pcm_data, stereo=False, fadein=False):
-        pcm_data = bytearray(_pcm_data)
-        if stereo:
-            if not fadein:
-                mask = [math.exp(-x/60) for x in range(0, int(len(pcm_data) / 4))]
-            else:
-                mask = [math.exp(-x / 60) for x in reversed(range(0, int(len(pcm_data) / 4)))]
-
-            for i in range(int(len(pcm_data) / 4)):
-                pcm_data[4 * i:4 * i + 2] = struct.pack("<h",
-                                                        round(struct.unpack("<h", pcm_data[4 * i:4 * i + 2])[0] * mask[i]))
-                pcm_data[4 * i + 2:4 * i + 4] = struct.pack("<h", round(
-                    struct.unpack("<h", pcm_data[4 * i + 2:4 * i + 4])[0] * mask[i]))
-        else:
-            mask = [math.exp(-x/60) for x in range(0, int(len(pcm_data) / 2))]
-            for i in range(int(len(pcm_data) / 2)):
-                pcm_data[2 * i:2 * i + 2] = struct.pack("<h",
-                                                        round(struct.unpack("<h", pcm_data[2 * i:2 * i + 2])[0] * mask[i]))
-
-        return bytes(pcm_data) + bytes(len(pcm_data))
+        return self.fader.apply(_pcm_data, 2 if stereo else 1, FADE_IN if fadein else FADE_OUT)
 
     # =======================
     #      Play Control
@@ -595,6 +1017,7 @@ class MumbleBot:
     def play(self, index=-1, start_at=0):
         if not self.is_pause:
             self.interrupt()
+        self._drop_paused_decoder()
 
         if index != -1:
             var.playlist.point_to(index)
@@ -604,58 +1027,92 @@ class MumbleBot:
         self.validate_and_start_download(current)
         self.is_pause = False
         self.wait_for_ready = True
-        self.song_start_at = -1
         self.playhead = start_at
+        self.interrupt_handled()
+        self.wake("play")
 
     def clear(self):
         # Kill the ffmpeg thread and empty the playlist
         self.interrupt()
+        self._drop_next_decoder()
+        self._drop_paused_decoder()
         var.playlist.clear()
         self.wait_for_ready = False
+        self.interrupt_handled()
+        self.wake("clear")
         self.log.info("bot: music stopped. playlist trashed.")
 
     def stop(self):
         self.interrupt()
+        self._drop_paused_decoder()
         self.is_pause = True
         if len(var.playlist) > 0:
             self.wait_for_ready = True
         else:
             self.wait_for_ready = False
+        self.interrupt_handled()
+        self.wake("stop")
         self.log.info("bot: music stopped.")
 
     def interrupt(self):
-        # Kill the ffmpeg thread
-        if self.thread:
+        # Kill the ffmpeg thread. The caller then sets what comes next, and calls interrupt_handled().
+        if self.decoder:
+            self._interrupt_handled.clear()
+            self._interrupted.clear()
             self.on_interrupting = True
+            self.wake("interrupt")
 
-            time.sleep(0.1)
-            self.song_start_at = -1
+            # wait for the loop to fade out and kill the decoder
+            self._interrupted.wait(0.1)
             self.read_pcm_size = 0
 
+    def interrupt_handled(self):
+        # The state that follows interrupt() is set, the loop may go on
+        self._interrupt_handled.set()
+
     def pause(self):
-        # Kill the ffmpeg thread
+        # Fade out and keep the decoder, unless it is a live stream
+        if self.decoder and var.playlist.current_item() and var.playlist.current_item().type != 'radio':
+            self.hold_decoder = True
         self.interrupt()
         self.is_pause = True
-        self.song_start_at = -1
+        self.interrupt_handled()
+        self.wake("pause")
         if len(var.playlist) > 0:
             self.pause_at_id = var.playlist.current_item().id
-            self.log.info(f"bot: music paused at {self.playhead:.2f} seconds.")
+            self.log.info(f"bot: music paused at {self.position():.2f} seconds.")
 
     def resume(self):
-        self.is_pause = False
         if var.playlist.current_index == -1:
             var.playlist.next()
             self.playhead = 0
-            return
-
-        music_wrapper = var.playlist.current_item()
-
-        if not music_wrapper or not music_wrapper.id == self.pause_at_id or not music_wrapper.is_ready():
-            self.playhead = 0
-            return
+        else:
+            music_wrapper = var.playlist.current_item()
+
+            if not music_wrapper or not music_wrapper.id == self.pause_at_id or not music_wrapper.is_ready():
+                self.playhead = 0
+                self._drop_paused_decoder()
+            elif self.paused_decoder and self.paused_decoder_item is music_wrapper:
+                # the decoder is still where the song was paused, once the frames it didn't get to play are
+                self.log.info(f"bot: music resumed at {self.position():.2f} seconds.")
+                self.replay_pcm = memoryview(self.paused_pcm)
+                # the song comes back the way it starts
+                self.fade_in = True
+                self.read_pcm_size = self.paused_decoder.consumed() - len(self.paused_pcm)
+                self.telemetry.resumed()
+                self.decoder = self.paused_decoder
+                self._follow_song(music_wrapper)
+                self.paused_decoder = None
+                self.paused_decoder_item = None
+                self.paused_pcm = b''
+                self.pause_at_id = ""
+            else:
+                self.wait_for_ready = True
+                self.pause_at_id = ""
 
-        self.wait_for_ready = True
-        self.pause_at_id = ""
+        # last, the loop may go on as soon as it sees it
+        self.is_pause = False
+        self.wake("resume")
 
 
 if __name__ == '__main__':
@@ -814,3 +1271,6 @@ if __name__ == '__main__':
 
     # Start the main loop.
     var.bot.loop()
+
+    var.db.close()
+    var.music_db.close()
@@ -0,0 +1,25 @@
+import sys
+
+from audio.decoder import Decoder
+
+# Stands in for ffmpeg, whose input is raw PCM already: copies it to stdout, from -ss for -t seconds
+SCRIPT = """
+import sys
+args = sys.argv[1:]
+option = lambda name, fallback: args[args.index(name) + 1] if name in args else fallback
+to_bytes = lambda seconds: int(float(seconds) * 48000) * 2 * int(option('-ac', '1'))
+start = to_bytes(option('-ss', 0))
+with open(option('-i', None), 'rb') as file:
+    pcm = file.read()[start:]
+if '-t' in args:
+    pcm = pcm[:to_bytes(option('-t', 0))]
+for i in range(0, len(pcm), 4096):
+    sys.stdout.buffer.write(pcm[i:i + 4096])
+"""
+
+
+class RawDecoder(Decoder):
+    # the Decoder, with ffmpeg replaced by SCRIPT
+
+    def command(self):
+        return (sys.executable, '-c', SCRIPT) + super().command()[1:]
@@ -0,0 +1,284 @@
+import array
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+import pytest
+
+try:
+    import mumbleBot
+except Exception as e:  # pymumble needs the opus library of the system
+    pytest.skip(f"the bot can't be imported: {e}", allow_module_level=True)
+import util
+import variables as var
+from audio.mixer import CrossfadeMixer
+from audio.pcm import frame_size, bytes_to_seconds, seconds_to_bytes
+from benchmark.fake_mumble import setup_environment, create_bot
+from media.cache import get_cached_wrapper_from_scrap
+from tests.fake_ffmpeg import RawDecoder
+
+CHANNELS = 2
+FRAME = frame_size(CHANNELS)
+
+
+def song_pcm(seconds, seed):
+    # no two frames alike, so that any piece of the output tells where it comes from
+    generator = random.Random(seed)
+    values = array.array('h', (generator.randrange(-10000, 10000)
+                               for i in range(seconds_to_bytes(seconds, CHANNELS) // 2)))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+class SoundOutput:
+    # pymumble's sound output, playing in real time what it is given and keeping every byte played
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = bytearray()
+        self.played = bytearray()
+        self.flushed = 0
+        self.last_drain = time.monotonic()
+
+    def _drain(self):
+        now = time.monotonic()
+        size = min(len(self.queue), seconds_to_bytes(now - self.last_drain, CHANNELS))
+        self.played += self.queue[:size]
+        del self.queue[:size]
+        self.last_drain = self.last_drain + bytes_to_seconds(size, CHANNELS) if self.queue else now
+
+    def add_sound(self, pcm):
+        assert type(pcm) is bytes
+        with self.lock:
+            self._drain()
+            self.queue += pcm
+
+    def get_buffer_size(self):
+        with self.lock:
+            self._drain()
+            return bytes_to_seconds(len(self.queue), CHANNELS)
+
+    def clear_buffer(self):
+        # without playing anything more, what is dropped is what get_buffer_size() told
+        with self.lock:
+            self.flushed += len(self.queue)
+            self.queue.clear()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.002)
+
+
+@pytest.fixture
+def start_bot(monkeypatch):
+    # start_bot(option=value, ...) runs a bot, whose songs are added with bot.add_song(seconds)
+    monkeypatch.setattr(util, 'get_media_duration', lambda path: bytes_to_seconds(os.path.getsize(path), CHANNELS))
+    monkeypatch.setattr(mumbleBot, 'Decoder', RawDecoder)
+    started = []
+
+    def start(**options):
+        defaults = {'output_buffer_min': 0.1, 'output_buffer_max': 0.2}
+        folder = setup_environment({('bot', name): value for name, value in dict(defaults, **options).items()})
+        var.config.set('debug', 'loop_watchdog', '0')
+        bot = create_bot()
+        bot.mumble.sound_output = output = SoundOutput()
+        # the songs aren't changed by the volume
+        bot.volume_helper.volume_set = bot.volume_helper.real_volume = 1.0
+        bot.songs = []
+
+        def add_song(seconds, **attributes):
+            name = f"song{len(bot.songs)}.pcm"
+            pcm = song_pcm(seconds, len(bot.songs))
+            with open(os.path.join(var.music_folder, name), 'wb') as file:
+                file.write(pcm)
+            music_wrapper = get_cached_wrapper_from_scrap(type='file', path=name, user="test")
+            for attribute, value in attributes.items():
+                setattr(music_wrapper.item(), attribute, value)
+            bot.songs.append(pcm)
+            var.playlist.append(music_wrapper)
+            bot.wake("playlist")
+            return pcm
+
+        bot.add_song = add_song
+        thread = threading.Thread(target=bot.loop, daemon=True)
+        thread.start()
+        started.append((bot, thread, folder))
+        return bot, output
+
+    yield start
+
+    for bot, thread, folder in started:
+        bot.exit = True
+        bot.wake("exit")
+        thread.join(5)
+        var.db.close()
+        var.music_db.close()
+        shutil.rmtree(folder)
+
+
+def finished(bot, output):
+    return bot.decoder is None and not bot.wait_for_ready and not output.queue
+
+
+def test_pause_and_resume(start_bot):
+    bot, output = start_bot()
+    song = bot.add_song(1)
+    wait_until(lambda: len(output.played) > len(song) // 3)
+    bot.pause()
+    wait_until(lambda: bot.paused_decoder is not None and not output.queue)
+
+    # what was heard after the first frame, which fades in, then the frame that was fading out followed
+    # by a frame of silence
+    heard = len(output.played) - 2 * FRAME
+    assert output.played[FRAME:heard] == song[FRAME:heard]
+    # the song resumes from the beginning of the frame pymumble was playing
+    resume_at = heard - heard % FRAME
+    assert bot.position() == pytest.approx(bytes_to_seconds(resume_at, CHANNELS))
+
+    time.sleep(0.3)
+    paused_decoder = bot.paused_decoder
+    bot.resume()
+    wait_until(lambda: finished(bot, output))
+    assert bot.decoder is None and paused_decoder.is_finished()
+    # the first frame fades in, then the song goes on without a gap
+    assert len(output.played) == heard + 2 * FRAME + len(song) - resume_at
+    assert output.played[heard + 3 * FRAME:] == song[resume_at + FRAME:]
+
+    # the pause isn't an underrun
+    assert bot.telemetry.late_frames == 0
+    assert all(reason != "underrun" for _, _, _, reason in bot.buffering.decisions)
+
+
+def test_trimmed_song_in_pcm_cache(start_bot):
+    bot, output = start_bot(silence_trimming=True, pcm_cache=True)
+
+    def play(add):
+        start = len(output.played)
+        add()
+        wait_until(lambda: finished(bot, output))
+        return output.played[start:]
+
+    def replay():
+        music_wrapper = get_cached_wrapper_from_scrap(type='file', path="song0.pcm", user="test")
+        music_wrapper.item().trim_start, music_wrapper.item().trim_end = 0.2, 0.7
+        var.playlist.append(music_wrapper)
+        bot.wake("playlist")
+
+    played = play(lambda: bot.add_song(1, trim_start=0.2, trim_end=0.7))
+    song = bot.songs[0]
+    trimmed = song[seconds_to_bytes(0.2, CHANNELS):seconds_to_bytes(0.7, CHANNELS)]
+    # the first frame fades in, the last one fades out and is followed by a frame of silence
+    assert len(played) == len(trimmed) + FRAME
+    assert played[FRAME:-2 * FRAME] == trimmed[FRAME:-FRAME]
+
+    # the second time, the whole song is recorded while its trimmed part is played
+    assert play(replay) == played
+    key = bot.pcm_cache.key(get_cached_wrapper_from_scrap(type='file', path="song0.pcm", user="test").item())
+    wait_until(lambda: key in bot.pcm_cache.files)
+    assert open(bot.pcm_cache.path(key), 'rb').read() == song
+
+    # then played from the cache, trimmed the same way
+    hits = bot.pcm_cache.hits
+    assert play(replay) == played
+    assert bot.pcm_cache.hits == hits + 1
+
+
+def test_gapless(start_bot):
+    bot, output = start_bot(gapless=True)
+    first = bot.add_song(0.5)
+    second = bot.add_song(0.5)
+    wait_until(lambda: finished(bot, output) and len(var.playlist) == 0)
+
+    # the second song starts right after the last sample of the first one, without a fade
+    assert len(output.played) == len(first) + len(second)
+    assert output.played[FRAME:len(first)] == first[FRAME:]
+    assert output.played[len(first):] == second
+
+
+def test_crossfade(start_bot):
+    bot, output = start_bot(crossfade=0.2)
+    first = bot.add_song(1)
+    second = bot.add_song(1)
+    wait_until(lambda: finished(bot, output) and len(var.playlist) == 0)
+
+    # the second song starts under the last 200 ms of the first one
+    overlap = seconds_to_bytes(0.2, CHANNELS)
+    start = len(first) - overlap
+    assert len(output.played) == len(first) + len(second) - overlap
+    assert output.played[FRAME:start] == first[FRAME:start]
+    mixer = CrossfadeMixer(CHANNELS, 0.2)
+    mixed = b''.join(bytes(mixer.mix(first[i:i + FRAME], second[i - start:i - start + FRAME]))
+                     for i in range(start, len(first), FRAME))
+    assert output.played[start:len(first)] == mixed
+    assert output.played[len(first):] == second[overlap:]
+
+
+def paused_position(bot, output, song, start, offset=0):
+    # Pause, and return where the song will resume: the song was heard from offset, output.played[start:]
+    bot.pause()
+    wait_until(lambda: bot.paused_decoder is not None and not output.queue)
+    # the frame fading out, then a frame of silence
+    heard = offset + len(output.played) - 2 * FRAME - start
+    resume_at = heard - heard % FRAME
+    assert output.played[start + FRAME:len(output.played) - 2 * FRAME] == song[offset + FRAME:heard]
+    return resume_at
+
+
+def test_seek(start_bot):
+    bot, output = start_bot()
+    song = bot.add_song(1)
+    wait_until(lambda: len(output.played) > len(song) // 5)
+    bot.play(start_at=0.5)
+    offset = seconds_to_bytes(0.5, CHANNELS)
+    # where the song was heard again from 0.5 s, after the first frame which fades in
+    wait_until(lambda: output.played.find(song[offset + FRAME:offset + 2 * FRAME]) > 0)
+    start = output.played.find(song[offset + FRAME:offset + 2 * FRAME]) - FRAME
+
+    wait_until(lambda: len(output.played) > start + len(song) // 5)
+    resume_at = paused_position(bot, output, song, start, offset)
+    assert bot.position() == pytest.approx(bytes_to_seconds(resume_at, CHANNELS))
+
+    bot.resume()
+    wait_until(lambda: finished(bot, output))
+    assert output.played.endswith(song[resume_at + FRAME:])
+
+
+def test_skip(start_bot):
+    bot, output = start_bot()
+    first = bot.add_song(1)
+    second = bot.add_song(1)
+    wait_until(lambda: len(output.played) > len(first) // 5)
+    # as !skip does
+    bot.interrupt()
+    bot.interrupt_handled()
+    wait_until(lambda: output.played.find(second[FRAME:2 * FRAME]) > 0)
+    start = output.played.find(second[FRAME:2 * FRAME]) - FRAME
+
+    # the playhead counts from the start of the next song
+    wait_until(lambda: len(output.played) > start + len(second) // 5)
+    resume_at = paused_position(bot, output, second, start)
+    assert bot.position() == pytest.approx(bytes_to_seconds(resume_at, CHANNELS))
+    bot.resume()
+    wait_until(lambda: finished(bot, output))
+    assert output.played.endswith(second[resume_at + FRAME:])
+
+
+def test_frames_remembered_for_a_pause(start_bot):
+    bot, output = start_bot()
+    block = bytearray(FRAME)
+    frame = bytes(FRAME)
+    replayed = memoryview(bytes(2 * FRAME))[FRAME:]
+    for pcm in (memoryview(block), frame, replayed):
+        bot._remember_sent(pcm)
+    # the block of the decoder is reused, the others are kept without a copy
+    block[:] = b'x' * FRAME
+    assert bot.sent_frames[0] == bytes(FRAME)
+    assert bot.sent_frames[1] is frame and bot.sent_frames[2] is replayed
+    assert bot._sent_tail(3 * FRAME) == bytes(3 * FRAME)
@@ -0,0 +1,112 @@
+import threading
+
+from audio.buffer import PCMRingBuffer
+
+
+def test_write_and_read_whole_frames():
+    buffer = PCMRingBuffer(4, 4)
+    assert buffer.write(b'abcdefghij')
+    out = bytearray(16)
+    # only whole frames while the stream goes on
+    assert buffer.read_into(out) == 8
+    assert out[:8] == b'abcdefgh'
+    assert buffer.available() == 2
+
+
+def test_wraps_around():
+    buffer = PCMRingBuffer(4, 3)
+    out = bytearray(8)
+    buffer.write(b'aaaabbbb')
+    assert buffer.read_into(out) == 8
+    buffer.write(b'ccccdddd')  # 'dddd' goes to the beginning of the memory
+    assert buffer.read_into(out) == 8
+    assert out == b'ccccdddd'
+    assert buffer.stats()['bytes_read'] == 16
+
+
+def test_last_frame_may_be_short():
+    buffer = PCMRingBuffer(4, 4)
+    buffer.write(b'abcdef')
+    buffer.close()
+    out = bytearray(16)
+    assert buffer.read_into(out) == 6
+    assert out[:6] == b'abcdef'
+    assert buffer.read_into(out) == 0
+    assert buffer.is_drained()
+
+
+def test_starving_counts_underruns_once_started():
+    buffer = PCMRingBuffer(4, 4)
+    out = bytearray(4)
+    assert buffer.read_into(out) is None
+    assert buffer.underruns == 0
+    buffer.write(b'abcd')
+    buffer.read_into(out)
+    assert buffer.read_into(out) is None
+    assert buffer.underruns == 1
+
+
+def test_listener_called_when_a_frame_is_ready():
+    buffer = PCMRingBuffer(4, 4)
+    calls = []
+    buffer.listener = lambda: calls.append(buffer.available())
+    buffer.write(b'ab')
+    assert calls == []
+    buffer.write(b'cd')
+    assert calls == [4]
+    buffer.write(b'efgh')  # not starving, nobody to wake up
+    assert calls == [4]
+    buffer.close()
+    assert len(calls) == 2
+
+
+def test_full_buffer_blocks_the_producer():
+    buffer = PCMRingBuffer(4, 2)
+    written = threading.Event()
+    thread = threading.Thread(target=lambda: buffer.write(b'x' * 12) and written.set())
+    thread.start()
+    assert not written.wait(0.05)
+    assert buffer.overruns == 1
+    buffer.read_into(bytearray(8))
+    assert written.wait(1)
+    thread.join()
+
+
+
+def test_write_nowait_drops_what_doesnt_fit():
+    buffer = PCMRingBuffer(4, 2)
+    assert buffer.write_nowait(b'abcd') == 4
+    # only whole frames: the rest of the data is dropped
+    assert buffer.write_nowait(b'efghij') == 4
+    assert buffer.overruns == 1
+    assert buffer.write_nowait(b'klmn') == 0
+    assert buffer.overruns == 2
+    out = bytearray(8)
+    assert buffer.read_into(out) == 8
+    assert out == b'abcdefgh'
+    buffer.abort()
+    assert buffer.write_nowait(b'abcd') == 0
+
+def test_abort_releases_the_producer():
+    buffer = PCMRingBuffer(4, 1)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(buffer.write(b'x' * 8)))
+    thread.start()
+    buffer.abort()
+    thread.join(1)
+    assert result == [False]
+
+
+def test_write_from():
+    buffer = PCMRingBuffer(4, 2)
+
+    def readinto(view):
+        view[:] = b'z' * len(view)
+        return len(view)
+
+    assert buffer.write_from(readinto, 100) == 8
+    assert buffer.available() == 8
+    assert not buffer.wait_for_space(4, 0.01)
+    buffer.read_into(bytearray(4))
+    assert buffer.wait_for_space(4, 0.01)
+    assert buffer.write_from(lambda view: 0, 4) == 0
@@ -0,0 +1,84 @@
+import time
+import types
+
+import pytest
+
+import audio.buffering
+from audio.buffering import BufferTarget, JITTER_HEADROOM, LOWER_STEP, RAISE_STEP, STEADY_PERIOD
+from audio.pcm import FRAME_DURATION
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the monotonic clock of BufferTarget, moved by the tests: clock.now += seconds
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(audio.buffering, 'time', types.SimpleNamespace(
+        monotonic=lambda: clock.now, time=time.time, strftime=time.strftime, localtime=time.localtime))
+    return clock
+
+
+def test_initial_target_within_bounds():
+    assert BufferTarget(0.1, 1.0, initial=5).target == 1.0
+    assert BufferTarget(0.1, 1.0, initial=0).target == 0.1
+    # a maximum under the minimum is the minimum
+    assert BufferTarget(0.3, 0.2).target == 0.3
+
+
+def test_underrun_raises_the_target(clock):
+    buffering = BufferTarget(0.1, 1.0, initial=0.2)
+    buffering.underrun()
+    assert buffering.target == pytest.approx(0.2 * (1 + RAISE_STEP) + FRAME_DURATION)
+    assert buffering.raised == 1
+    assert buffering.decisions[-1][1:] == (0.2, buffering.target, "underrun")
+
+
+def test_target_stays_under_the_maximum(clock):
+    buffering = BufferTarget(0.1, 0.5, initial=0.2)
+    for _ in range(10):
+        buffering.underrun()
+    assert buffering.target == 0.5
+    # reaching it is one more change, staying there isn't
+    assert buffering.raised == 3
+
+
+def test_late_wake_up_raises_the_target(clock):
+    buffering = BufferTarget(0.1, 1.0, initial=0.1)
+    buffering.woke(0.05)
+    assert buffering.target == pytest.approx(JITTER_HEADROOM * 0.05 + 2 * FRAME_DURATION)
+    assert buffering.decisions[-1][3] == "wakes up 50 ms late"
+
+
+def test_target_decays_to_the_floor(clock):
+    buffering = BufferTarget(0.1, 1.0, initial=0.8)
+    # nothing changes before STEADY_PERIOD
+    buffering.woke(0.001)
+    assert buffering.target == 0.8
+
+    targets = []
+    for _ in range(20):
+        clock.now += STEADY_PERIOD + 0.1
+        buffering.woke(0.001)
+        targets.append(buffering.target)
+    assert targets[0] == pytest.approx(0.8 * (1 - LOWER_STEP))
+    assert targets == sorted(targets, reverse=True)
+    assert targets[-1] == 0.1 and buffering.decisions[-1][3] == "steady"
+
+
+def test_target_decays_to_what_the_oversleeps_need(clock):
+    buffering = BufferTarget(0.05, 1.0, initial=0.8)
+    buffering.woke(0.04)
+    needed = JITTER_HEADROOM * 0.04 + 2 * FRAME_DURATION
+    for _ in range(20):
+        clock.now += STEADY_PERIOD + 0.1
+        buffering.woke(0.001)
+    assert buffering.target == pytest.approx(needed)
+
+
+def test_underrun_resets_the_steady_period(clock):
+    buffering = BufferTarget(0.1, 1.0, initial=0.2)
+    clock.now += STEADY_PERIOD - 0.5
+    buffering.underrun()
+    target = buffering.target
+    clock.now += 1.0
+    buffering.woke(0.001)
+    assert buffering.target == target
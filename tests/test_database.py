@@ -0,0 +1,267 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+import database
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration, Condition
+
+
+def song(i, tags=()):
+    return {'id': f"{i:032x}", 'type': 'file', 'title': f"Song {i}", 'artist': f"Artist {i % 5}",
+            'keywords': f"Song {i} Artist {i % 5}", 'tags': list(tags), 'path': f"artist {i % 5}/song {i}.mp3",
+            'duration': 180}
+
+
+def v4_database(path, songs):
+    # a music database as the bot left it before the full-text index
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE music (id TEXT PRIMARY KEY, type TEXT, title TEXT, keywords TEXT, metadata TEXT, "
+                 "tags TEXT, path TEXT, create_at DATETIME DEFAULT CURRENT_TIMESTAMP)")
+    conn.execute("INSERT INTO music (id, title) VALUES ('info', '4')")
+    for music_dict in songs:
+        metadata = {'artist': music_dict['artist'], 'duration': music_dict['duration']}
+        conn.execute("INSERT INTO music (id, type, title, keywords, metadata, tags, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (music_dict['id'], music_dict['type'], music_dict['title'], music_dict['keywords'],
+                      json.dumps(metadata), "".join(tag + "," for tag in music_dict['tags']), music_dict['path']))
+    conn.commit()
+    conn.close()
+
+
+def migrated(tmp_path, songs):
+    v4_database(str(tmp_path / "music.db"), songs)
+    settings_db = SettingsDatabase(str(tmp_path / "settings.db"))
+    music_db = MusicDatabase(str(tmp_path / "music.db"))
+    DatabaseMigration(settings_db, music_db).migrate()
+    settings_db.close()
+    return music_db
+
+
+def titles(results):
+    return [result['title'] for result in results]
+
+
+@pytest.fixture
+def music_db(tmp_path):
+    settings_db = SettingsDatabase(str(tmp_path / "settings.db"))
+    music_db = MusicDatabase(str(tmp_path / "music.db"))
+    DatabaseMigration(settings_db, music_db).migrate()
+    yield music_db
+    settings_db.close()
+    music_db.close()
+
+
+def count_from_other_thread(music_db):
+    # what another connection of the pool sees
+    result = []
+    thread = threading.Thread(target=lambda: result.append(music_db.query_music_count(Condition())))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_batch_is_one_transaction(music_db):
+    before = count_from_other_thread(music_db)
+    with music_db.batch():
+        for i in range(10):
+            music_db.insert_music(song(i))
+        with music_db.batch():
+            music_db.insert_music(song(10))
+        assert count_from_other_thread(music_db) == before
+    assert count_from_other_thread(music_db) == before + 11
+
+
+def test_batch_rolls_back_on_error(music_db):
+    with pytest.raises(sqlite3.OperationalError):
+        with music_db.batch():
+            music_db.insert_music(song(1))
+            music_db.pool.get().execute("SELECT * FROM no_such_table")
+    assert music_db.query_music_by_id(song(1)['id']) is None
+
+
+def test_failed_write_is_rolled_back(music_db):
+    with pytest.raises(sqlite3.Error):
+        # the second song can't be written, after the first one
+        music_db.insert_music_many([song(1), dict(song(2), title=object())])
+    assert music_db.query_music_by_id(song(1)['id']) is None
+
+    # the transaction is over, the other threads can write
+    thread = threading.Thread(target=lambda: music_db.insert_music(song(3)))
+    thread.start()
+    thread.join()
+    assert count_from_other_thread(music_db) == 1
+
+
+def test_database_in_memory_waits_for_transactions():
+    settings_db = SettingsDatabase(":memory:")
+    music_db = MusicDatabase(":memory:")
+    DatabaseMigration(settings_db, music_db).migrate()
+
+    results = []
+    reader = threading.Thread(target=lambda: results.append(music_db.query_music_by_id(song(1)['id'])))
+    with music_db.batch():
+        music_db.insert_music(song(1))
+        # the table is locked, the other connection waits instead of failing
+        reader.start()
+        reader.join(0.05)
+        assert reader.is_alive()
+    reader.join()
+    assert results[0]['title'] == "Song 1"
+
+    writers = [threading.Thread(target=music_db.insert_music, args=(song(i),)) for i in range(2, 10)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert music_db.query_music_count(Condition()) == 9
+    settings_db.close()
+    music_db.close()
+
+
+def test_migration_from_4_indexes_the_library(tmp_path):
+    music_db = migrated(tmp_path, [song(i) for i in range(20)])
+    conn = music_db.pool.get()
+    assert conn.execute("SELECT title FROM music WHERE id='info'").fetchone()[0] == '7'
+    assert conn.execute("SELECT COUNT(*) FROM music_fts").fetchone()[0] == 20
+    assert titles(music_db.query_music_by_keywords(["song", "13"])) == ["Song 13"]
+    # by artist too
+    assert len(music_db.query_music_by_keywords(["artist", "3"])) == 4
+    music_db.close()
+
+
+def test_search_matches_the_beginning_of_words(music_db):
+    for music_dict in [dict(song(1), title="Summer Nights"), dict(song(2), title="Indian Summer"),
+                       dict(song(3), title="Winter")]:
+        music_db.insert_music(music_dict)
+    assert sorted(titles(music_db.query_music_by_keywords(["summ"]))) == ["Indian Summer", "Summer Nights"]
+    assert titles(music_db.query_music_by_keywords(["sum", "nig"])) == ["Summer Nights"]
+    assert music_db.query_music_by_keywords(["ummer"]) == []
+    # not an FTS5 query
+    assert music_db.query_music_by_keywords(['"summer', 'OR']) == []
+
+
+def test_search_ranks_titles_first(music_db):
+    music_db.insert_music(dict(song(1), title="Something", artist="Moon Band", keywords="Something Moon Band"))
+    music_db.insert_music(dict(song(2), title="Moon River", keywords="Moon River"))
+    assert titles(music_db.query_music_by_keywords(["moon"])) == ["Moon River", "Something"]
+    assert titles(music_db.query_music_by_keywords(["moon"], limit=1)) == ["Moon River"]
+
+
+def test_search_follows_updates_and_deletes(music_db):
+    music_db.insert_music(song(1))
+    music_db.insert_music(dict(song(1), title="Renamed", keywords="Renamed", path="renamed.mp3"))
+    assert music_db.query_music_by_keywords(["song"]) == []
+    assert titles(music_db.query_music_by_keywords(["renamed"])) == ["Renamed"]
+    music_db.delete_music(Condition().and_equal('id', song(1)['id']))
+    assert music_db.query_music_by_keywords(["renamed"]) == []
+
+
+def test_search_after_vacuum(music_db):
+    music_db.insert_music_many([song(i) for i in range(10)])
+    music_db.delete_music(Condition().and_equal('title', "Song 2"))
+    # VACUUM renumbers the implicit rowids
+    music_db.pool.get().execute("VACUUM")
+    assert titles(music_db.query_music_by_keywords(["song", "7"])) == ["Song 7"]
+    music_db.insert_music(song(10))
+    assert titles(music_db.query_music_by_keywords(["song", "10"])) == ["Song 10"]
+
+
+def test_migration_from_6_indexes_the_library_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'MUSIC_DB_VERSION', 6)
+    music_db = migrated(tmp_path, [song(i, tags=["fav"] if i == 1 else ()) for i in range(5)])
+    conn = music_db.pool.get()
+    # a version 6 database whose rowids were renumbered by a VACUUM after the index was filled
+    conn.execute("UPDATE music_fts SET rowid = rowid + 100")
+    conn.commit()
+    assert music_db.query_music_by_keywords(["song", "3"]) == []
+
+    monkeypatch.undo()
+    settings_db = SettingsDatabase(str(tmp_path / "settings.db"))
+    DatabaseMigration(settings_db, music_db).migrate()
+    settings_db.close()
+    assert conn.execute("SELECT title FROM music WHERE id='info'").fetchone()[0] == '7'
+    assert titles(music_db.query_music_by_keywords(["song", "3"])) == ["Song 3"]
+    assert music_db.query_music_count(Condition()) == 5
+    assert len(music_db.query_music_by_tags(["fav"])) == 1
+    music_db.close()
+
+
+def test_search_without_index(music_db):
+    for i in range(3):
+        music_db.insert_music(song(i))
+    music_db.tables = {'music'}  # an sqlite without FTS5
+    assert titles(music_db.query_music_by_keywords(["song 1"])) == ["Song 1"]
+
+
+def test_migration_from_4_fills_the_tags(tmp_path):
+    songs = [song(1, ["rock"]), song(2, ["rock", "Live"]), song(3)]
+    music_db = migrated(tmp_path, songs)
+    assert music_db.query_tag_counts() == {"rock": 2, "Live": 1}
+    assert sorted(titles(music_db.query_music_by_tags(["rock"]))) == ["Song 1", "Song 2"]
+    music_db.close()
+
+
+def test_tags_follow_the_items(music_db):
+    music_db.insert_music(song(1, ["rock", "jazz"]))
+    music_db.insert_music(song(2, ["rock"]))
+    assert titles(music_db.query_music_by_tags(["ROCK", "jazz"])) == ["Song 1"]
+    assert titles(music_db.query_music(Condition().and_tag("rock").and_not_tag("jazz"))) == ["Song 2"]
+
+    music_db.insert_music(song(1, ["pop"]))
+    assert music_db.query_tag_counts() == {"pop": 1, "rock": 1}
+    music_db.delete_music(Condition().and_equal('id', song(2)['id']))
+    assert music_db.query_all_tags() == ["pop"]
+
+
+def test_recent_added_tag(music_db):
+    music_db.insert_music(song(1))
+    music_db.manage_special_tags()
+    assert titles(music_db.query_music_by_tags(["recent added"])) == ["Song 1"]
+    assert music_db.query_tags(Condition())[song(1)['id']] == ["recent added"]
+
+
+def test_recent_added_tag_is_removed_in_any_case(music_db):
+    music_db.insert_music(song(1, ["rock", "Recent Added"]))
+    conn = music_db.pool.get()
+    conn.execute("UPDATE music SET create_at=DATETIME('now', '-2 day')")
+    conn.commit()
+    music_db.manage_special_tags()
+    assert titles(music_db.query_music_by_tags(["recent added"])) == []
+    assert music_db.query_tags(Condition())[song(1)['id']] == ["rock"]
+
+
+def test_insert_music_many(music_db):
+    music_db.insert_music_many([song(i, ["rock"]) for i in range(1200)])
+    assert music_db.query_music_count(Condition()) == 1200
+    assert music_db.query_tag_counts() == {"rock": 1200}
+    assert titles(music_db.query_music_by_keywords(["song", "1199"])) == ["Song 1199"]
+    assert music_db.query_music_by_id(song(7)['id'])['artist'] == "Artist 2"
+
+
+def test_insert_music_many_updates(music_db):
+    music_db.insert_music(song(1, ["rock"]))
+    rowid = music_db.pool.get().execute("SELECT rowid FROM music WHERE id=?", (song(1)['id'],)).fetchone()
+    music_db.insert_music_many([dict(song(1, ["jazz", "jazz", ""]), title="Renamed", path="renamed.mp3"), song(2)])
+
+    # the row is updated in place, the index follows it
+    assert music_db.pool.get().execute("SELECT rowid FROM music WHERE id=?", (song(1)['id'],)).fetchone() == rowid
+    assert music_db.query_music_by_id(song(1)['id'])['tags'] == ["jazz"]
+    assert music_db.query_tag_counts() == {"jazz": 1}
+    assert titles(music_db.query_music_by_keywords(["renamed"])) == ["Renamed"]
+    assert music_db.query_music_count(Condition()) == 2
+
+
+def test_insert_music_many_last_dict_of_an_id_wins(music_db):
+    music_db.insert_music_many([song(1), dict(song(1), title="Second")])
+    assert titles(music_db.query_music(Condition())) == ["Second"]
+    assert music_db.pool.get().execute("SELECT COUNT(*) FROM music_fts").fetchone()[0] == 1
+
+
+def test_insert_music_many_in_a_batch(music_db):
+    with pytest.raises(RuntimeError):
+        with music_db.batch():
+            music_db.insert_music_many([song(1), song(2)])
+            raise RuntimeError()
+    assert music_db.query_music_count(Condition()) == 0
+    music_db.insert_music_many([])
@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+
+from audio.decoder import classify_error, ERROR_MISSING, ERROR_NETWORK, ERROR_UNKNOWN, ERROR_UNSUPPORTED
+from audio.pcm import seconds_to_bytes
+from tests.fake_ffmpeg import RawDecoder
+
+
+class Recording:
+    def __init__(self):
+        self.data = bytearray()
+        self.complete = None
+
+    def write(self, data):
+        self.data += data
+
+    def finish(self, complete):
+        self.complete = complete
+
+
+def song(tmp_path, seconds, channels=1):
+    pcm = os.urandom(seconds_to_bytes(seconds, channels))
+    path = tmp_path / "song.pcm"
+    path.write_bytes(pcm)
+    return str(path), pcm
+
+
+def read_all(decoder):
+    pcm = bytearray()
+    deadline = time.monotonic() + 5
+    while True:
+        frame = decoder.read()
+        if frame is None:
+            assert time.monotonic() < deadline, "timed out"
+            time.sleep(0.001)
+        elif not frame:
+            return bytes(pcm)
+        else:
+            pcm += frame
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_trimmed_by_ffmpeg(tmp_path):
+    path, pcm = song(tmp_path, 1)
+    decoder = RawDecoder(path, 1, start_from=0.25, end=0.75).start()
+    assert '-t' in decoder.command() and '-ss' in decoder.command()
+    assert read_all(decoder) == pcm[seconds_to_bytes(0.25, 1):seconds_to_bytes(0.75, 1)]
+
+
+def test_recording_gets_the_whole_song(tmp_path):
+    path, pcm = song(tmp_path, 1)
+    recording = Recording()
+    decoder = RawDecoder(path, 1, start_from=0.25, end=0.75, recording=recording).start()
+    assert '-t' not in decoder.command() and '-ss' not in decoder.command()
+
+    # the bot gets the same as without a recording
+    assert read_all(decoder) == pcm[seconds_to_bytes(0.25, 1):seconds_to_bytes(0.75, 1)]
+    decoder.kill()
+    wait_until(lambda: recording.complete is not None)
+    assert recording.complete
+    assert recording.data == pcm
+
+
+def test_recording_without_trimming(tmp_path):
+    path, pcm = song(tmp_path, 1)
+    recording = Recording()
+    decoder = RawDecoder(path, 1, recording=recording).start()
+    assert read_all(decoder) == pcm
+    wait_until(lambda: recording.complete is not None)
+    assert recording.complete and recording.data == pcm
+
+
+def test_recording_of_a_song_stopped_before_its_end(tmp_path):
+    path, pcm = song(tmp_path, 10, channels=2)
+    recording = Recording()
+    decoder = RawDecoder(path, 2, end=9, buffer_duration=0.1, recording=recording).start()
+    wait_until(decoder.read)
+    decoder.kill()
+    wait_until(lambda: recording.complete is not None)
+    assert not recording.complete
+
+
+# the last lines ffmpeg printed when it failed
+@pytest.mark.parametrize("stderr, kind", [
+    ("[https @ 0x55d0c5a4b2c0] HTTP error 404 Not Found\n"
+     "https://example.com/song.mp3: Server returned 404 Not Found", ERROR_MISSING),
+    ("/music/gone.flac: No such file or directory", ERROR_MISSING),
+    ("[tls @ 0x5581f4e1c880] Error in the pull function.\n"
+     "[https @ 0x5581f4e1a9c0] Connection reset by peer\n"
+     "https://example.com/stream: Connection reset by peer", ERROR_NETWORK),
+    ("[tcp @ 0x55c2b8e4a640] Connection to tcp://radio.example:8000 failed: Connection refused\n"
+     "http://radio.example:8000/live: Connection refused", ERROR_NETWORK),
+    ("[https @ 0x5623f2f4f300] HTTP error 503 Service Unavailable\n"
+     "https://example.com/song.mp3: Server returned 5XX Server Error reply", ERROR_NETWORK),
+    ("[mp3 @ 0x55f5a1ed2a40] Failed to read frame size: Could not seek to 1026.\n"
+     "/music/broken.mp3: Invalid argument", ERROR_UNSUPPORTED),
+    ("/music/cover.jpg.mp3: Invalid data found when processing input", ERROR_UNSUPPORTED),
+    ("[mov,mp4,m4a,3gp,3g2,mj2 @ 0x5632c8e0b5c0] moov atom not found\n"
+     "/music/cut.m4a: Invalid data found when processing input", ERROR_UNSUPPORTED),
+    ("Error while decoding stream #0:0: Invalid argument\nffmpeg exited with code 1", ERROR_UNKNOWN),
+    ("", ERROR_UNKNOWN),
+])
+def test_classify_error(stderr, kind):
+    assert classify_error(stderr) == kind
@@ -0,0 +1,122 @@
+import array
+import math
+import sys
+
+import pytest
+
+from audio.dsp import Compressor, DSPChain, Equalizer, Limiter, db_to_gain
+from audio.pcm import frame_size
+
+FRAME = frame_size(1)
+
+
+def pcm(values):
+    samples = array.array('h', values)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def samples(data):
+    values = array.array('h', bytes(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return list(values)
+
+
+def frames(data):
+    return [data[start:start + FRAME] for start in range(0, len(data), FRAME)]
+
+
+def process(stage, data, gain=1.0):
+    # frame by frame, like the bot does
+    return b''.join(bytes(stage.process(frame, gain)) for frame in frames(data))
+
+
+def test_flat_equalizer_only_delays():
+    eq = Equalizer(1)
+    data = pcm((i * 7919) % 20000 - 10000 for i in range(4 * FRAME // 2))
+    out = process(eq, data)
+    delay = eq.delay * 2
+    assert out[:delay] == bytes(delay)
+    # the tails carry over from one frame to the next
+    assert out[delay:] == data[:-delay]
+
+
+def test_equalizer_bass_and_treble():
+    eq = Equalizer(1, bass=6, treble=-6)
+    # constant: only bass, alternating: only treble
+    low = samples(process(eq, pcm([1000] * (4 * FRAME // 2))))
+    assert low[-1] == pytest.approx(1000 * db_to_gain(6), abs=2)
+    eq.reset()
+    high = samples(process(eq, pcm([1000, -1000] * (2 * FRAME // 2))))
+    assert abs(high[-1]) == pytest.approx(1000 * db_to_gain(-6), abs=2)
+
+
+def test_quiet_songs_go_through_the_compressor():
+    compressor = Compressor(1, threshold=-20)
+    data = pcm([100, -100] * (2 * FRAME // 2))
+    assert process(compressor, data) == data
+    assert compressor.reduction == 0
+
+
+def test_compressor_reduction_carries_over():
+    compressor = Compressor(1, threshold=-20, ratio=4, attack=0.01, release=0.2)
+    loud = pcm([20000, -20000] * (FRAME // 2))
+    levels = [max(samples(compressor.process(loud, 1.0))) for _ in range(20)]
+    # the gain goes down over the attack, across frames, until the level above -20 dBFS is divided by 4
+    assert levels == sorted(levels, reverse=True) and levels[0] > levels[-1]
+    over = 20 * math.log10(20000 / 32767) + 20
+    assert levels[-1] == pytest.approx(32767 * db_to_gain(-20 + over / 4), rel=0.01)
+
+    # then comes back up over the release
+    reduction = compressor.reduction
+    compressor.process(pcm([0] * (FRAME // 2)), 1.0)
+    assert 0 < compressor.reduction < reduction
+    compressor.reset()
+    assert compressor.reduction == 0
+
+
+def test_compressor_makeup():
+    compressor = Compressor(1, threshold=-20, makeup=6)
+    out = samples(compressor.process(pcm([100] * (FRAME // 2)), 1.0))
+    assert out[-1] == pytest.approx(100 * db_to_gain(6), abs=1)
+
+
+def test_limiter_leaves_what_doesnt_clip():
+    limiter = Limiter(1, ceiling=-1)
+    data = pcm([10000] * (FRAME // 2))
+    assert limiter.process(data, 2.0) is data
+    # three times louder, it would clip
+    out = samples(limiter.process(data, 3.0))
+    assert max(out) * 3.0 <= 32767 * db_to_gain(-1) + 3
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+    def process(self, pcm, gain):
+        return bytes(pcm) + self.name.encode()
+
+
+def test_chain_applies_the_stages_in_order():
+    stages = [Stage("a"), Stage("b")]
+    chain = DSPChain(stages, 1)
+    assert chain.process(b'x', 0.5) == b'xab'
+    assert chain.processed == 1
+    chain.reset()
+    assert [stage.resets for stage in stages] == [1, 1]
+    assert [line.split(":")[0] for line in chain.report()] == ["a", "b"]
+
+
+def test_flat_chain_keeps_the_song():
+    chain = DSPChain([Equalizer(1), Compressor(1, threshold=0, makeup=0)], 1)
+    data = pcm((i * 7919) % 2000 - 1000 for i in range(3 * FRAME // 2))
+    out = process(chain, data)
+    delay = chain.stages[0].delay * 2
+    assert out[delay:] == data[:-delay]
@@ -0,0 +1,39 @@
+import array
+import sys
+
+from audio.ducking import DuckingDetector
+
+
+def pcm_of(value, count=480):
+    values = array.array('h', [value, -value] * (count // 2))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def test_loud_user_triggers_ducking():
+    detector = DuckingDetector(threshold=3000, release=1.0)
+    detector._measure("alice", pcm_of(1000), 100.0)
+    assert not detector.is_ducking(100.0)
+    detector._measure("alice", pcm_of(10000), 100.02)
+    assert detector.is_ducking(100.02)
+    # released one second after the last loud packet
+    assert detector.is_ducking(100.9)
+    assert not detector.is_ducking(101.1)
+
+
+def test_threshold_of_a_user():
+    detector = DuckingDetector(threshold=3000)
+    detector.thresholds["bob"] = 20000
+    detector._measure("bob", pcm_of(10000), 100.0)
+    assert not detector.is_ducking(100.0)
+    detector._measure("alice", pcm_of(10000), 100.0)
+    assert detector.is_ducking(100.0)
+
+
+def test_attack():
+    detector = DuckingDetector(threshold=3000, attack=0.05)
+    detector._measure("alice", pcm_of(10000), 100.0)
+    assert not detector.is_ducking(100.0)
+    detector._measure("alice", pcm_of(10000), 100.06)
+    assert detector.is_ducking(100.06)
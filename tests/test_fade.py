@@ -0,0 +1,66 @@
+import array
+import math
+import sys
+
+import pytest
+
+from audio.fade import Fader, FADE_IN, FADE_OUT, FADE_TOLERANCE, fade_curves
+from audio.pcm import frame_size
+
+
+def samples(pcm):
+    values = array.array('h', bytes(pcm))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pcm_of(values):
+    values = array.array('h', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def sine(channels):
+    return pcm_of(int(30000 * math.sin(i // channels / 10)) for i in range(frame_size(channels) // 2))
+
+
+def per_sample(pcm, channels, shape, direction):
+    # the gain of every frame taken from the curve, like the fade before the engine
+    values = samples(pcm)
+    gains = fade_curves[shape](len(values) // channels)
+    if direction == FADE_IN:
+        gains.reverse()
+    return [round(value * gains[i // channels]) for i, value in enumerate(values)]
+
+
+@pytest.mark.parametrize('shape', sorted(fade_curves))
+@pytest.mark.parametrize('direction', [FADE_IN, FADE_OUT])
+@pytest.mark.parametrize('channels', [1, 2])
+def test_fade_is_within_tolerance(shape, direction, channels):
+    pcm = sine(channels)
+    faded = samples(Fader(shape).apply(pcm, channels, direction, pad=False))
+    expected = per_sample(pcm, channels, shape, direction)
+    assert max(abs(a - b) for a, b in zip(faded, expected)) <= FADE_TOLERANCE * 32768 + 1
+
+
+def test_fade_out_is_padded_with_silence():
+    pcm = sine(2)
+    faded = Fader().apply(pcm, 2, FADE_OUT)
+    assert len(faded) == 2 * len(pcm)
+    assert faded[len(pcm):] == bytes(len(pcm))
+    assert len(Fader().apply(pcm, 2, FADE_IN, pad=False)) == len(pcm)
+
+
+def test_partial_frame_is_dropped():
+    faded = Fader().apply(sine(2)[:-2], 2, FADE_OUT, pad=False)
+    assert len(faded) == frame_size(2) - 4
+
+
+def test_steps_are_short_where_the_curve_is_steep():
+    steps = Fader('exponential').curve(480, 1, FADE_OUT)
+    sizes = [end - start for (start, _), (end, _) in zip([(0, None)] + list(steps), steps)]
+    assert sizes[0] == 2  # one frame
+    assert sizes[-1] > 2
+    assert steps[-1][0] == 480 * 2
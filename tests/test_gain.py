@@ -0,0 +1,60 @@
+import array
+import sys
+
+from audio.gain import GainRamp
+from audio.pcm import frame_size
+
+
+def samples(pcm):
+    values = array.array('h', pcm)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pcm_of(values):
+    values = array.array('h', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def test_output_is_bytes():
+    # pymumble gives it to opuslib, which can't cast a bytearray
+    ramp = GainRamp(2)
+    pcm = pcm_of([1000] * (frame_size(2) // 2))
+    for gain in (0.5, 0.5, 0.8, 1.0, 1.0, 0.2):
+        assert type(ramp.apply(pcm, gain)) is bytes
+    assert type(ramp.apply(pcm[:100], 0.7)) is bytes
+    assert type(ramp.apply(bytearray(pcm), 1.0)) is bytes
+
+
+def test_output_not_reused():
+    ramp = GainRamp(1)
+    pcm = pcm_of([1000] * (frame_size(1) // 2))
+    ramp.apply(pcm, 1.0)
+    first = ramp.apply(pcm, 0.5)
+    copy = bytes(first)
+    ramp.apply(pcm, 0.1)
+    assert first == copy
+
+
+def test_constant_gain():
+    ramp = GainRamp(1)
+    pcm = pcm_of([1000] * (frame_size(1) // 2))
+    ramp.apply(pcm, 0.5)
+    assert set(samples(ramp.apply(pcm, 0.5))) == {500}
+    ramp = GainRamp(1)
+    ramp.apply(pcm, 1.0)
+    assert ramp.apply(pcm, 1.0) == pcm
+
+
+def test_ramp_goes_from_previous_to_new_gain():
+    ramp = GainRamp(1)
+    pcm = pcm_of([10000] * (frame_size(1) // 2))
+    ramp.apply(pcm, 1.0)
+    values = samples(ramp.apply(pcm, 0.5))
+    # monotonic from near the previous gain down to the new one, reached at the end of the frame
+    assert all(a >= b for a, b in zip(values, values[1:]))
+    assert values[0] < 10000 and values[0] > 9000
+    assert values[-1] == 5000
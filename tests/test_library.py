@@ -0,0 +1,70 @@
+import configparser
+import os
+import wave
+
+import pytest
+
+import util
+import variables as var
+from audio.pcm import SAMPLE_RATE, SAMPLE_WIDTH
+from database import SettingsDatabase, MusicDatabase, DatabaseMigration, Condition
+from media.cache import MusicCache
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    # an empty library in tmp_path/music/, its files are written by the tests
+    config = configparser.ConfigParser(interpolation=None, allow_no_value=True)
+    config.read(os.path.join(os.path.dirname(os.path.dirname(__file__)), "configuration.default.ini"),
+                encoding='utf-8')
+    monkeypatch.setattr(var, 'config', config)
+    monkeypatch.setattr(var, 'music_folder', str(tmp_path / "music") + "/")
+    monkeypatch.setattr(util, 'get_media_duration', lambda path: 1.0)
+    os.makedirs(var.music_folder)
+
+    settings_db = SettingsDatabase(str(tmp_path / "settings.db"))
+    music_db = MusicDatabase(str(tmp_path / "music.db"))
+    DatabaseMigration(settings_db, music_db).migrate()
+    yield MusicCache(music_db)
+    settings_db.close()
+    music_db.close()
+
+
+def write_song(path):
+    # a short silent wav, the scan only takes audio files
+    with wave.open(var.music_folder + path, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(SAMPLE_WIDTH)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes(bytes(SAMPLE_RATE // 10 * SAMPLE_WIDTH))
+
+
+def test_modified_file_is_reloaded(library):
+    write_song("song.wav")
+    library.build_dir_cache()
+    music_dict, = library.db.query_music(Condition().and_equal('path', "song.wav"))
+    assert music_dict['mtime'] == os.path.getmtime(var.music_folder + "song.wav")
+
+    os.utime(var.music_folder + "song.wav", (0, 1000))
+    library.build_dir_cache()
+    music_dict, = library.db.query_music(Condition().and_equal('path', "song.wav"))
+    assert music_dict['mtime'] == 1000
+
+
+def test_mtime_is_filled_for_items_saved_without_it(library):
+    write_song("song.wav")
+    library.build_dir_cache()
+    # as a version that didn't keep the mtime saved it
+    music_dict, = library.db.query_music(Condition().and_equal('path', "song.wav"))
+    del music_dict['mtime']
+    library.db.insert_music(music_dict)
+
+    library.build_dir_cache()
+    music_dict, = library.db.query_music(Condition().and_equal('path', "song.wav"))
+    assert music_dict['mtime'] == os.path.getmtime(var.music_folder + "song.wav")
+
+    # so that its next change is noticed
+    os.utime(var.music_folder + "song.wav", (0, 1000))
+    library.build_dir_cache()
+    music_dict, = library.db.query_music(Condition().and_equal('path', "song.wav"))
+    assert music_dict['mtime'] == 1000
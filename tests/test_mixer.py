@@ -0,0 +1,84 @@
+import array
+import math
+import sys
+
+import pytest
+
+from audio.fade import fade_curves
+from audio.mixer import CrossfadeMixer
+from audio.pcm import FRAME_DURATION, FRAME_SAMPLES, frame_size
+
+
+def samples(pcm):
+    values = array.array('h', bytes(pcm))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pcm_of(values):
+    values = array.array('h', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+@pytest.mark.parametrize('shape', sorted(fade_curves))
+@pytest.mark.parametrize('length', [FRAME_SAMPLES, 300, 37])
+def test_curves_fall_over_their_length(shape, length):
+    curve = fade_curves[shape](length)
+    assert len(curve) == length
+    assert curve[0] == 1
+    assert all(a >= b for a, b in zip(curve, curve[1:]))
+    assert curve[-1] < 0.03
+    # still there halfway
+    assert curve[length // 2] > 0.01
+
+
+def test_exponential_curve_of_a_frame_is_the_legacy_fade():
+    curve = fade_curves['exponential'](FRAME_SAMPLES)
+    assert curve == pytest.approx([math.exp(-x / 60) for x in range(FRAME_SAMPLES)])
+
+
+@pytest.mark.parametrize('shape', sorted(fade_curves))
+def test_crossfade_lasts_its_duration(shape):
+    duration = 3
+    mixer = CrossfadeMixer(1, duration, shape)
+    outgoing = pcm_of([10000] * (frame_size(1) // 2))
+    silence = bytes(frame_size(1))
+
+    levels = []
+    while not mixer.is_done():
+        levels.append(samples(mixer.mix(outgoing, silence))[0])
+    assert len(levels) == round(duration / FRAME_DURATION)
+    assert levels[0] == 10000
+    assert levels[len(levels) // 4] > 1000
+    assert levels[-1] < 100
+
+
+@pytest.mark.parametrize('shape', sorted(fade_curves))
+def test_crossfade_curve_follows_the_duration(shape):
+    short = CrossfadeMixer(1, 1, shape)
+    long = CrossfadeMixer(1, 3, shape)
+    for i in range(short.length):
+        assert short.fade_out[i] == pytest.approx(long.fade_out[3 * i])
+
+
+@pytest.mark.parametrize('shape', sorted(fade_curves))
+def test_crossfade_keeps_the_level(shape):
+    mixer = CrossfadeMixer(2, 1, shape)
+    pcm = pcm_of([8000, -8000] * (frame_size(2) // 4))
+    while not mixer.is_done():
+        mixed = samples(mixer.mix(pcm, pcm))
+        assert all(abs(a - b) <= 1 for a, b in zip(mixed, samples(pcm)))
+
+
+def test_short_outgoing_is_mixed_with_silence():
+    mixer = CrossfadeMixer(1, 1, 'linear')
+    incoming = pcm_of([1000] * (frame_size(1) // 2))
+    mixed = mixer.mix(pcm_of([1000] * 10), incoming)
+    assert len(mixed) == len(incoming)
+    values = samples(mixed)
+    assert values[0] == 1000
+    assert values[-1] == 0  # the incoming song starts from silence
+    assert len(mixer.mix(None, incoming)) == len(incoming)
@@ -0,0 +1,99 @@
+import io
+
+import pytest
+
+from audio.ogg import OggReader, opus_audio_packets, opus_head, opus_packet_samples
+
+SERIAL = 1234
+
+
+def page(lacing, body, continued=False, serial=SERIAL):
+    # an Ogg page, whose CRC isn't checked by OggReader
+    header = b"OggS" + bytes([0, 0x01 if continued else 0]) + bytes(8) + serial.to_bytes(4, 'little') \
+        + bytes(8) + bytes([len(lacing)])
+    return header + bytes(lacing) + body
+
+
+def packet_page(*packets, continued=False, serial=SERIAL):
+    # a page of whole packets: lacing values of 255 while a packet goes on, then the rest, maybe 0
+    lacing = []
+    for packet in packets:
+        lacing += [255] * (len(packet) // 255) + [len(packet) % 255]
+    return page(lacing, b''.join(packets), continued, serial)
+
+
+def packets(*pages):
+    return list(OggReader(io.BytesIO(b''.join(pages))).packets())
+
+
+def opus_packet(toc, size):
+    return bytes([toc]) + bytes(i % 251 for i in range(size - 1))
+
+
+def test_packets_of_a_page():
+    assert packets(packet_page(b'abc', b'', b'de')) == [b'abc', b'', b'de']
+
+
+@pytest.mark.parametrize("size", [254, 255, 256, 510, 600])
+def test_lacing_values_of_255(size):
+    # a packet of a multiple of 255 bytes ends with a lacing value of 0
+    packet = bytes(i % 251 for i in range(size))
+    assert packets(packet_page(packet, b'next')) == [packet, b'next']
+
+
+def test_packet_split_across_pages():
+    packet = bytes(i % 251 for i in range(700))
+    # 510 bytes on the first page, both lacing values 255: the packet goes on in the next page
+    first = page([255, 255], packet[:510])
+    second = page([190, 3], packet[510:] + b'end', continued=True)
+    assert packets(first, second) == [packet, b'end']
+
+
+def test_unfinished_packet_is_dropped_by_a_new_packet_page():
+    first = page([255], bytes(255))
+    assert packets(first, packet_page(b'new')) == [b'new']
+
+
+def test_other_logical_streams_are_ignored():
+    assert packets(packet_page(b'a'), packet_page(b'video', serial=99), packet_page(b'b')) == [b'a', b'b']
+
+
+def test_truncated_stream_ends():
+    data = packet_page(b'a') + packet_page(b'bcdef')[:-2]
+    assert packets(data) == [b'a']
+
+
+def test_not_ogg():
+    with pytest.raises(ValueError):
+        packets(b"RIFF" + bytes(40))
+
+
+def test_opus_stream():
+    head = b"OpusHead" + bytes([1, 2]) + (312).to_bytes(2, 'little') + (48000).to_bytes(4, 'little') + bytes(3)
+    # comment headers with a cover are several pages long
+    tags = b"OpusTags" + bytes(600)
+    audio = [opus_packet(0xfc, 120), opus_packet(0x79, 300), opus_packet(0xfc, 60)]
+    stream = packets(packet_page(head), page([255, 255], tags[:510]), page([98], tags[510:], continued=True),
+                     packet_page(*audio[:2]), packet_page(audio[2], b''))
+
+    reader = iter(stream)
+    assert opus_head(next(reader)) == (2, 312)
+    # the comment header, and the empty packet, aren't audio
+    assert list(opus_audio_packets(reader)) == [(audio[0], 960), (audio[1], 2 * 960), (audio[2], 960)]
+
+
+def test_opus_head():
+    assert opus_head(b"OpusTags" + bytes(20)) is None
+    assert opus_head(b"OpusHead" + bytes(5)) is None
+
+
+@pytest.mark.parametrize("packet, samples", [
+    (bytes([0xfc]), 960),  # CELT 20 ms, one frame
+    (bytes([0xf8 | 1]), 2 * 960),  # CELT 20 ms, two frames of the same size
+    (bytes([0x08 | 2]), 2 * 960),  # SILK 20 ms, two frames of different sizes
+    (bytes([0xe3, 0x04]), 4 * 120),  # CELT 2.5 ms, code 3 with 4 frames
+    (bytes([0x03]), 0),  # code 3 without its frame count
+    (b'', 0),
+])
+def test_opus_packet_samples(packet, samples):
+    assert opus_packet_samples(packet) == samples
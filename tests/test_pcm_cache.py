@@ -0,0 +1,94 @@
+import os
+import types
+
+from audio.pcm_cache import PCMCache, ADMIT_AFTER
+
+
+def song(id, duration=1):
+    return types.SimpleNamespace(id=id, type='url', duration=duration)
+
+
+def record(cache, item, data):
+    recording = cache.recording(item)
+    assert recording
+    recording.write(data)
+    recording.finish(True)
+
+
+def test_admitted_after_being_seen(tmp_path):
+    cache = PCMCache(str(tmp_path), channels=1)
+    item = song("a")
+    for _ in range(ADMIT_AFTER - 1):
+        assert cache.lookup(item) is None
+        assert cache.recording(item) is None
+    assert cache.lookup(item) is None
+    record(cache, item, b'x' * 100)
+
+    path = cache.lookup(item)
+    assert path and open(path, 'rb').read() == b'x' * 100
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == ADMIT_AFTER
+
+
+def test_one_recording_at_a_time(tmp_path):
+    cache = PCMCache(str(tmp_path), channels=1)
+    item = song("a")
+    for _ in range(ADMIT_AFTER):
+        cache.lookup(item)
+    recording = cache.recording(item)
+    assert cache.recording(item) is None
+    recording.finish(False)
+    assert not os.listdir(tmp_path)
+    assert cache.lookup(item) is None
+    assert cache.recording(item)
+
+
+def test_least_recently_played_evicted(tmp_path):
+    cache = PCMCache(str(tmp_path), max_size=250, channels=1)
+    items = [song(id, duration=None) for id in "abc"]
+    for item in items[:2]:
+        for _ in range(ADMIT_AFTER):
+            cache.lookup(item)
+        record(cache, item, b'x' * 100)
+    assert cache.lookup(items[0])  # 'b' is now the least recently played
+
+    for _ in range(ADMIT_AFTER):
+        cache.lookup(items[2])
+    record(cache, items[2], b'x' * 100)
+    assert cache.lookup(items[1]) is None
+    assert cache.lookup(items[0]) and cache.lookup(items[2])
+    assert cache.size == 200
+    assert not os.path.exists(cache.path("b"))
+
+
+def test_too_large_not_recorded(tmp_path):
+    cache = PCMCache(str(tmp_path), max_size=1000, channels=1)
+    long = song("long", duration=60)
+    for _ in range(ADMIT_AFTER):
+        cache.lookup(long)
+    assert cache.recording(long) is None
+
+    # the duration may be unknown, the recording stops once it is too large
+    unknown = song("unknown", duration=None)
+    for _ in range(ADMIT_AFTER):
+        cache.lookup(unknown)
+    recording = cache.recording(unknown)
+    recording.write(b'x' * 1001)
+    recording.finish(True)
+    assert cache.lookup(unknown) is None
+    assert not os.listdir(tmp_path)
+
+
+def test_reloaded_in_the_same_order(tmp_path):
+    cache = PCMCache(str(tmp_path), channels=1)
+    for id, mtime in (("a", 300), ("b", 100), ("c", 200)):
+        item = song(id)
+        for _ in range(ADMIT_AFTER):
+            cache.lookup(item)
+        record(cache, item, b'x' * 10)
+        os.utime(cache.path(id), (mtime, mtime))
+    open(os.path.join(tmp_path, "d.1ch.pcm.part"), 'wb').close()
+
+    cache = PCMCache(str(tmp_path), max_size=20, channels=1)
+    assert list(cache.files) == ["c", "a"]
+    assert not os.path.exists(os.path.join(tmp_path, "d.1ch.pcm.part"))
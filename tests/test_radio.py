@@ -0,0 +1,62 @@
+import threading
+import time
+
+from media.radio import MetadataCache
+
+
+def test_fetched_once_within_ttl():
+    calls = []
+    cache = MetadataCache(lambda url: calls.append(url) or f"title of {url}", ttl=60)
+    assert cache.get("a") == "title of a"
+    assert cache.get("a") == "title of a"
+    assert cache.get("b") == "title of b"
+    assert calls == ["a", "b"]
+
+
+def test_fetched_again_once_expired():
+    calls = []
+    cache = MetadataCache(lambda url: calls.append(url) or len(calls), ttl=0.01)
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a") == 2
+    assert len(cache.entries) == 1
+
+
+def test_concurrent_callers_share_one_fetch():
+    calls = []
+    release = threading.Event()
+
+    def fetch(url):
+        calls.append(url)
+        release.wait(1)
+        return "title"
+
+    cache = MetadataCache(fetch, ttl=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("a"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(1)
+    assert results == ["title"] * 4
+    assert calls == ["a"]
+
+
+def test_failed_fetch_is_not_cached():
+    calls = []
+
+    def fetch(url):
+        calls.append(url)
+        if len(calls) == 1:
+            raise ConnectionError()
+        return "title"
+
+    cache = MetadataCache(fetch, ttl=60)
+    try:
+        cache.get("a")
+    except ConnectionError:
+        pass
+    assert cache.get("a") == "title"
+    assert not cache.fetching
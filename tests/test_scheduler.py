@@ -0,0 +1,40 @@
+import threading
+import time
+
+from audio.scheduler import PlaybackScheduler
+
+
+def test_event_before_wait_is_not_lost():
+    scheduler = PlaybackScheduler()
+    scheduler.notify("decoder")
+    scheduler.notify("pause")
+    start = time.monotonic()
+    assert scheduler.wait(1) == {"decoder", "pause"}
+    assert time.monotonic() - start < 0.5
+    assert scheduler.wakeups == 1
+
+
+def test_timeout():
+    scheduler = PlaybackScheduler()
+    assert scheduler.wait(0.01) == set()
+    assert scheduler.timeouts == 1
+
+
+def test_notify_wakes_up_a_waiting_loop():
+    scheduler = PlaybackScheduler()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(scheduler.wait(5)))
+    thread.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    scheduler.notify("play")
+    thread.join(1)
+    assert result == [{"play"}]
+    assert time.monotonic() - start < 0.5
+
+
+def test_clear_forgets_events():
+    scheduler = PlaybackScheduler()
+    scheduler.notify("interrupt")
+    scheduler.clear()
+    assert scheduler.wait(0.01) == set()
@@ -0,0 +1,85 @@
+import time
+
+from audio.shared import SharedDecoder, SharedStream, StreamHub
+
+URI = "http://radio.example/stream"
+
+
+def started_stream(hub, channels=2):
+    # a stream the hub already has, without running ffmpeg
+    stream = SharedStream(hub, URI, channels)
+    hub.streams[(URI, channels)] = stream
+    return stream
+
+
+def test_second_decoder_shares_the_stream():
+    hub = StreamHub()
+    stream = started_stream(hub)
+    first = SharedDecoder(hub, URI, 2).start()
+    second = SharedDecoder(hub, URI, 2).start()
+    assert first.stream is stream and second.stream is stream
+    assert stream.subscribers == [first, second]
+    assert hub.stats() == {'streams': 1, 'subscribers': 2}
+
+
+def test_last_one_out_stops_the_stream():
+    hub = StreamHub()
+    stream = started_stream(hub)
+    first = SharedDecoder(hub, URI, 2).start()
+    second = SharedDecoder(hub, URI, 2).start()
+
+    first.kill()
+    assert stream.subscribers == [second]
+    assert not stream.aborted
+    assert first.buffer.is_aborted()
+
+    second.kill()
+    assert stream.aborted
+    assert hub.stats() == {'streams': 0, 'subscribers': 0}
+    # killing twice changes nothing
+    second.kill()
+    assert hub.stats()['streams'] == 0
+
+
+def test_stopped_stream_takes_no_subscriber():
+    hub = StreamHub()
+    stream = started_stream(hub)
+    stream.aborted = True
+    assert not stream.subscribe(SharedDecoder(hub, URI, 2))
+    assert stream.subscribers == []
+
+
+def test_blocks_go_to_every_subscriber():
+    hub = StreamHub()
+    stream = started_stream(hub)
+    decoders = [SharedDecoder(hub, URI, 2).start() for _ in range(2)]
+    stream._fan_out(b'\x01' * stream.frame_size)
+    for decoder in decoders:
+        assert bytes(decoder.read()) == b'\x01' * stream.frame_size
+
+
+def test_full_subscriber_doesnt_hold_up_the_others():
+    hub = StreamHub()
+    stream = started_stream(hub)
+    stuck = SharedDecoder(hub, URI, 2, buffer_duration=0.02).start()
+    decoder = SharedDecoder(hub, URI, 2).start()
+    start = time.monotonic()
+    for value in range(1, 4):
+        stream._fan_out(bytes([value]) * stream.frame_size)
+    # without waiting for the stuck bot
+    assert time.monotonic() - start < 0.5
+    assert stuck.buffer.overruns == 1
+    for value in range(1, 4):
+        assert bytes(decoder.read()) == bytes([value]) * stream.frame_size
+    # the stuck one missed the last frame
+    assert bytes(stuck.read()) == b'\x01' * stream.frame_size
+    assert bytes(stuck.read()) == b'\x02' * stream.frame_size
+    assert stuck.read() is None
+
+
+def test_channels_are_separate_streams():
+    hub = StreamHub()
+    stereo = started_stream(hub, 2)
+    mono = started_stream(hub, 1)
+    assert SharedDecoder(hub, URI, 2).start().stream is stereo
+    assert SharedDecoder(hub, URI, 1).start().stream is mono
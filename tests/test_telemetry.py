@@ -0,0 +1,96 @@
+import threading
+import time
+
+from audio.pcm import FRAME_DURATION
+from audio.telemetry import Histogram, LoopTelemetry, LoopWatchdog
+
+
+def test_frames_in_time_are_not_late():
+    telemetry = LoopTelemetry()
+    assert not telemetry.sent(0.2, playing=True)  # the first frame of the song
+    assert not telemetry.sent(0.2, playing=True)
+    assert telemetry.frames == 2 and telemetry.late_frames == 0
+
+
+def test_frame_after_the_output_ran_dry_is_late():
+    telemetry = LoopTelemetry()
+    telemetry.sent(0.0, playing=True)
+    # one frame was queued, gone after 10 ms
+    time.sleep(FRAME_DURATION + 0.02)
+    assert telemetry.sent(0.0, playing=True)
+    assert telemetry.late_frames == 1
+    assert telemetry.max_gap > FRAME_DURATION
+
+
+def test_frame_starting_a_song_is_not_late():
+    telemetry = LoopTelemetry()
+    telemetry.sent(0.0, playing=True)
+    time.sleep(FRAME_DURATION + 0.02)
+    assert not telemetry.sent(0.0, playing=False)
+
+
+def test_frame_after_a_pause_is_not_late():
+    telemetry = LoopTelemetry()
+    telemetry.sent(0.0, playing=True)
+    time.sleep(FRAME_DURATION + 0.02)
+    telemetry.resumed()
+    assert not telemetry.sent(0.0, playing=True)
+    assert telemetry.late_frames == 0
+
+
+def test_phases():
+    telemetry = LoopTelemetry()
+    telemetry.enter("Wait for buffer 0.512")
+    telemetry.enter("Wait for buffer 0.3")
+    telemetry.enter("Reading raw")
+    telemetry.enter("Wait for buffer 0.1")
+    assert telemetry.phases["Wait for buffer"][1] == 1
+    assert telemetry.phases["Reading raw"][1] == 1
+
+
+def test_histogram():
+    histogram = Histogram((0.0, 0.1, float('inf')))
+    for value in (0.0, 0.05, 0.1, 3):
+        histogram.add(value)
+    assert histogram.counts == [1, 2, 1]
+    assert histogram.format() == ["≤ 0 ms: 1 (25.0%)", "≤ 100 ms: 2 (50.0%)", "> 100 ms: 1 (25.0%)"]
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_watchdog_reports_a_stall_once(monkeypatch):
+    monkeypatch.setattr(LoopWatchdog, 'dump', staticmethod(lambda: "stacks"))
+    telemetry = LoopTelemetry()
+    playing = threading.Event()
+    playing.set()
+    watchdog = LoopWatchdog(telemetry, playing.is_set, 0.05)
+    telemetry.sent(0.0, playing=True)
+    watchdog.start()
+    wait_until(lambda: telemetry.stalls)
+    time.sleep(0.2)
+    assert telemetry.stalls == 1
+
+    # a new stall after frames were sent again
+    telemetry.sent(0.0, playing=True)
+    wait_until(lambda: telemetry.stalls == 2)
+    playing.clear()
+
+
+def test_watchdog_ignores_pauses(monkeypatch):
+    monkeypatch.setattr(LoopWatchdog, 'dump', staticmethod(lambda: "stacks"))
+    telemetry = LoopTelemetry()
+    playing = threading.Event()
+    watchdog = LoopWatchdog(telemetry, playing.is_set, 0.2)
+    telemetry.sent(0.0, playing=True)
+    watchdog.start()
+    time.sleep(0.5)
+    # the song resumes: the time paused isn't a stall
+    playing.set()
+    time.sleep(0.05)
+    assert telemetry.stalls == 0
+    playing.clear()